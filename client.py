@@ -6,7 +6,15 @@
 # Search "python <name> library" for documentation
 #import string  # Python library with useful string constants
 #import dacite  # Helpers for serializing dicts into dataclasses
-#import pymerkle # Merkle tree implementation (CS1620/CS2660 only, but still optional)
+import pymerkle # Merkle tree implementation (CS1620/CS2660 only, but still optional)
+
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import random
+import threading
+import time
 
 ## ** Support code libraries ****
 # The following imports load our support code from the "support"
@@ -19,57 +27,1541 @@ import support.util as util                       # Various helper functions
 from support.dataserver import dataserver, memloc
 from support.keyserver import keyserver
 
+# Raised by dataserver.SetIfVersion when a record changed since it was read
+from support.dataserver import VersionConflict
+
 # **NOTE**:  If you want to use any additional libraries, please ask on Ed
 # first.  You are NOT permitted to use any additional cryptographic functions
 # other than those provided by crypto.py, or any filesystem/networking
 # libraries.
 
+##
+## File layout
+##
+## Every file is described by a header stored at a random memloc and
+## sealed under a per-file key-encryption key (KEK):
+##
+##   header = {"size": total bytes,
+##             "keys": [data key for each key epoch],
+##             "index": ref of the root of the index tree, or None,
+##             "depth": number of levels of nodes above the pages}
+##
+## File contents are split into chunks of at most CHUNK_SIZE bytes,
+## each encrypted under its epoch's data key.  Chunks are listed, in
+## order, by index pages (stored at random memlocs) of at most
+## PAGE_ENTRIES entries:
+##
+##   page = [[chunk addr, length, tag, epoch], ...]
+##
+## Pages are listed, in order, by a tree of nodes of at most NODE_ENTRIES
+## refs each.  Nodes just above the pages list page refs, and higher
+## nodes list node refs; with depth 0, the root is a page:
+##
+##   node = [ref, ...]
+##   ref = [addr, epoch, digest, nbytes, nchunks]
+##
+## A ref's digest is the Merkle root over the entries of the page or node
+## it points to (see _merkle_root), and nbytes and nchunks count the
+## bytes and chunks below it.  The header's MAC covers the root's digest,
+## and each page or node is checked against the digest in its parent when
+## it is loaded, so a chunk is found, by offset or by index, and checked
+## with only the header, the nodes on the path to its page and the page.
+##
+## Besides PAGE_ENTRIES, a page also ends after an entry whose tag starts
+## with a byte below PAGE_CUT, so page boundaries follow the contents and
+## pages that are unchanged by an overwrite keep the same digest and are
+## reused.
+##
+## Appending only writes the new chunks, fresh copies of the last page
+## and of the nodes on the path to it, and the header.  Its cost depends
+## on the appended bytes and the depth of the tree, which grows by one
+## level each time the number of pages grows NODE_ENTRIES times, rather
+## than on the size of the file.
+##
+## Chunks are encrypted with AuthenticatedEncrypt, with their memloc as
+## associated data, and page entries record their AEAD tag.  They are
+## content-addressed: the memloc and nonce of a chunk are taken from an
+## HMAC of its plaintext under a dedup key derived from the epoch's data
+## key.  Identical chunks of a file therefore share one
+## memloc and one ciphertext, and re-uploading an edited file only
+## writes the chunks that changed.  Uploads cut chunks at content-defined
+## boundaries (see _cdc) so that an insertion only changes the chunks
+## around it.
+##
+
+## Access and revocation
+##
+## The owner's pointer to a file holds the header's memloc and the KEK,
+## and once the file is shared, a reference to its share table:
+##
+##   pointer = {"meta": header addr, "kek": KEK,
+##              "shares": {"id": table id, "last": last page addr,
+##                         "count": number of recipients}}
+##
+## Each direct recipient reaches the file through a small branch record
+## sealed under its own branch key:
+##
+##   branch = {"meta": header addr, "kek": KEK}
+##
+## The share table lists the branches in pages of at most
+## SHARE_PAGE_ENTRIES entries, each linking to the page before it:
+##
+##   share page = {"prev": page addr or None,
+##                 "entries": [[recipient, branch addr, branch key], ...]}
+##
+## Sharing copies the last page to a new memloc with one more entry, or
+## starts a new page after a full one, so each share writes a bounded
+## amount whatever the number of recipients.  Each recipient also has a
+## record of its [branch addr, branch key], at a memloc keyed by the
+## owner's files key, the table id and the recipient, so that a share
+## is found without reading the table.  Share pages and records are
+## sealed under the owner's files key.
+##
+## Recipients may share the file further.  Each of their recipients gets
+## a record pointing at the sharer's own record, so access forms a tree
+## rooted at the owner's branches:
+##
+##   branch = {"parent": [parent branch addr, parent branch key]}
+##
+## A recipient's pointer holds the memloc and key of its record,
+##
+##   pointer = {"node": [branch addr, branch key]},
+##
+## and is resolved to the header by following parents, one hop per
+## level of the tree.  Resolved routes are cached by each User and only
+## resolved again once the header they lead to is gone.  Records are
+## handed over through an invitation stored at a memloc derived from the
+## sender, recipient and filename; it holds the branch memloc and key
+## encrypted to the recipient and is signed by the sender, so each share
+## costs one AsymmetricEncrypt.  Revoking a direct recipient deletes its
+## record, which also cuts off everyone who received the file from it.
+##
+## Revocation rotates keys lazily: the header moves to a new memloc under
+## a new KEK, a new data key epoch is added for future writes, and the
+## remaining branch records are rewritten.  Chunks and index pages are
+## left alone, so revoking access costs the same for any file size; old
+## chunks are re-encrypted under the new epoch when they are next
+## overwritten.  Before the new pointer is stored, the old header is
+## replaced with a tombstone, {"moved": True}, if it has not changed
+## since it was copied.  Updates that committed first make the revocation
+## retry, and later ones find the tombstone and retry on the new header.
+##
+
+CHUNK_SIZE = 64 * 1024
+PAGE_ENTRIES = 128
+PAGE_CUT = 2
+
+# Number of refs listed by each node of a file's index tree
+NODE_ENTRIES = 64
+
+# Content-defined chunking parameters: the smallest chunk cut at a
+# boundary, and the width of the rolling hash window.  Chunks average
+# about CDC_MIN + 2**(CDC_BITS + 1) bytes, capped at CHUNK_SIZE.
+CDC_MIN = 4 * 1024
+CDC_BITS = 14
+
+# Number of chunks read or written per dataserver call.  This bounds the
+# memory used by streaming uploads and downloads.
+BATCH_CHUNKS = 16
+
+# Length of the HMAC appended to sealed records
+MAC_LEN = 64
+
+# Number of decrypted records (pointers, headers and pages) each User
+# keeps in its read cache
+CACHE_ENTRIES = 1024
+
+# Number of recipients listed by each page of a file's share table
+SHARE_PAGE_ENTRIES = 64
+
+# Attempts at an optimistic metadata update (see User._retry) before
+# giving up, and the longest random wait between attempts, in seconds
+UPDATE_ATTEMPTS = 64
+UPDATE_BACKOFF = 0.1
+
 
 def s_addr(s):
     return memloc.MakeFromBytes(crypto.Hash(s.encode("utf-8"))[:16])
 
 
+def _seal(key: bytes, addr: bytes, obj: object) -> bytes:
+    """
+    Serialize obj, encrypt it and MAC it together with the memloc it will
+    be stored at, using subkeys derived from key.
+    """
+    enc_key = crypto.HashKDF(key, "enc")
+    mac_key = crypto.HashKDF(key, "mac")
+
+    ciphertext = crypto.SymmetricEncrypt(enc_key, crypto.SecureRandom(16),
+                                         util.ObjectToBytes(obj, codec="binary"))
+    return ciphertext + _record_mac(mac_key, addr, ciphertext)
+
+
+def _record_mac(mac_key: bytes, addr: bytes, ciphertext) -> bytes:
+    """
+    MAC a record's memloc followed by its ciphertext, without joining them.
+    """
+    mac = crypto.HMACContext(mac_key)
+    mac.update(addr)
+    mac.update(ciphertext)
+    return mac.finalize()
+
+
+def _unseal(key: bytes, addr: bytes, blob: bytes) -> object:
+    """
+    Check and decrypt a record made by _seal.  Raises DropboxError if the
+    record was modified or moved.
+    """
+    enc_key = crypto.HashKDF(key, "enc")
+    mac_key = crypto.HashKDF(key, "mac")
+
+    ciphertext, tag = memoryview(blob)[:-MAC_LEN], blob[-MAC_LEN:]
+    if len(tag) != MAC_LEN or not crypto.HMACEqual(tag, _record_mac(mac_key, addr, ciphertext)):
+        raise util.DropboxError("Integrity check failed")
+
+    return util.BytesToObject(crypto.SymmetricDecrypt(enc_key, ciphertext))
+
+
+def _get(addr: bytes) -> bytes:
+    """
+    Fetch a value from the dataserver, raising DropboxError if it is missing.
+    The value may be a read-only memoryview rather than bytes.
+    """
+    try:
+        return dataserver.Get(addr)
+    except ValueError:
+        raise util.DropboxError("Value not found")
+
+
+def _get_many(addrs: list) -> list:
+    """
+    Fetch several values in one dataserver call, raising DropboxError if any
+    of them is missing.  Values may be read-only memoryviews.
+    """
+    found = dataserver.GetMany(addrs)
+    vals = [found[a] for a in addrs]
+    if any(v is None for v in vals):
+        raise util.DropboxError("Value not found")
+    return vals
+
+
+class _DataKeys:
+    """
+    Subkeys derived from a data key, used to encrypt and address chunks.
+    """
+    def __init__(self, dk: bytes) -> None:
+        self.enc_key = crypto.HashKDF(dk, "enc")
+        self.dedup_key = crypto.HashKDF(dk, "dedup")
+
+    def cdc_table(self) -> bytes:
+        """
+        A keyed bytes.translate table mapping each byte value to one bit,
+        used by _cdc.
+        """
+        bits = crypto.HMAC(self.dedup_key, b"cdc table")
+        return bytes((bits[b >> 3] >> (b & 7)) & 1 for b in range(256))
+
+    def locate(self, piece: bytes):
+        """
+        Returns: (memloc, nonce) for a chunk, both derived from its contents
+        """
+        digest = crypto.HMAC(self.dedup_key, piece)
+        return memloc.MakeFromBytes(digest[:16]), digest[16:16 + crypto.AEAD_NONCE_LEN]
+
+
+def _chunk_tag(ciphertext: bytes) -> bytes:
+    """
+    Returns: the AEAD tag of a chunk's ciphertext
+    """
+    return ciphertext[-crypto.AEAD_NONCE_LEN - crypto.AEAD_TAG_LEN:-crypto.AEAD_NONCE_LEN]
+
+
+def _encrypt_chunk(dk: _DataKeys, epoch: int, piece: bytes, addr: bytes, nonce: bytes,
+                   entry: list):
+    """
+    Encrypt one chunk, bound to its memloc, unless an entry for the same
+    contents already exists.
+
+    Returns: (memloc, ciphertext or None if reused, page entry)
+    """
+    if entry is not None:
+        return addr, None, entry
+
+    ciphertext = crypto.AuthenticatedEncrypt(dk.enc_key, nonce, piece, addr)
+    return addr, ciphertext, [addr, len(piece), _chunk_tag(ciphertext), epoch]
+
+
+def _decrypt_chunk(dk: _DataKeys, entry: list, ciphertext: bytes) -> bytes:
+    """
+    Check and decrypt one chunk against its page entry.
+    """
+    addr, length, tag, _ = entry
+    try:
+        if not crypto.HMACEqual(tag, _chunk_tag(ciphertext)):
+            raise ValueError("Wrong version")
+        chunk = crypto.AuthenticatedDecrypt(dk.enc_key, ciphertext, addr)
+    except ValueError:
+        raise util.DropboxError("Integrity check failed")
+    if len(chunk) != length:
+        raise util.DropboxError("Integrity check failed")
+    return chunk
+
+
+def _leaf(entry: list) -> bytes:
+    """
+    The Merkle tree leaf for a page entry.
+    """
+    return util.ObjectToBytes(entry, codec="binary")
+
+
+def _merkle_root(leaves) -> bytes:
+    """
+    Returns: the raw Merkle root digest over the given (non-empty) leaves
+    """
+    # pymerkle gives the root as hex
+    return bytes.fromhex(pymerkle.MerkleTree.init_from_entries(*leaves).root.decode())
+
+
+def _pmap(func, arg_tuples, workers: int):
+    """
+    Like itertools.starmap, but runs func on up to `workers` threads.
+    Results are yielded in order, and at most max(workers, BATCH_CHUNKS)
+    calls are in flight, so arg_tuples is consumed lazily.
+    """
+    if workers <= 1:
+        for args in arg_tuples:
+            yield func(*args)
+        return
+
+    window = max(workers, BATCH_CHUNKS)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for args in arg_tuples:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _RecordCache(collections.OrderedDict):
+    """
+    A bounded LRU cache of decrypted records, keyed by memloc.
+
+    Each entry keeps the key the record was checked with, a tag
+    identifying the exact version that was checked (its MAC, or for
+    index pages and nodes, the digest listed in their parent) and the
+    decoded object.  A record whose stored tag still matches can be used
+    without checking or decrypting it again: any other ciphertext
+    carrying the same tag would be a MAC forgery.
+
+    Cached objects are shared, so callers must copy before modifying them.
+    The cache may be used from several threads (see AsyncUser).
+    """
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, addr: bytes, key: bytes, tag: bytes):
+        """
+        Returns: the cached object, or None if it is missing or stale
+        """
+        with self._lock:
+            entry = self.get(addr)
+            if entry is not None and entry[0] == key and entry[1] == tag:
+                self.move_to_end(addr)
+                self.hits += 1
+                return entry[2]
+
+            self.misses += 1
+            return None
+
+    def store(self, addr: bytes, key: bytes, tag: bytes, obj: object) -> None:
+        with self._lock:
+            self[addr] = (key, tag, obj)
+            self.move_to_end(addr)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def discard(self, addrs) -> None:
+        with self._lock:
+            for addr in addrs:
+                self.pop(addr, None)
 
 
 class User:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, username: str, dec_key: crypto.AsymmetricDecryptKey,
+                 sign_key: crypto.SignatureSignKey, files_key: bytes) -> None:
+        self.username = username
+        self._dec_key = dec_key
+        self._sign_key = sign_key
+        self._files_key = files_key
+
+        # Number of threads used to encrypt and decrypt chunks.  The
+        # crypto library releases the GIL, so more than one worker lets
+        # chunk crypto use several cores.
+        self.workers = 1
+
+        self._cache = _RecordCache(CACHE_ENTRIES)
+
+        # Resolved (header addr, KEK) for each branch record this user
+        # received, keyed by the record's memloc
+        self._routes = _RecordCache(CACHE_ENTRIES)
+
+        # Chunks and bytes uploaded, and how many of them were already
+        # stored and did not have to be written again
+        self.upload_stats = {"chunks": 0, "reused": 0, "bytes": 0, "bytes_saved": 0}
+
+    ##
+    ## Records
+    ##
+
+    def _unseal_cached(self, key: bytes, addr: bytes, blob: bytes) -> object:
+        """
+        Like _unseal, but use the cached object if blob has the same tag
+        as the version that was last checked.
+        """
+        tag = bytes(blob[-MAC_LEN:])
+        obj = self._cache.lookup(addr, key, tag)
+        if obj is None:
+            obj = _unseal(key, addr, blob)
+            self._cache.store(addr, key, tag, obj)
+        return obj
+
+    def _seal_cached(self, key: bytes, addr: bytes, obj: object) -> bytes:
+        """
+        Like _seal, but also cache obj as the current version of the record.
+        """
+        blob = _seal(key, addr, obj)
+        self._cache.store(addr, key, blob[-MAC_LEN:], obj)
+        return blob
+
+    def _set_many(self, records: dict) -> None:
+        """
+        Store chunks and index pages.  They must all be stored before the
+        header that lists them (see _wait_writes).
+        """
+        dataserver.SetMany(records)
+
+    def _wait_writes(self) -> None:
+        """
+        Wait until the records this operation passed to _set_many are
+        stored, raising the first error.  Called before a header is
+        stored.  User writes synchronously, so there is nothing to wait for.
+        """
+
+    def _delete_many(self, addrs: list) -> None:
+        self._cache.discard(addrs)
+        dataserver.DeleteMany(addrs)
+
+    def _abandon(self, addrs: list) -> None:
+        """
+        Delete records written by an operation that failed before
+        anything referred to them, once any writes still in flight land.
+        """
+        try:
+            self._wait_writes()
+        except Exception:
+            pass
+        if addrs:
+            self._delete_many(addrs)
+
+    ##
+    ## File lookup
+    ##
+
+    def _file_addr(self, filename: str) -> bytes:
+        """
+        Memloc of this user's pointer to a file.  It is keyed so that
+        filenames are not revealed by the memloc.
+        """
+        return memloc.MakeFromBytes(
+            crypto.HMAC(self._files_key, filename.encode("utf-8"))[:16])
+
+    def _load_pointer(self, filename: str):
+        """
+        Returns this user's pointer to a file, or None if there is none.
+        """
+        return self._load_pointer_versioned(filename)[0]
+
+    def _load_pointer_versioned(self, filename: str):
+        """
+        Returns: (pointer or None, its version on the dataserver)
+        """
+        addr = self._file_addr(filename)
+        blob, version = dataserver.GetVersioned(addr)
+        if blob is None:
+            return None, version
+        return self._unseal_cached(self._files_key, addr, blob), version
+
+    def _store_pointer(self, filename: str, pointer: dict, version: int = None) -> None:
+        """
+        Store a pointer.  If a version is given, the pointer is only
+        stored if it is still at that version; otherwise VersionConflict
+        is raised.
+        """
+        addr = self._file_addr(filename)
+        blob = self._seal_cached(self._files_key, addr, pointer)
+        if version is None:
+            dataserver.Set(addr, blob)
+        else:
+            dataserver.SetIfVersion(addr, blob, version)
+
+    def _resolve(self, pointer: dict, fresh: bool = False):
+        """
+        Follow a pointer, and for shared files the branch records above
+        it, to the file's header.  Unless `fresh` is set, a route that
+        was resolved before is used without fetching any records.
+
+        Returns: (header addr, KEK), None if a record on the way is
+                 missing (access was revoked), or raises DropboxError
+        """
+        if "kek" in pointer:
+            return pointer["meta"], pointer["kek"]
+
+        start_addr, start_key = pointer["node"]
+        route = None if fresh else self._routes.lookup(start_addr, start_key, None)
+        if route is None:
+            node_addr, node_key = start_addr, start_key
+            while True:
+                blob = dataserver.GetVersioned(node_addr)[0]
+                if blob is None:
+                    return None
+                node = self._unseal_cached(node_key, node_addr, blob)
+                if "parent" not in node:
+                    break
+                node_addr, node_key = node["parent"]
+            route = (node["meta"], node["kek"])
+            self._routes.store(start_addr, start_key, None, route)
+        return route
+
+    def _load_header(self, pointer: dict, missing_ok: bool = False):
+        """
+        Returns: (header addr, KEK, header, header version) for a pointer
+                 or raises DropboxError.  If the file is gone (access was
+                 revoked) and `missing_ok` is set, returns None instead.
+                 Raises VersionConflict if the header is being moved; the
+                 pointer should then be read again (see _open).
+        """
+        route = self._resolve(pointer)
+        header, version = self._get_header(*route) if route else (None, 0)
+        if (header is None or "moved" in header) and "node" in pointer:
+            # The header moved since the route was cached
+            route = self._resolve(pointer, fresh=True)
+            header, version = self._get_header(*route) if route else (None, 0)
+        if header is None:
+            if missing_ok:
+                return None
+            raise util.DropboxError("File not found")
+        if "moved" in header:
+            # Keys are being rotated, and the new header is not reachable
+            # yet (see _rotate_keys)
+            raise VersionConflict("VersionConflict")
+        meta_addr, kek = route
+        return meta_addr, kek, header, version
+
+    def _get_header(self, meta_addr: bytes, kek: bytes):
+        """
+        Returns: (header or None if missing, its version)
+        """
+        blob, version = dataserver.GetVersioned(meta_addr)
+        if blob is None:
+            return None, version
+        return self._unseal_cached(kek, meta_addr, blob), version
+
+    def _open(self, filename: str):
+        """
+        Resolve a file to its header.
+
+        Returns: (header addr, KEK, header, header version) or raises
+                 DropboxError
+        """
+        def attempt():
+            pointer = self._load_pointer(filename)
+            if pointer is None:
+                raise util.DropboxError("File not found")
+            return self._load_header(pointer)
+
+        return self._retry(attempt)
+
+    ##
+    ## Share table
+    ##
+
+    def _share_addr(self, table_id: bytes, recipient: str) -> bytes:
+        """
+        Memloc of the record of a file's share with one recipient.
+        """
+        return memloc.MakeFromBytes(
+            crypto.HMAC(self._files_key, table_id + recipient.encode("utf-8"))[:16])
+
+    def _load_shares(self, pointer: dict):
+        """
+        Read a file's share table, following the pages back from the last.
+
+        Returns: (list of [recipient, branch addr, branch key] in the
+                  order they were shared, list of page memlocs)
+        """
+        pages, addrs = [], []
+        addr = pointer["shares"]["last"] if "shares" in pointer else None
+        while addr is not None:
+            page = self._unseal_cached(self._files_key, addr, _get(addr))
+            pages.append(page["entries"])
+            addrs.append(addr)
+            addr = page["prev"]
+        return list(itertools.chain.from_iterable(reversed(pages))), addrs
+
+    def _check_version(self, filename: str, version: int) -> None:
+        """
+        Raise VersionConflict if a file's pointer is no longer at
+        `version`.  A record that went missing while it was read through
+        an older pointer may have been replaced by a concurrent update.
+        """
+        if self._load_pointer_versioned(filename)[1] != version:
+            raise VersionConflict("VersionConflict")
+
+    def _seal_shares(self, entries: list, prev: bytes = None):
+        """
+        Seal share table entries into pages at new memlocs, after the
+        page at `prev`.
+
+        Returns: (dict of page memloc -> record, memloc of the last page)
+        """
+        records = {}
+        for i in range(0, len(entries), SHARE_PAGE_ENTRIES):
+            addr = memloc.Make()
+            page = {"prev": prev, "entries": entries[i:i + SHARE_PAGE_ENTRIES]}
+            records[addr] = self._seal_cached(self._files_key, addr, page)
+            prev = addr
+        return records, prev
+
+    ##
+    ## Chunks and pages
+    ##
+
+    def _load_pages(self, header: dict, refs: list) -> list:
+        """
+        Fetch and check the index pages or nodes for the given refs.
+        They are never modified once written, so cached ones whose
+        digest matches the ref are used without fetching them.
+        """
+        pages = [self._cache.lookup(ref[0], header["keys"][ref[1]], ref[2]) for ref in refs]
+
+        missing = [ref for ref, page in zip(refs, pages) if page is None]
+        if not missing:
+            return pages
+        blobs = iter(_get_many([ref[0] for ref in missing]))
+
+        for i, ref in enumerate(refs):
+            if pages[i] is not None:
+                continue
+            page_addr, epoch, digest = ref[0], ref[1], ref[2]
+            pages[i] = _unseal(header["keys"][epoch], page_addr, next(blobs))
+            if _merkle_root(_leaf(e) for e in pages[i]) != digest:
+                raise util.DropboxError("Integrity check failed")
+            self._cache.store(page_addr, header["keys"][epoch], digest, pages[i])
+        return pages
+
+    def _index_refs(self, header: dict):
+        """
+        Load a file's whole index tree, one level at a time.
+
+        Returns: (list of page refs in order, list of node refs)
+        """
+        refs = [header["index"]] if header["index"] is not None else []
+        nodes = []
+        for _ in range(header["depth"]):
+            nodes.extend(refs)
+            refs = list(itertools.chain.from_iterable(self._load_pages(header, refs)))
+        return refs, nodes
+
+    def _find_pages(self, header: dict, field: int, start: int, end: int):
+        """
+        Find the pages that cover [start, end), counted in bytes (field 3
+        of a ref) or in chunks (field 4), loading only the nodes on the
+        way down to them.
+
+        Returns: (list of page refs, position of the first one)
+        """
+        refs = [header["index"]] if header["index"] is not None else []
+        pos = 0
+        for _ in range(header["depth"]):
+            covering, at = [], pos
+            for ref in itertools.chain.from_iterable(self._load_pages(header, refs)):
+                if at >= end:
+                    break
+                if at + ref[field] > start:
+                    if not covering:
+                        pos = at
+                    covering.append(ref)
+                at += ref[field]
+            refs = covering
+        return refs, pos
+
+    def _read_chunks(self, header: dict, entries: list):
+        """
+        Fetch, check and decrypt the chunks listed by page entries.
+        Returns an iterator of plaintext chunks, in order.
+        """
+        keys = {}
+
+        def fetched():
+            for i in range(0, len(entries), BATCH_CHUNKS):
+                batch = entries[i:i + BATCH_CHUNKS]
+                blobs = _get_many([e[0] for e in batch])
+                for entry, ciphertext in zip(batch, blobs):
+                    epoch = entry[3]
+                    if epoch not in keys:
+                        keys[epoch] = _DataKeys(header["keys"][epoch])
+                    yield keys[epoch], entry, ciphertext
+
+        return _pmap(_decrypt_chunk, fetched(), self.workers)
+
+    def _append_chunks(self, header: dict, pieces, existing: dict = None,
+                       old_pages: dict = None, written: list = None):
+        """
+        Encrypt and store each plaintext piece as a chunk under the
+        current key epoch, extending the header's index tree.  The last
+        page and the nodes on the path to it are copied to fresh memlocs
+        rather than modified in place.
+
+        Pieces whose memloc is a key of `existing` (memloc -> page entry)
+        are already stored, and their entry is reused without writing;
+        the entries of new chunks are added to it.  Likewise, a new page
+        or node whose digest is a key of `old_pages` (digest -> ref)
+        reuses that one.  The memlocs of the records that are stored are
+        added to `written`, if given.
+
+        Returns: (list of memlocs no longer referenced by the header,
+                  set of chunk, page and node memlocs referenced by new
+                  entries)
+        """
+        existing = existing if existing is not None else {}
+        old_pages = old_pages if old_pages is not None else {}
+        written = written if written is not None else []
+        stats = self.upload_stats
+        used = set()
+
+        epoch = len(header["keys"]) - 1
+        page_key = header["keys"][epoch]
+        dk = _DataKeys(page_key)
+        replaced = []
+
+        pending = {}
+
+        def store():
+            written.extend(pending)
+            self._set_many(pending)
+            pending.clear()
+
+        # levels[h] holds the refs at height h (pages are at height 0)
+        # that go into the open node above them
+        levels = [[] for _ in range(header["depth"] + 1)]
+
+        def seal(items: list, nbytes: int, nchunks: int) -> list:
+            digest = _merkle_root(_leaf(e) for e in items)
+            ref = old_pages.get(digest)
+            if ref is None:
+                addr = memloc.Make()
+                pending[addr] = _seal(page_key, addr, items)
+                self._cache.store(addr, page_key, digest, items)
+                ref = [addr, epoch, digest, nbytes, nchunks]
+            used.add(ref[0])
+            return ref
+
+        def push(height: int, ref: list) -> None:
+            if height == len(levels):
+                levels.append([])
+            levels[height].append(ref)
+            if len(levels[height]) == NODE_ENTRIES:
+                close(height)
+
+        def close(height: int) -> None:
+            refs, levels[height] = levels[height], []
+            push(height + 1, seal(refs, sum(r[3] for r in refs), sum(r[4] for r in refs)))
+
+        def flush_page():
+            push(0, seal(entries, sum(e[1] for e in entries), len(entries)))
+            if pending:
+                store()
+
+        # Reopen the path to the last page, and the page unless it is full
+        entries = []
+        ref = header["index"]
+        for height in range(header["depth"], 0, -1):
+            node = self._load_pages(header, [ref])[0]
+            replaced.append(ref[0])
+            levels[height - 1] = list(node[:-1])
+            ref = node[-1]
+        if ref is not None and ref[4] < PAGE_ENTRIES:
+            entries = list(self._load_pages(header, [ref])[0])
+            replaced.append(ref[0])
+        elif ref is not None:
+            push(0, ref)
+
+        def located():
+            for piece in pieces:
+                addr, nonce = dk.locate(piece)
+                yield dk, epoch, piece, addr, nonce, existing.get(addr)
+
+        for addr, ciphertext, entry in _pmap(_encrypt_chunk, located(), self.workers):
+            stats["chunks"] += 1
+            stats["bytes"] += entry[1]
+            if ciphertext is None:
+                stats["reused"] += 1
+                stats["bytes_saved"] += entry[1]
+            else:
+                pending[addr] = ciphertext
+                existing[addr] = entry
+            used.add(addr)
+            entries.append(entry)
+            header["size"] += entry[1]
+
+            if len(entries) == PAGE_ENTRIES or entry[2][0] < PAGE_CUT:
+                flush_page()
+                entries = []
+            elif len(pending) == BATCH_CHUNKS:
+                store()
+
+        if entries:
+            flush_page()
+
+        # Close the open nodes from the bottom up, until only the root is left
+        height = 0
+        while height < len(levels) - 1 or len(levels[height]) > 1:
+            if levels[height]:
+                close(height)
+            height += 1
+        if pending:
+            store()
+
+        header["index"] = levels[-1][0] if levels[-1] else None
+        header["depth"] = len(levels) - 1
+        return replaced, used
+
+    def _store_header(self, meta_addr: bytes, kek: bytes, header: dict,
+                      version: int = None) -> None:
+        """
+        Store a header, only if it is still at `version` if one is given
+        (see _store_pointer).
+        """
+        self._wait_writes()
+        blob = self._seal_cached(kek, meta_addr, header)
+        if version is None:
+            dataserver.Set(meta_addr, blob)
+        else:
+            dataserver.SetIfVersion(meta_addr, blob, version)
+
+    def _retry(self, update):
+        """
+        Run an optimistic update: update() reads the records it changes
+        with their versions and writes them back with SetIfVersion, so it
+        raises VersionConflict if another session wrote them in between.
+        It is then run again on the new versions, after a random wait that
+        grows with each attempt.  A failed attempt must clean up whatever
+        it wrote that nothing refers to.
+
+        Returns: what update() returned
+        """
+        for attempt in range(UPDATE_ATTEMPTS):
+            try:
+                return update()
+            except VersionConflict:
+                time.sleep(random.uniform(0, min(UPDATE_BACKOFF, 0.0001 * 2 ** attempt)))
+        raise util.DropboxError("Too many concurrent updates")
+
+    def _rotate_keys(self, filename: str, pointer: dict, version: int,
+                     drop: str = None) -> None:
+        """
+        Move a file's header to a new memloc under a new KEK with a new
+        data key epoch, and rewrite the share table and the branch
+        records of everyone it is still shared with, leaving out the
+        recipient `drop`.  Bulk data is not touched.  Raises
+        VersionConflict if the header changes while it is copied.
+
+        The new pointer is stored only if the pointer is still at
+        `version`, and VersionConflict is raised otherwise.
+        """
+        meta_addr, kek = pointer["meta"], pointer["kek"]
+        blob, header_version = dataserver.GetVersioned(meta_addr)
+        if blob is None:
+            raise util.DropboxError("File not found")
+        header = self._unseal_cached(kek, meta_addr, blob)
+        if "moved" in header:
+            raise VersionConflict("VersionConflict")
+        header = dict(header, keys=header["keys"] + [crypto.SecureRandom(16)])
+
+        shares, old_pages = [], []
+        if "shares" in pointer:
+            try:
+                shares, old_pages = self._load_shares(pointer)
+            except util.DropboxError:
+                self._check_version(filename, version)
+                raise
+            shares = [e for e in shares if e[0] != drop]
+        records, last = self._seal_shares(shares)
+
+        pointer = dict(pointer, meta=memloc.Make(), kek=crypto.SecureRandom(16))
+        if "shares" in pointer:
+            pointer["shares"] = dict(pointer["shares"], last=last, count=len(shares))
+        if records:
+            dataserver.SetMany(records)
+        self._store_header(pointer["meta"], pointer["kek"], header)
+        abandoned = [pointer["meta"]] + list(records)
+
+        # Replace the old header with a tombstone, only if nobody wrote it
+        # since it was read, so that no update to it is lost.  Sessions
+        # that read the tombstone retry until the new pointer is stored.
+        try:
+            moved = dataserver.SetIfVersion(meta_addr, _seal(kek, meta_addr, {"moved": True}),
+                                            header_version)
+        except VersionConflict:
+            self._delete_many(abandoned)
+            raise
+        try:
+            self._store_pointer(filename, pointer, version)
+        except VersionConflict:
+            dataserver.SetIfVersion(meta_addr, blob, moved)
+            self._delete_many(abandoned)
+            raise
+
+        branch = {"meta": pointer["meta"], "kek": pointer["kek"]}
+        records = {}
+        for _, branch_addr, branch_key in shares:
+            records[branch_addr] = self._seal_cached(branch_key, branch_addr, branch)
+        if records:
+            dataserver.SetMany(records)
+        self._delete_many([meta_addr] + old_pages)
+
+    ##
+    ## Public API
+    ##
 
     def upload_file(self, filename: str, data: bytes) -> None:
-        dataserver.Set(s_addr(filename), data)
+        self.upload_stream(filename, _split(data))
+
+    def upload_stream(self, filename: str, pieces) -> None:
+        """
+        Upload a file from an iterable of bytes-like pieces of any size.
+        Pieces are regrouped into chunks and encrypted and stored as they
+        arrive, so the whole file is never held in memory.
+
+        When overwriting a file, chunks and index pages that are unchanged
+        from the previous version are kept rather than written again.  A
+        new file's pointer is stored last, so if the upload fails nothing
+        refers to it; the records it stored are then deleted.
+        """
+        def opened():
+            pointer = self._load_pointer(filename)
+            if pointer is None:
+                return None
+            # A pointer whose file is gone (access was revoked) is replaced
+            return self._load_header(pointer, missing_ok=True)
+
+        current = self._retry(opened)
+        new_file = current is None
+
+        existing = {}
+        old_pages = {}
+        if new_file:
+            meta_addr, kek = memloc.Make(), crypto.SecureRandom(16)
+            keys = [crypto.SecureRandom(16)]
+        else:
+            meta_addr, kek, old, version = current
+            # Overwrite in place so that anyone with access keeps it
+            pages, nodes = self._index_refs(old)
+            for page in self._load_pages(old, pages):
+                existing.update((e[0], e) for e in page)
+            old_pages = {ref[2]: ref for ref in pages + nodes}
+            keys = old["keys"]
+
+        header = {"size": 0, "keys": keys, "index": None, "depth": 0}
+        table = _DataKeys(keys[-1]).cdc_table()
+        written = []
+        try:
+            _, used = self._append_chunks(header, _cdc(pieces, table), existing, old_pages, written)
+            if new_file:
+                self._store_header(meta_addr, kek, header)
+            else:
+                try:
+                    self._store_header(meta_addr, kek, header, version)
+                    listed = set(existing).union(ref[0] for ref in old_pages.values())
+                except VersionConflict:
+                    # The file changed since it was read.  The overwrite
+                    # still replaces it, wherever its header is now, and
+                    # what goes is whatever that header listed.
+                    reused = used.difference(written)
+                    listed = self._retry(lambda: self._replace_header(filename, header, reused))
+        except Exception:
+            if not new_file:
+                # Chunks are content-addressed, and a concurrent append to
+                # the file may list the same ones, so only new pages and
+                # nodes go
+                written = [addr for addr in written if addr not in existing]
+            self._abandon(written)
+            raise
+        if new_file:
+            self._store_pointer(filename, {"meta": meta_addr, "kek": kek})
+            return
+
+        garbage = listed.difference(used)
+        if garbage:
+            self._delete_many(list(garbage))
+
+    def _replace_header(self, filename: str, header: dict, reused: set) -> set:
+        """
+        Store the header of an overwrite in place of a file's current
+        header, keeping the key epochs added since the overwrite began.
+
+        The overwrite reused the chunks and pages in `reused` from the
+        version it read.  Whoever replaced that version deletes what it
+        no longer lists, so the overwrite only goes ahead if the current
+        header still lists all of them.
+
+        Returns: set of chunk, page and node memlocs listed by the
+                 replaced header
+        """
+        meta_addr, kek, current, version = self._open(filename)
+        if current["keys"][:len(header["keys"])] != header["keys"]:
+            raise util.DropboxError("File was replaced during upload")
+        pages, nodes = self._index_refs(current)
+        listed = {ref[0] for ref in pages + nodes}
+        for page in self._load_pages(current, pages):
+            listed.update(e[0] for e in page)
+        if not reused <= listed:
+            raise util.DropboxError("File was replaced during upload")
+        self._store_header(meta_addr, kek, dict(header, keys=current["keys"]), version)
+        return listed
 
     def download_file(self, filename: str) -> bytes:
-        return dataserver.Get(s_addr(filename))
+        return b"".join(self.download_stream(filename))
+
+    def download_stream(self, filename: str):
+        """
+        Download a file as an iterator of plaintext chunks.  Chunks are
+        fetched and decrypted BATCH_CHUNKS at a time as the iterator is
+        consumed.  Raises DropboxError right away if the file is missing.
+        """
+        _, _, header, _ = self._open(filename)
+        refs, _ = self._index_refs(header)
+
+        def stream():
+            for ref in refs:
+                page = self._load_pages(header, [ref])[0]
+                yield from self._read_chunks(header, page)
+
+        return stream()
+
+    def download_range(self, filename: str, offset: int, length: int) -> bytes:
+        """
+        Download part of a file, fetching and checking only the index
+        pages and chunks that cover it and the nodes above those pages.
+
+        Params:
+        > filename - str
+        > offset - int, position of the first byte to read
+        > length - int, number of bytes to read
+
+        Returns: the bytes of the file in [offset, offset + length); fewer
+        than `length` if the range runs past the end of the file
+        """
+        if offset < 0 or length < 0:
+            raise util.DropboxError("Invalid range")
+
+        _, _, header, _ = self._open(filename)
+        end = min(offset + length, header["size"])
+        if offset >= end:
+            return b""
+
+        # Pages covering the range, found from the byte counts in the tree
+        refs, pos = self._find_pages(header, 3, offset, end)
+        pages = self._load_pages(header, refs)
+
+        # Then the entries covering the range within those pages
+        entries = []
+        for entry in itertools.chain.from_iterable(pages):
+            if pos + entry[1] > offset:
+                if not entries:
+                    skip = offset - pos
+                entries.append(entry)
+            pos += entry[1]
+            if pos >= end:
+                break
+
+        data = b"".join(self._read_chunks(header, entries))
+        return data[skip:skip + end - offset]
+
+    def download_chunk(self, filename: str, index: int) -> bytes:
+        """
+        Download one chunk of a file, fetching only the header, the nodes
+        on the path to the index page that lists the chunk, the page and
+        the chunk itself.  Each node and the page are checked against the
+        digest in their parent (see _load_pages), and the chunk against
+        its entry in the page, so the check takes O(log n) records.
+
+        Params:
+        > filename - str
+        > index - int, position of the chunk in the file
+
+        Returns: the plaintext chunk
+        """
+        _, _, header, _ = self._open(filename)
+
+        if header["index"] is None or not 0 <= index < header["index"][4]:
+            raise util.DropboxError("Chunk not found")
+
+        refs, pos = self._find_pages(header, 4, index, index + 1)
+        page = self._load_pages(header, refs)[0]
+        return next(self._read_chunks(header, [page[index - pos]]))
 
     def append_file(self, filename: str, data: bytes) -> None:
-        # TODO: Implement
-        raise util.DropboxError("Not Implemented")
+        """
+        Append to a file.  Appends from several sessions at once are
+        serialized by retrying the ones whose header changed under them.
+        """
+        def update():
+            meta_addr, kek, header, version = self._open(filename)
+            header = dict(header)
+            chunks, written = {}, []
+
+            try:
+                replaced, _ = self._append_chunks(header, _split(data), chunks, None, written)
+            except util.DropboxError:
+                # A concurrent append may have replaced the last page or node
+                if dataserver.GetVersioned(meta_addr)[1] != version:
+                    raise VersionConflict("VersionConflict")
+                raise
+            try:
+                self._store_header(meta_addr, kek, header, version)
+            except VersionConflict:
+                # The new pages and nodes are not listed anywhere.  Chunks
+                # are content-addressed and may be shared, so they stay.
+                self._delete_many([addr for addr in written if addr not in chunks])
+                raise
+
+            if replaced:
+                self._delete_many(replaced)
+
+        self._retry(update)
 
     def share_file(self, filename: str, recipient: str) -> None:
-        # TODO: Implement
-        raise util.DropboxError("Not Implemented")
+        try:
+            enc_key = keyserver.Get(f"{recipient}/enc")
+        except ValueError:
+            raise util.DropboxError("No such user")
+
+        def update():
+            pointer, version = self._load_pointer_versioned(filename)
+            if pointer is None:
+                raise util.DropboxError("File not found")
+
+            node_addr, node_key = memloc.Make(), crypto.SecureRandom(16)
+            if "kek" not in pointer:
+                # Reshares are not listed in a share table
+                node = {"parent": pointer["node"]}
+                return [node_addr, node_key], {node_addr: self._seal_cached(node_key, node_addr, node)}
+
+            table = pointer.get("shares", {"id": crypto.SecureRandom(16), "last": None, "count": 0})
+            share_addr = self._share_addr(table["id"], recipient)
+            blob, share_version = dataserver.GetVersioned(share_addr)
+            if blob is not None:
+                # Hand out the same record again
+                return self._unseal_cached(self._files_key, share_addr, blob), {}
+
+            # Copy the last page with the new entry, unless it is full
+            entries, prev = [], table["last"]
+            if prev is not None:
+                try:
+                    page = self._unseal_cached(self._files_key, prev, _get(prev))
+                except util.DropboxError:
+                    self._check_version(filename, version)
+                    raise
+                if len(page["entries"]) < SHARE_PAGE_ENTRIES:
+                    entries, prev = list(page["entries"]), page["prev"]
+            records, last = self._seal_shares(entries + [[recipient, node_addr, node_key]], prev)
+
+            node = {"meta": pointer["meta"], "kek": pointer["kek"]}
+            records[node_addr] = self._seal_cached(node_key, node_addr, node)
+            dataserver.SetMany(records)
+            written = [node_addr, last]
+            try:
+                # Only one session may add a given recipient
+                dataserver.SetIfVersion(share_addr, self._seal_cached(
+                    self._files_key, share_addr, [node_addr, node_key]), share_version)
+                written.append(share_addr)
+                table = dict(table, last=last, count=table["count"] + 1)
+                self._store_pointer(filename, dict(pointer, shares=table), version)
+            except VersionConflict:
+                self._delete_many(written)
+                raise
+
+            if entries:
+                # The copied page is no longer listed
+                self._delete_many([pointer["shares"]["last"]])
+            return [node_addr, node_key], {}
+
+        (node_addr, node_key), records = self._retry(update)
+
+        invite_addr = _invite_addr(self.username, recipient, filename)
+        secret = crypto.AsymmetricEncrypt(enc_key, node_addr + node_key)
+        invite = {"secret": secret,
+                  "sig": crypto.SignatureSign(self._sign_key, invite_addr + secret)}
+        records[invite_addr] = util.ObjectToBytes(invite, codec="binary")
+        dataserver.SetMany(records)
 
     def receive_file(self, filename: str, sender: str) -> None:
-        # TODO: Implement
-        raise util.DropboxError("Not Implemented")
+        pointer = self._load_pointer(filename)
+        if pointer is not None:
+            # A file this user lost access to may be received again
+            if self._retry(lambda: self._load_header(pointer, missing_ok=True)) is not None:
+                raise util.DropboxError("File already exists")
+        try:
+            verify_key = keyserver.Get(f"{sender}/sig")
+        except ValueError:
+            raise util.DropboxError("No such user")
+
+        invite_addr = _invite_addr(sender, self.username, filename)
+        try:
+            invite = util.BytesToObject(_get(invite_addr))
+            secret = invite["secret"]
+            if not crypto.SignatureVerify(verify_key, invite_addr + secret, invite["sig"]):
+                raise ValueError("Bad signature")
+            secret = crypto.AsymmetricDecrypt(self._dec_key, secret)
+        except (ValueError, KeyError, TypeError):
+            raise util.DropboxError("Invalid invitation")
+        if len(secret) != 32:
+            raise util.DropboxError("Invalid invitation")
+
+        # Check that the record leads to the file before keeping it
+        pointer = {"node": [secret[:16], secret[16:]]}
+        self._retry(lambda: self._load_header(pointer))
+        self._store_pointer(filename, pointer)
 
     def revoke_file(self, filename: str, old_recipient: str) -> None:
-        # TODO: Implement
-        raise util.DropboxError("Not Implemented")
+        def update():
+            pointer, version = self._load_pointer_versioned(filename)
+            if pointer is None:
+                raise util.DropboxError("File not found")
+            if "kek" not in pointer:
+                raise util.DropboxError("Only the owner can revoke access")
+            if "shares" not in pointer:
+                raise util.DropboxError("File is not shared with that user")
+
+            share_addr = self._share_addr(pointer["shares"]["id"], old_recipient)
+            blob = dataserver.GetVersioned(share_addr)[0]
+            if blob is None:
+                raise util.DropboxError("File is not shared with that user")
+            branch_addr = self._unseal_cached(self._files_key, share_addr, blob)[0]
+
+            self._rotate_keys(filename, pointer, version, drop=old_recipient)
+            self._delete_many([branch_addr, share_addr])
+
+        self._retry(update)
+
+
+def _invite_addr(sender: str, recipient: str, filename: str) -> bytes:
+    """
+    Memloc of the invitation from sender to recipient for a file.
+    """
+    name = util.ObjectToBytes(["invite", sender, recipient, filename], codec="binary")
+    return memloc.MakeFromBytes(crypto.Hash(name)[:16])
+
+
+def _split(data: bytes):
+    """
+    Split data into memoryview pieces of at most CHUNK_SIZE bytes.
+    """
+    view = memoryview(data)
+    for i in range(0, len(data), CHUNK_SIZE):
+        yield view[i:i + CHUNK_SIZE]
+
+
+def _cdc_cut(bits: bytearray, start: int) -> int:
+    """
+    Returns: the end of the chunk that starts at `start` (see _cdc)
+    """
+    i = bits.find(b"\x01" * CDC_BITS, start + CDC_MIN - CDC_BITS, start + CHUNK_SIZE)
+    if i >= 0:
+        return i + CDC_BITS
+    return min(len(bits), start + CHUNK_SIZE)
+
+
+def _cdc(pieces, table: bytes):
+    """
+    Regroup an iterable of bytes-like pieces into content-defined chunks.
+
+    Each byte is mapped to one bit by the keyed table, and the rolling
+    hash of a position is the string of bits of the CDC_BITS bytes
+    ending there.  A chunk ends after the first position whose hash is
+    all ones, once the chunk is at least CDC_MIN bytes long, and never
+    grows beyond CHUNK_SIZE bytes.  Boundaries therefore only depend on
+    nearby content, and inserting or removing bytes only changes the
+    chunks around the edit.  The table lookups and the search for the
+    boundary run in bytes.translate and bytes.find.
+    """
+    buf = bytearray()
+    bits = bytearray()
+    start = 0
+    for piece in pieces:
+        if not isinstance(piece, (bytes, bytearray)):
+            piece = bytes(piece)
+        buf += piece
+        bits += piece.translate(table)
+
+        while len(buf) - start >= CHUNK_SIZE:
+            end = _cdc_cut(bits, start)
+            yield bytes(memoryview(buf)[start:end])
+            start = end
+
+        del buf[:start]
+        del bits[:start]
+        start = 0
+
+    while start < len(buf):
+        end = _cdc_cut(bits, start)
+        yield bytes(memoryview(buf)[start:end])
+        start = end
+
 
 def create_user(username: str, password: str) -> User:
-    info_addr = s_addr(username)
-    dataserver.Set(info_addr, password.encode("utf-8"))
+    if not isinstance(username, str) or not username:
+        raise util.DropboxError("Invalid username")
+
+    try:
+        keyserver.Get(f"{username}/enc")
+    except ValueError:
+        pass
+    else:
+        # Saves generating keys; the claim below is what decides
+        raise util.DropboxError("Username already taken")
+
+    enc_key, dec_key = crypto.AsymmetricKeyGen()
+    verify_key, sign_key = crypto.SignatureKeyGen()
+    files_key = crypto.SecureRandom(16)
+
+    # Claim the name with the keyserver's atomic set-if-absent before
+    # writing anything, so that concurrent registrations cannot overwrite
+    # each other's records
+    try:
+        keyserver.Set(f"{username}/enc", enc_key)
+    except ValueError:
+        raise util.DropboxError("Username already taken")
+
+    salt = crypto.SecureRandom(16)
+    iterations = crypto.PBKDF2_ITERATIONS
+    root_key = crypto.PasswordKDF(password, salt, 16, iterations)
+
+    user_addr = s_addr(f"{username}/user")
+    record = {
+        "dec_key": dec_key.to_bytes("der"),
+        "sign_key": sign_key.to_bytes("der"),
+        "files_key": files_key,
+    }
+    salt_record = {"salt": salt, "iterations": iterations}
+    dataserver.SetMany({
+        s_addr(f"{username}/salt"): util.ObjectToBytes(salt_record, codec="binary"),
+        user_addr: _seal(root_key, user_addr, record),
+    })
 
-    return User() # Probably should do something else here...
+    keyserver.Set(f"{username}/sig", verify_key)
+
+    return User(username, dec_key, sign_key, files_key)
 
 def authenticate_user(username: str, password: str) -> User:
-    info_addr = s_addr(username)
-    password_bytes = dataserver.Get(info_addr)
+    if not isinstance(username, str) or not username:
+        raise util.DropboxError("Invalid username")
 
-    password_check = password_bytes.decode("utf-8")
+    user_addr = s_addr(f"{username}/user")
+    salt_addr = s_addr(f"{username}/salt")
+    found = dataserver.GetMany([salt_addr, user_addr])
+    if found[salt_addr] is None or found[user_addr] is None:
+        raise util.DropboxError("Could not authenticate!")
 
-    if password != password_check:  # Hmmm...
+    try:
+        salt_record = util.BytesToObject(found[salt_addr])
+        root_key = crypto.PasswordKDF(password, salt_record["salt"], 16,
+                                      salt_record.get("iterations", 1000))
+        record = _unseal(root_key, user_addr, found[user_addr])
+    except Exception:
         raise util.DropboxError("Could not authenticate!")
 
-    return User()
+    return User(username,
+                crypto.AsymmetricDecryptKey.from_bytes(record["dec_key"]),
+                crypto.SignatureSignKey.from_bytes(record["sign_key"]),
+                record["files_key"])
+
+
+##
+## Asyncio API
+##
+
+class _PipelinedUser(User):
+    """
+    A User whose chunk and page writes are sent on a thread pool without
+    waiting for each one.  Each operation runs on one thread (see
+    _call) and tracks its own writes, with at most `concurrency` in
+    flight.  An operation waits for its writes before it stores its
+    header, so a header is never visible before the records it lists,
+    and only sees errors from its own writes.
+    """
+    def __init__(self, user: User, executor: concurrent.futures.Executor,
+                 concurrency: int) -> None:
+        super().__init__(user.username, user._dec_key, user._sign_key, user._files_key)
+        self._writes = executor
+        self._concurrency = concurrency
+        self._local = threading.local()
+
+    def _inflight(self) -> collections.deque:
+        """
+        Returns: the writes in flight for the operation on this thread
+        """
+        if getattr(self._local, "writes", None) is None:
+            self._local.writes = collections.deque()
+        return self._local.writes
+
+    def _call(self, func, *args):
+        """
+        Run a User method as one operation.  Writes it leaves in flight
+        (for instance if it failed before storing its header) are waited
+        for, so they are not mistaken for the next operation's.
+        """
+        self._local.writes = collections.deque()
+        try:
+            return func(*args)
+        finally:
+            concurrent.futures.wait(self._local.writes)
+            self._local.writes = None
+
+    def _set_many(self, records: dict) -> None:
+        inflight = self._inflight()
+        while len(inflight) >= self._concurrency:
+            inflight.popleft().result()
+        # The caller reuses its dict
+        inflight.append(self._writes.submit(dataserver.SetMany, dict(records)))
+
+    def _wait_writes(self) -> None:
+        inflight = self._inflight()
+        while inflight:
+            inflight.popleft().result()
+
+
+class AsyncUser:
+    """
+    An asyncio counterpart to User.  Dataserver calls run on a pool of
+    `concurrency` threads, so at most that many are in flight at once,
+    and chunk encryption and decryption run on a separate pool of
+    `workers` threads, so the event loop is never blocked.
+
+    download_file fetches all batches of chunks at once rather than one
+    after the other, so on a dataserver with per-call latency it takes
+    a few round trips whatever the size of the file.  Uploads send chunk
+    batches without waiting for the previous ones.  Other methods run the
+    corresponding User method on the thread pool.
+
+    Call close() (or use `async with`) to stop the thread pools.
+    """
+    def __init__(self, user: User, concurrency: int = 16, workers: int = 1) -> None:
+        """
+        Params:
+            > user        - User to act as
+            > concurrency - int, most dataserver calls in flight at once
+            > workers     - int, threads used for chunk crypto
+        """
+        self.username = user.username
+        self.concurrency = concurrency
+
+        self._io = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self._crypto = concurrent.futures.ThreadPoolExecutor(workers)
+        # Uploads hold an I/O thread while their writes are in flight, so
+        # the writes get their own pool
+        self._writes = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+        self.user = _PipelinedUser(user, self._writes, concurrency)
+        self.user.workers = workers
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._io.shutdown()
+        self._crypto.shutdown()
+        self._writes.shutdown()
+
+    async def _run(self, func, *args):
+        """
+        Run a blocking call that talks to the dataserver on the I/O pool,
+        as one operation of the pipelined user.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._io, self.user._call, func, *args)
+
+    async def _decrypt(self, dk: _DataKeys, entry: list, ciphertext: bytes) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._crypto, _decrypt_chunk, dk, entry, ciphertext)
+
+    async def _read_batch(self, keys: dict, batch: list) -> list:
+        blobs = await self._run(_get_many, [e[0] for e in batch])
+        return await asyncio.gather(*(self._decrypt(keys[e[3]], e, ciphertext)
+                                      for e, ciphertext in zip(batch, blobs)))
+
+    ##
+    ## Public API
+    ##
+
+    @property
+    def upload_stats(self) -> dict:
+        return self.user.upload_stats
+
+    async def upload_file(self, filename: str, data: bytes) -> None:
+        await self._run(self.user.upload_file, filename, data)
+
+    async def download_file(self, filename: str) -> bytes:
+        _, _, header, _ = await self._run(self.user._open, filename)
+        refs, _ = await self._run(self.user._index_refs, header)
+        pages = await self._run(self.user._load_pages, header, refs)
+        entries = list(itertools.chain.from_iterable(pages))
+
+        keys = {epoch: _DataKeys(header["keys"][epoch]) for epoch in {e[3] for e in entries}}
+        batches = await asyncio.gather(*(self._read_batch(keys, entries[i:i + BATCH_CHUNKS])
+                                         for i in range(0, len(entries), BATCH_CHUNKS)))
+        return b"".join(itertools.chain.from_iterable(batches))
+
+    async def download_range(self, filename: str, offset: int, length: int) -> bytes:
+        return await self._run(self.user.download_range, filename, offset, length)
+
+    async def download_chunk(self, filename: str, index: int) -> bytes:
+        return await self._run(self.user.download_chunk, filename, index)
+
+    async def append_file(self, filename: str, data: bytes) -> None:
+        await self._run(self.user.append_file, filename, data)
+
+    async def share_file(self, filename: str, recipient: str) -> None:
+        await self._run(self.user.share_file, filename, recipient)
+
+    async def receive_file(self, filename: str, sender: str) -> None:
+        await self._run(self.user.receive_file, filename, sender)
+
+    async def revoke_file(self, filename: str, old_recipient: str) -> None:
+        await self._run(self.user.revoke_file, filename, old_recipient)
+
+
+async def async_create_user(username: str, password: str, **kwargs) -> AsyncUser:
+    """
+    Like create_user, but returns an AsyncUser.  Keyword arguments are
+    passed to AsyncUser.
+    """
+    loop = asyncio.get_running_loop()
+    return AsyncUser(await loop.run_in_executor(None, create_user, username, password), **kwargs)
+
+async def async_authenticate_user(username: str, password: str, **kwargs) -> AsyncUser:
+    """
+    Like authenticate_user, but returns an AsyncUser.
+    """
+    loop = asyncio.get_running_loop()
+    return AsyncUser(await loop.run_in_executor(None, authenticate_user, username, password), **kwargs)
@@ -17,82 +17,202 @@ from cryptography.hazmat.primitives import padding as sym_padding
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidTag
 
 from support.util import *
 
 import base64
+import collections
+import concurrent.futures
 import os
+import threading
+import time
+
+# Types accepted wherever bytes are expected
+_BYTES_LIKE = (bytes, bytearray, memoryview)
 
 def check_type(arg, corr_type, param_name: str, func_name: str) -> None:
     """
-    A helper function for argument type checking.
+    A helper function for argument type checking.  Where bytes are
+    expected, any contiguous bytes-like object is accepted, so callers can
+    pass bytearrays and memoryview slices without copying them.
     """
+    if corr_type is bytes:
+        corr_type = _BYTES_LIKE
+        if isinstance(arg, memoryview) and not arg.contiguous:
+            corr_type = bytes
     if not isinstance(arg, corr_type):
         print(f"\nParameter \"{param_name}\" to {func_name} must of type {corr_type}!")
         print(f"Instead, it is: {type(arg)}\n")
         raise TypeError
 
+class _InternTable:
+    """
+    A bounded LRU table of loaded keys, keyed by their class and
+    serialized form, so that loading the same bytes again returns the
+    key object that was already loaded.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cls, byte_repr: bytes):
+        with self._lock:
+            key = self._entries.get((cls, byte_repr))
+            if key is not None:
+                self._entries.move_to_end((cls, byte_repr))
+            return key
+
+    def put(self, cls, byte_repr: bytes, key) -> None:
+        with self._lock:
+            self._entries[(cls, byte_repr)] = key
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+# Loaded keys are shared between from_bytes calls on identical bytes
+key_intern_table = _InternTable(maxsize=256)
+
+def _as_bytes(data) -> bytes:
+    """
+    Convert a bytes-like argument for the few library calls that only take
+    bytes.  Only used for short inputs (keys, tags, RSA blocks).
+    """
+    return data if isinstance(data, bytes) else bytes(data)
+
+def _is_pem(byte_repr: bytes) -> bool:
+    return bytes(byte_repr[:10]) == b"-----BEGIN"
+
 class AsmPublicKey:
     """
     A wrapper around a public key. Allows for marshalling to and from bytes.
     Do not call this class construtor directly. Instead use AsymmetricKeyGen or SignatureKeyGen.
+
+    The PEM and DER forms are computed once and cached on the object.
     """
     def __init__(self, libPubKey):
         self.libPubKey = libPubKey
+        self._encoded = {}
 
     def __eq__(self, other):
-        return bytes(self) == bytes(other)
+        return self is other or bytes(self) == bytes(other)
 
     @classmethod
     def from_bytes(cls, byte_repr):
-        pub_key = serialization.load_pem_public_key(byte_repr)
-        return cls(pub_key)
+        """
+        Load a key from its PEM or DER form (see to_bytes).
+        """
+        byte_repr = bytes(byte_repr)
+        key = key_intern_table.get(cls, byte_repr)
+        if key is not None:
+            return key
+
+        if _is_pem(byte_repr):
+            pub_key = serialization.load_pem_public_key(byte_repr)
+        else:
+            pub_key = serialization.load_der_public_key(byte_repr)
+
+        key = cls(pub_key)
+        key_intern_table.put(cls, byte_repr, key)
+        return key
+
+    def to_bytes(self, encoding: str = "pem") -> bytes:
+        """
+        Serialize the key.  "der" is about 30% smaller than "pem".
+
+        Params:
+            > encoding - "pem" or "der"
+        Returns: bytes
+        """
+        encoded = self._encoded.get(encoding)
+        if encoded is None:
+            if encoding == "pem":
+                lib_encoding = serialization.Encoding.PEM
+            elif encoding == "der":
+                lib_encoding = serialization.Encoding.DER
+            else:
+                raise ValueError(f"Unknown key encoding {encoding}")
+            encoded = self.libPubKey.public_bytes(
+                encoding=lib_encoding,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+            self._encoded[encoding] = encoded
+        return encoded
 
     def __str__(self):
-        pem = self.libPubKey.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo,
-        )
-        return pem.decode('utf-8')
+        return self.to_bytes().decode('utf-8')
 
     def __bytes__(self):
-        pem = self.libPubKey.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo,
-        )
-        return pem
+        return self.to_bytes()
 
 class AsmPrivateKey:
     """
     A wrapper around a private key.
     Do not call this class construtor directly. Instead use AsymmetricKeyGen or SignatureKeyGen.
+
+    The PEM and DER forms are computed once and cached on the object.
     """
     def __init__(self, libPrivKey):
         self.libPrivKey = libPrivKey
+        self._encoded = {}
 
     def __eq__(self, other):
-        return bytes(self) == bytes(other)
+        return self is other or bytes(self) == bytes(other)
 
     @classmethod
     def from_bytes(cls, byte_repr):
-        private_key = serialization.load_pem_private_key(byte_repr, password=None)
-        return cls(private_key)
+        """
+        Load a key from its PEM or DER form (see to_bytes).
+        """
+        byte_repr = bytes(byte_repr)
+        key = key_intern_table.get(cls, byte_repr)
+        if key is not None:
+            return key
+
+        if _is_pem(byte_repr):
+            private_key = serialization.load_pem_private_key(byte_repr, password=None)
+        else:
+            private_key = serialization.load_der_private_key(byte_repr, password=None)
+
+        key = cls(private_key)
+        key_intern_table.put(cls, byte_repr, key)
+        return key
+
+    def to_bytes(self, encoding: str = "pem") -> bytes:
+        """
+        Serialize the key.  "der" is about 30% smaller than "pem".
+
+        Params:
+            > encoding - "pem" or "der"
+        Returns: bytes
+        """
+        encoded = self._encoded.get(encoding)
+        if encoded is None:
+            if encoding == "pem":
+                lib_encoding = serialization.Encoding.PEM
+            elif encoding == "der":
+                lib_encoding = serialization.Encoding.DER
+            else:
+                raise ValueError(f"Unknown key encoding {encoding}")
+            encoded = self.libPrivKey.private_bytes(
+                encoding=lib_encoding,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            self._encoded[encoding] = encoded
+        return encoded
 
     def __str__(self):
-        pem = self.libPrivKey.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        return pem.decode('utf-8')
+        return self.to_bytes().decode('utf-8')
 
     def __bytes__(self):
-        pem = self.libPrivKey.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        return pem
+        return self.to_bytes()
 
 """
 These classes are wrappers around AsmPublicKey and AsmPrivateKey that
@@ -112,6 +232,166 @@ class SignatureVerifyKey(AsmPublicKey):
 class SignatureSignKey(AsmPrivateKey):
     pass
 
+def _generate_rsa_der(_=None) -> bytes:
+    """
+    Generate an RSA private key as DER, so that it can be sent back from a
+    worker process.
+    """
+    private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+    return private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+class RSAKeyPool:
+    """
+    A pool of pre-generated RSA private keys, refilled in the background
+    whenever it drops to a low-water mark.  Use EnableKeyPool to have
+    AsymmetricKeyGen and SignatureKeyGen take keys from a pool.
+
+    If the pool is empty when a key is needed, the key is generated
+    synchronously and the pool counts the request as starved.
+    """
+    def __init__(self, size: int = 8, low_water: int = 2, processes: int = 0):
+        """
+        Params:
+            > size      - int, number of keys to hold when full
+            > low_water - int, refill when this many keys or fewer remain
+            > processes - int, generate keys in this many worker processes
+                          (0 generates them in a background thread)
+        """
+        self.size = size
+        self.low_water = low_water
+        self.processes = processes
+        self._keys = collections.deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._executor = None
+        self._thread = None
+        self.hits = 0
+        self.starved = 0
+        self.generated = 0
+
+    def start(self) -> None:
+        """
+        Start filling the pool in the background.
+        """
+        if self.processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+        self._thread = threading.Thread(target=self._fill, name="RSAKeyPool", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background filler and drop the pooled keys.
+        """
+        with self._cond:
+            self._stopping = True
+            self._keys.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _add(self, private_key) -> None:
+        with self._cond:
+            if not self._stopping:
+                self._keys.append(private_key)
+                self.generated += 1
+                self._cond.notify_all()
+
+    def _fill(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping and len(self._keys) > self.low_water:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                need = self.size - len(self._keys)
+
+            if self._executor is not None:
+                for der in self._executor.map(_generate_rsa_der, range(need)):
+                    self._add(serialization.load_der_private_key(der, password=None))
+            else:
+                for _ in range(need):
+                    if self._stopping:
+                        return
+                    self._add(rsa.generate_private_key(public_exponent=65537,key_size=2048))
+
+    def wait_until_full(self, timeout: float = None) -> bool:
+        """
+        Block until the pool holds size keys.
+
+        Returns: True if the pool is full, False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._keys) >= self.size, timeout)
+
+    def take(self):
+        """
+        Returns: an RSA private key, from the pool if one is available
+        """
+        with self._cond:
+            if self._keys:
+                private_key = self._keys.popleft()
+                self.hits += 1
+            else:
+                private_key = None
+                self.starved += 1
+            if len(self._keys) <= self.low_water:
+                self._cond.notify_all()
+
+        if private_key is None:
+            private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+        return private_key
+
+    def stats(self) -> dict:
+        """
+        Returns: dict of available, hits, starved and generated
+        """
+        with self._cond:
+            return {
+                "available": len(self._keys),
+                "hits": self.hits,
+                "starved": self.starved,
+                "generated": self.generated,
+            }
+
+# The active key pool, or None when keys are generated on demand (the default)
+key_pool = None
+
+def EnableKeyPool(size: int = 8, low_water: int = 2, processes: int = 0) -> RSAKeyPool:
+    """
+    Start a background pool of RSA keys for AsymmetricKeyGen and
+    SignatureKeyGen.  Any existing pool is stopped first.
+
+    Params: see RSAKeyPool
+
+    Returns: the new RSAKeyPool
+    """
+    global key_pool
+    DisableKeyPool()
+    key_pool = RSAKeyPool(size=size, low_water=low_water, processes=processes)
+    key_pool.start()
+    return key_pool
+
+def DisableKeyPool() -> None:
+    """
+    Stop the key pool, if any, and go back to generating keys on demand.
+    """
+    global key_pool
+    if key_pool is not None:
+        key_pool.stop()
+    key_pool = None
+
+def _new_rsa_key():
+    pool = key_pool
+    if pool is not None:
+        return pool.take()
+    return rsa.generate_private_key(public_exponent=65537,key_size=2048)
+
 def AsymmetricKeyGen() -> tuple[AsymmetricEncryptKey, AsymmetricDecryptKey]:
     """
      Generates a public-key pair for asymmetric encryption purposes.
@@ -119,7 +399,7 @@ def AsymmetricKeyGen() -> tuple[AsymmetricEncryptKey, AsymmetricDecryptKey]:
      Params: None
      Returns: (Public) Asymmetric Encryption Key, (Private) Asymmetric Decryption Key
     """
-    private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+    private_key = _new_rsa_key()
     public_key = private_key.public_key()
 
     return AsymmetricEncryptKey(public_key), AsymmetricDecryptKey(private_key)
@@ -135,7 +415,7 @@ def AsymmetricEncrypt(EncryptionKey: AsymmetricEncryptKey, plaintext: bytes) ->
     check_type(EncryptionKey, AsymmetricEncryptKey, "EncryptionKey", "AsymmetricEncrypt")
     check_type(plaintext, bytes, "plaintext", "AsymmetricEncrypt")
 
-    c_bytes = EncryptionKey.libPubKey.encrypt(plaintext, padding.OAEP(
+    c_bytes = EncryptionKey.libPubKey.encrypt(_as_bytes(plaintext), padding.OAEP(
         mgf=padding.MGF1(algorithm=hashes.SHA512()),
         algorithm=hashes.SHA512(),
         label=None
@@ -154,7 +434,7 @@ def AsymmetricDecrypt(DecryptionKey: AsymmetricDecryptKey, ciphertext: bytes) ->
     check_type(ciphertext, bytes, "ciphertext", "AsymmetricDecrypt")
 
     plaintext = DecryptionKey.libPrivKey.decrypt(
-        ciphertext,
+        _as_bytes(ciphertext),
         padding.OAEP(
             mgf=padding.MGF1(algorithm=hashes.SHA512()),
             algorithm=hashes.SHA512(),
@@ -164,13 +444,81 @@ def AsymmetricDecrypt(DecryptionKey: AsymmetricDecryptKey, ciphertext: bytes) ->
 
     return plaintext
 
+# Length of the HMAC that ends a hybrid ciphertext
+HYBRID_MAC_LEN = 64
+
+def HybridEncryptMulti(EncryptionKeys: list, plaintext: bytes) -> tuple[list[bytes], bytes]:
+    """
+    Encrypt a plaintext of any size once for several recipients.  A fresh
+    symmetric key encrypts and MACs the plaintext, and is wrapped with
+    AsymmetricEncrypt for each public key.
+
+    Params:
+        > EncryptionKeys - list of AsymmetricEncryptKey
+        > plaintext      - bytes
+
+    Returns: (list of wrapped keys, one per public key, shared body).
+             Recipient i decrypts wrapped_keys[i] + body with HybridDecrypt.
+    """
+    check_type(EncryptionKeys, list, "EncryptionKeys", "HybridEncryptMulti")
+    check_type(plaintext, bytes, "plaintext", "HybridEncryptMulti")
+
+    data_key = SecureRandom(16)
+    wrapped_keys = [AsymmetricEncrypt(key, data_key) for key in EncryptionKeys]
+
+    body = SymmetricEncrypt(HashKDF(data_key, "hybrid-enc"), SecureRandom(16), plaintext)
+    body += HMAC(HashKDF(data_key, "hybrid-mac"), body)
+    return wrapped_keys, body
+
+def HybridEncrypt(EncryptionKey: AsymmetricEncryptKey, plaintext: bytes) -> bytes:
+    """
+    Encrypt a plaintext of any size with a public key, using a single
+    RSA operation (see HybridEncryptMulti).
+
+    Params:
+        > EncryptionKey - AsymmetricEncryptKey
+        > plaintext     - bytes
+
+    Returns: ciphertext bytes
+    """
+    check_type(EncryptionKey, AsymmetricEncryptKey, "EncryptionKey", "HybridEncrypt")
+
+    wrapped_keys, body = HybridEncryptMulti([EncryptionKey], plaintext)
+    return wrapped_keys[0] + body
+
+def HybridDecrypt(DecryptionKey: AsymmetricDecryptKey, ciphertext: bytes) -> bytes:
+    """
+    Decrypt a ciphertext made by HybridEncrypt, or a wrapped key followed
+    by the body made by HybridEncryptMulti.
+
+    Params:
+        > DecryptionKey - AsymmetricDecryptKey
+        > ciphertext    - bytes
+
+    Returns: plaintext bytes, or raises ValueError if the ciphertext was
+             not made for this key or was modified
+    """
+    check_type(DecryptionKey, AsymmetricDecryptKey, "DecryptionKey", "HybridDecrypt")
+    check_type(ciphertext, bytes, "ciphertext", "HybridDecrypt")
+
+    split = DecryptionKey.libPrivKey.key_size // 8
+    if len(ciphertext) < split + HYBRID_MAC_LEN:
+        raise ValueError("Ciphertext too short")
+
+    data_key = AsymmetricDecrypt(DecryptionKey, ciphertext[:split])
+    body, tag = ciphertext[split:-HYBRID_MAC_LEN], ciphertext[-HYBRID_MAC_LEN:]
+    if not HMACEqual(HMAC(HashKDF(data_key, "hybrid-mac"), body), tag):
+        raise ValueError("Integrity check failed")
+
+    return SymmetricDecrypt(HashKDF(data_key, "hybrid-enc"), body)
+
 def SignatureKeyGen() -> tuple[SignatureVerifyKey, SignatureSignKey]:
     """
     Generates a public-key pair for digital signature purposes.
     Params: None
     Returns: (Public) Verifying Key, (Private) Signing Key
     """
-    private_key = rsa.generate_private_key(public_exponent=65537,key_size=2048)
+    private_key = _new_rsa_key()
     public_key = private_key.public_key()
 
     return SignatureVerifyKey(public_key), SignatureSignKey(private_key)
@@ -212,7 +560,7 @@ def SignatureVerify(VerifyKey: SignatureVerifyKey, data: bytes, signature: bytes
 
     try:
         VerifyKey.libPubKey.verify(
-            signature,
+            _as_bytes(signature),
             data,
             padding.PSS(
                 mgf=padding.MGF1(hashes.SHA512()),
@@ -261,6 +609,69 @@ def HMAC(key: bytes, data: bytes) -> bytes:
     h.update(data)
     return h.finalize()
 
+class HashContext:
+    """
+    Computes Hash incrementally: feed the data in pieces with update(),
+    then call finalize() for the same digest Hash would return for the
+    concatenated pieces.  Pieces may be any bytes-like object, including
+    memoryview slices, and are not copied.
+    """
+    def __init__(self, _ctx=None):
+        self._ctx = _ctx if _ctx is not None else hashes.Hash(hashes.SHA512())
+
+    def update(self, data) -> None:
+        """
+        Params:
+            > data - bytes, bytearray or memoryview
+        """
+        check_type(data, bytes, "data", "HashContext.update")
+        self._ctx.update(data)
+
+    def copy(self) -> "HashContext":
+        """
+        Returns: an independent context with the same state, e.g. to hash a
+        common prefix once and then several different suffixes
+        """
+        return HashContext(self._ctx.copy())
+
+    def finalize(self) -> bytes:
+        """
+        Returns: the SHA512 hash of the data (bytes).  The context cannot
+        be used afterwards.
+        """
+        return self._ctx.finalize()
+
+class HMACContext:
+    """
+    Computes HMAC incrementally, like HashContext does for Hash.
+    """
+    def __init__(self, key: bytes, _ctx=None):
+        if _ctx is None:
+            check_type(key, bytes, "key", "HMACContext")
+            _ctx = hmac.HMAC(key, hashes.SHA512())
+        self._ctx = _ctx
+
+    def update(self, data) -> None:
+        """
+        Params:
+            > data - bytes, bytearray or memoryview
+        """
+        check_type(data, bytes, "data", "HMACContext.update")
+        self._ctx.update(data)
+
+    def copy(self) -> "HMACContext":
+        """
+        Returns: an independent context with the same key and state
+        """
+        return HMACContext(None, self._ctx.copy())
+
+    def finalize(self) -> bytes:
+        """
+        Returns: the SHA-512 HMAC of the data (bytes).  The context cannot
+        be used afterwards.
+        """
+        return self._ctx.finalize()
+
 def HMACEqual(hmac1: bytes, hmac2: bytes) -> bool:
     """
     Check if an HMAC is correct in constant time wrt the number of matching bytes.
@@ -275,7 +686,117 @@ def HMACEqual(hmac1: bytes, hmac2: bytes) -> bool:
     check_type(hmac1, bytes, "hmac1", "HMACEqual")
     check_type(hmac2, bytes, "hmac2", "HMACEqual")
 
-    return constant_time.bytes_eq(hmac1, hmac2)
+    return constant_time.bytes_eq(_as_bytes(hmac1), _as_bytes(hmac2))
+
+class KDFCache:
+    """
+    A process-local, bounded LRU cache of derived keys with a time-to-live.
+
+    Entries are keyed by an HMAC (under a random per-process secret) of
+    the KDF inputs, so neither passwords nor source keys are kept as
+    cache keys.  Use EnableKDFCache to turn caching on for HashKDF and
+    PasswordKDF.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        """
+        Params:
+            > maxsize - int, maximum number of cached keys
+            > ttl     - float, seconds before a cached key expires
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._secret = os.urandom(32)
+        self._entries = collections.OrderedDict()  # type: dict[bytes, tuple[float, bytes]]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def digest(self, *parts) -> bytes:
+        """
+        Compute the cache key for a sequence of KDF inputs.
+        """
+        h = hmac.HMAC(self._secret, hashes.SHA256())
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            elif isinstance(part, int):
+                part = str(part).encode()
+            h.update(len(part).to_bytes(8, "big"))
+            h.update(part)
+        return h.finalize()
+
+    def get(self, digest: bytes):
+        """
+        Returns: the cached key for digest, or None
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None:
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, digest: bytes, key: bytes) -> None:
+        with self._lock:
+            self._entries[digest] = (time.monotonic() + self.ttl, key)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Drop every cached key.  Statistics are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns: dict of hits, misses, evictions, size and hit_rate
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+# The active cache, or None when caching is off (the default)
+kdf_cache = None
+
+def EnableKDFCache(maxsize: int = 1024, ttl: float = 300.0) -> KDFCache:
+    """
+    Turn on caching of HashKDF and PasswordKDF results for this process.
+    Any existing cache is replaced.
+
+    Params:
+        > maxsize - int, maximum number of cached keys
+        > ttl     - float, seconds before a cached key expires
+
+    Returns: the new KDFCache
+    """
+    global kdf_cache
+    kdf_cache = KDFCache(maxsize=maxsize, ttl=ttl)
+    return kdf_cache
+
+def DisableKDFCache() -> None:
+    """
+    Turn off caching of derived keys and drop the cached keys.
+    """
+    global kdf_cache
+    if kdf_cache is not None:
+        kdf_cache.clear()
+    kdf_cache = None
 
 def HashKDF(key: bytes, purpose: str) -> bytes:
     """
@@ -296,16 +817,31 @@ def HashKDF(key: bytes, purpose: str) -> bytes:
     check_type(key, bytes, "key", "HashKDF")
     check_type(purpose, str, "purpose", "HashKDF")
 
+    cache = kdf_cache
+    if cache is not None:
+        digest = cache.digest("HashKDF", key, purpose)
+        cached = cache.get(digest)
+        if cached is not None:
+            return cached
+
     hkdf = HKDF(
         algorithm=hashes.SHA512(),
         length=len(key),
         salt=None,
         info=purpose.encode(),
     )
-    key = hkdf.derive(key)
-    return key
+    derived = hkdf.derive(key)
+
+    if cache is not None:
+        cache.put(digest, derived)
+    return derived
 
-def PasswordKDF(password: str, salt: bytes, keyLen: int) -> bytes:
+# Default PBKDF2 work factor used by PasswordKDF.  Deployments can set it
+# with the DROPBOX_PBKDF2_ITERATIONS environment variable, by assigning
+# to it, or with CalibratePasswordKDF.
+PBKDF2_ITERATIONS = int(os.environ.get("DROPBOX_PBKDF2_ITERATIONS", "1000"))
+
+def PasswordKDF(password: str, salt: bytes, keyLen: int, iterations: int = None) -> bytes:
     """
     Output some bytes that can be used as a symmetric key. The size of the output equals keyLen.
     A password-based key derivation function can be used to deterministically generate a cryptographic key
@@ -318,10 +854,14 @@ def PasswordKDF(password: str, salt: bytes, keyLen: int) -> bytes:
     Avoid using the same constant salt for everyone,
     as that may enable an attacker to create a single lookup table for reversing this function.
 
+    The work factor should be stored alongside the salt, so that keys can
+    be derived again after PBKDF2_ITERATIONS changes.
+
     Params:
         > password - string
         > salt - bytes
         > keyLen - int
+        > iterations - int (default: PBKDF2_ITERATIONS)
 
     Returns: A key of length keyLen (bytes)
     """
@@ -329,21 +869,67 @@ def PasswordKDF(password: str, salt: bytes, keyLen: int) -> bytes:
     check_type(salt, bytes, "salt", "PasswordKDF")
     check_type(keyLen, int, "keyLen", "PasswordKDF")
 
+    if iterations is None:
+        iterations = PBKDF2_ITERATIONS  # NOTE:  The default of 1000 is low for testing.
+                                        # A production version using PBKDF2 would use >= 10000
+                                        # iterations to increase the cost of generating hashes.
+                                        # Since we'll be generating a lot of hashes to create
+                                        # users in each test, we use a lower value now
+                                        # and could increase it when the client is ready
+                                        # for deployment to real users.
+    check_type(iterations, int, "iterations", "PasswordKDF")
+    if iterations < 1:
+        raise ValueError
+
+    cache = kdf_cache
+    if cache is not None:
+        digest = cache.digest("PasswordKDF", password, salt, keyLen, iterations)
+        cached = cache.get(digest)
+        if cached is not None:
+            return cached
+
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=keyLen,
-        salt=salt,
-        iterations=1000,  # NOTE:  We have decreased this value for testing.
-                          # A production version using PBKDF2 would use >= 10000
-                          # iterations to increase the cost of generating hashes.
-                          # Since we'll be generating a lot of hashes to create
-                          # users in each test, we use a lower value now
-                          # and could increase it when the client is ready
-                          # for deployment to real users.
+        salt=_as_bytes(salt),
+        iterations=iterations,
     )
     key = kdf.derive(password.encode())
+
+    if cache is not None:
+        cache.put(digest, key)
     return key
 
+def CalibratePasswordKDF(target_seconds: float = 0.1, keyLen: int = 16,
+                         minimum: int = 1000) -> int:
+    """
+    Measure this host and return the PBKDF2 iteration count that makes one
+    PasswordKDF call take about target_seconds.  The result can be assigned
+    to PBKDF2_ITERATIONS.
+
+    Params:
+        > target_seconds - float
+        > keyLen - int
+        > minimum - int, the smallest count to return
+
+    Returns: iteration count (int)
+    """
+    salt = os.urandom(16)
+    probe = 1000
+    while True:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=keyLen, salt=salt,
+                         iterations=probe)
+        start = time.perf_counter()
+        kdf.derive(b"calibration")
+        elapsed = time.perf_counter() - start
+
+        # Probe until the measurement is long enough to be reliable
+        if elapsed >= min(0.02, target_seconds / 4):
+            break
+        probe *= 4
+
+    return max(minimum, int(probe * target_seconds / elapsed))
+
 def SymmetricEncrypt(key: bytes, iv: bytes, plaintext: bytes) -> bytes:
     """
     Encrypt the plaintext using AES-CBC mode with the provided key and IV.
@@ -390,8 +976,10 @@ def SymmetricDecrypt(key: bytes, ciphertext: bytes) -> bytes:
     check_type(key, bytes, "key", "symmetricDecrypt")
     check_type(ciphertext, bytes, "ciphertext", "symmetricDecrypt")
 
-    iv = ciphertext[-16:]
-    ciphertext = ciphertext[:-16]
+    # Slice a view rather than the ciphertext itself, to avoid copying it
+    view = memoryview(ciphertext)
+    iv = view[-16:]
+    ciphertext = view[:-16]
 
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
     decryptor = cipher.decryptor()
@@ -406,6 +994,90 @@ def SymmetricDecrypt(key: bytes, ciphertext: bytes) -> bytes:
 
     return plaintext
 
+# AEAD used by AuthenticatedEncrypt: AES-GCM where the OpenSSL build
+# supports it, ChaCha20-Poly1305 otherwise
+AEAD_ALGORITHM = ("AES-GCM" if default_backend().aead_cipher_supported(AESGCM(bytes(16)))
+                  else "ChaCha20-Poly1305")
+
+# Lengths of the nonce and of the tag in an authenticated ciphertext
+AEAD_NONCE_LEN = 12
+AEAD_TAG_LEN = 16
+
+def _chacha(key: bytes) -> ChaCha20Poly1305:
+    if len(key) != 32:
+        key = HKDF(algorithm=hashes.SHA512(), length=32, salt=None,
+                   info=b"ChaCha20-Poly1305").derive(key)
+    return ChaCha20Poly1305(_as_bytes(key))
+
+def AuthenticatedEncrypt(key: bytes, nonce: bytes, plaintext: bytes,
+                         associated_data: bytes = b"") -> bytes:
+    """
+    Encrypt and authenticate the plaintext in one pass with an AEAD
+    (see AEAD_ALGORITHM), also authenticating the associated data, which
+    is not encrypted or included in the output.  A nonce must never be
+    reused with the same key for a different plaintext.
+    The ciphertext at the end will include the tag and then the nonce.
+
+    Params:
+        > key             - bytes (128 or 256 bits)
+        > nonce           - bytes (96 bits)
+        > plaintext       - bytes
+        > associated_data - bytes
+
+    Returns: ciphertext + tag (16 bytes) + nonce (12 bytes)
+    """
+    check_type(key, bytes, "key", "AuthenticatedEncrypt")
+    check_type(nonce, bytes, "nonce", "AuthenticatedEncrypt")
+    check_type(plaintext, bytes, "plaintext", "AuthenticatedEncrypt")
+    check_type(associated_data, bytes, "associated_data", "AuthenticatedEncrypt")
+
+    if len(key) not in (16, 32) or len(nonce) != AEAD_NONCE_LEN:
+        raise ValueError
+
+    if AEAD_ALGORITHM == "AES-GCM":
+        # The streaming cipher API takes any buffer without copying it
+        encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+        encryptor.authenticate_additional_data(associated_data)
+        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        return b"".join((ciphertext, encryptor.tag, nonce))
+
+    return _chacha(key).encrypt(_as_bytes(nonce), _as_bytes(plaintext),
+                              _as_bytes(associated_data)) + nonce
+
+def AuthenticatedDecrypt(key: bytes, ciphertext: bytes, associated_data: bytes = b"") -> bytes:
+    """
+    Check and decrypt a ciphertext made by AuthenticatedEncrypt with the
+    same key and associated data.
+
+    Params:
+        > key             - bytes
+        > ciphertext      - bytes
+        > associated_data - bytes
+
+    Returns: plaintext bytes, or raises ValueError if the ciphertext or
+             associated data were modified or the key is wrong
+    """
+    check_type(key, bytes, "key", "AuthenticatedDecrypt")
+    check_type(ciphertext, bytes, "ciphertext", "AuthenticatedDecrypt")
+    check_type(associated_data, bytes, "associated_data", "AuthenticatedDecrypt")
+
+    if len(key) not in (16, 32) or len(ciphertext) < AEAD_NONCE_LEN + AEAD_TAG_LEN:
+        raise ValueError("Ciphertext too short")
+
+    view = memoryview(ciphertext)
+    nonce = view[-AEAD_NONCE_LEN:]
+    try:
+        if AEAD_ALGORITHM == "AES-GCM":
+            tag = view[-AEAD_NONCE_LEN - AEAD_TAG_LEN:-AEAD_NONCE_LEN]
+            decryptor = Cipher(algorithms.AES(key), modes.GCM(nonce, _as_bytes(tag))).decryptor()
+            decryptor.authenticate_additional_data(associated_data)
+            return decryptor.update(view[:-AEAD_NONCE_LEN - AEAD_TAG_LEN]) + decryptor.finalize()
+
+        return _chacha(key).decrypt(_as_bytes(nonce), _as_bytes(view[:-AEAD_NONCE_LEN]),
+                                  _as_bytes(associated_data))
+    except InvalidTag:
+        raise ValueError("Integrity check failed")
+
 def SecureRandom(num_bytes: int) -> bytes:
     """
     Given a length, return that many randomly generated bytes. Can be used for an IV or symmetric key.
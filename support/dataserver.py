@@ -10,6 +10,12 @@
 
 
 
+import contextlib
+import itertools
+import mmap
+import os
+import struct
+import threading
 import uuid
 
 class Memloc:
@@ -34,13 +40,323 @@ class Memloc:
         """
         return uuid.UUID(bytes=bytes16).bytes
 
-class Dataserver:
+class Backend:
     """
-    Dataserver implementation.
+    Storage interface used by Dataserver.  Memlocs and values are
+    validated by the Dataserver before they reach the backend.  Values
+    may be any contiguous bytes-like object; a backend must not keep a
+    reference to a buffer the caller could modify afterwards.
+
+    A backend may be called from several threads at once for different
+    memlocs (see Dataserver), and must keep its own state consistent.
+    """
+    def get(self, memloc: bytes):
+        """
+        Returns: the val stored at memloc, or None
+        """
+        raise NotImplementedError
+
+    def set_many(self, mapping: dict) -> None:
+        """
+        Stores every memloc -> val pair in mapping.
+        """
+        raise NotImplementedError
+
+    def delete(self, memloc: bytes) -> bool:
+        """
+        Returns: True if a val was deleted, False if there was none
+        """
+        raise NotImplementedError
+
+    def keys(self, prefix: bytes = b"") -> list:
+        """
+        Returns: list of the memlocs holding a val that start with prefix
+        """
+        raise NotImplementedError
+
+    def as_dict(self) -> dict:
+        """
+        Returns: the backend contents as a dict
+        """
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+class DictBackend(Backend):
+    """
+    In-process storage in a plain dict.  Contents are lost at exit.
+    Each method is a single dict operation, so no locking is needed.
     """
     def __init__(self):
         self.data = {}  # type: dict[bytes, bytes]
 
+    def get(self, memloc: bytes):
+        return self.data.get(memloc)
+
+    def set_many(self, mapping: dict) -> None:
+        # Keep bytes as they are, and snapshot other buffers
+        self.data.update((m, val if type(val) is bytes else bytes(val))
+                         for m, val in mapping.items())
+
+    def delete(self, memloc: bytes) -> bool:
+        return self.data.pop(memloc, None) is not None
+
+    def keys(self, prefix: bytes = b"") -> list:
+        # Copy the keys first, since other threads may be writing
+        return [m for m in list(self.data) if m.startswith(prefix)]
+
+    def as_dict(self) -> dict:
+        return self.data
+
+    def clear(self) -> None:
+        self.data = {}
+
+class LogBackend(Backend):
+    """
+    Persistent storage in an append-only log file.
+
+    Every Set or Delete appends a record to the log:
+
+        op (1 byte) | memloc (16 bytes) | val length (8 bytes) | val
+
+    An in-memory index maps each memloc to the position of its latest
+    val, and is rebuilt by scanning the log when the backend is opened.
+    A partially written record at the end of the log (e.g. after a crash)
+    is discarded.  Values are read through mmap, and get() returns a
+    memoryview into the mapping rather than a copy.
+
+    Deleted and overwritten values stay in the log until compact() is
+    called.  Reads and writes are serialized by a lock, so that a read
+    never uses offsets from a log that compact() has since replaced.
+    """
+    _RECORD = struct.Struct("<B16sQ")
+    _SET = 1
+    _DELETE = 2
+
+    def __init__(self, path: str, sync: bool = False):
+        """
+        Params:
+            > path - str, log file to open or create
+            > sync - bool, fsync the log after every write
+        """
+        self.path = path
+        self.sync = sync
+        self._lock = threading.RLock()
+        self._open()
+
+    def _open(self) -> None:
+        self._file = open(self.path, "a+b", buffering=0)
+        self._map = None
+        self._index = {}  # type: dict[bytes, tuple[int, int]]
+        self._size = self._recover()
+
+    def _remap(self) -> None:
+        """
+        Map the whole log.  Earlier mappings are not closed, since views
+        handed out by get() may still refer to them; they are released
+        once those views are gone.
+        """
+        if self._size > 0:
+            self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+
+    def _recover(self) -> int:
+        """
+        Rebuild the index from the log.
+
+        Returns: length of the valid part of the log
+        """
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._remap()
+
+        pos = 0
+        while pos + self._RECORD.size <= self._size:
+            op, memloc, length = self._RECORD.unpack_from(self._map, pos)
+            start = pos + self._RECORD.size
+            if op not in (self._SET, self._DELETE) or start + length > self._size:
+                break
+            if op == self._SET:
+                self._index[memloc] = (start, length)
+            else:
+                self._index.pop(memloc, None)
+            pos = start + length
+
+        if pos != self._size:
+            self._file.truncate(pos)
+            self._map = None  # remap on the next read
+        return pos
+
+    def _append(self, records: list) -> None:
+        """
+        Write (op, memloc, val) records to the end of the log in one call.
+        """
+        with self._lock:
+            self._append_locked(records)
+
+    def _append_locked(self, records: list) -> None:
+        buf = bytearray()
+        positions = []
+        for op, memloc, val in records:
+            buf += self._RECORD.pack(op, memloc, len(val))
+            positions.append((memloc, self._size + len(buf), len(val)))
+            buf += val
+
+        self._file.write(buf)
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self._size += len(buf)
+
+        for (op, _, _), (memloc, start, length) in zip(records, positions):
+            if op == self._SET:
+                self._index[memloc] = (start, length)
+            else:
+                self._index.pop(memloc, None)
+
+    def _view(self, start: int, length: int) -> memoryview:
+        """
+        View part of the log.  The caller must hold the lock, since
+        compact() and clear() replace the log that offsets refer to.
+        """
+        if length == 0:
+            return memoryview(b"")
+        if self._map is None or len(self._map) < start + length:
+            self._remap()
+        return memoryview(self._map)[start:start + length]
+
+    def get(self, memloc: bytes):
+        with self._lock:
+            loc = self._index.get(memloc)
+            if loc is None:
+                return None
+            return self._view(*loc)
+
+    def set_many(self, mapping: dict) -> None:
+        self._append([(self._SET, m, val) for m, val in mapping.items()])
+
+    def delete(self, memloc: bytes) -> bool:
+        with self._lock:
+            if memloc not in self._index:
+                return False
+            self._append_locked([(self._DELETE, memloc, b"")])
+            return True
+
+    def keys(self, prefix: bytes = b"") -> list:
+        with self._lock:
+            return [m for m in self._index if m.startswith(prefix)]
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {m: bytes(self._view(*loc)) for m, loc in self._index.items()}
+
+    def compact(self) -> None:
+        """
+        Rewrite the log so that it only holds live values.
+        """
+        with self._lock:
+            self._compact_locked()
+
+    def _compact_locked(self) -> None:
+        tmp_path = self.path + ".compact"
+        with open(tmp_path, "wb") as f:
+            for m, loc in self._index.items():
+                f.write(self._RECORD.pack(self._SET, m, loc[1]))
+                f.write(self._view(*loc))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Replacing the file leaves existing mappings of the old log valid
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._open()
+
+    def clear(self) -> None:
+        # Unlink rather than truncate, so existing views stay readable
+        with self._lock:
+            self._file.close()
+            os.unlink(self.path)
+            self._open()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class VersionConflict(ValueError):
+    """
+    Raised by Dataserver.SetIfVersion when the memloc is not at the
+    expected version.
+    """
+
+class _StripedLock:
+    """
+    A fixed set of locks, each guarding the memlocs whose first byte
+    falls in one range of prefixes.  Operations on memlocs in different
+    stripes do not wait for each other.
+    """
+    def __init__(self, stripes: int):
+        if not 1 <= stripes <= 256:
+            raise ValueError("Stripes must be between 1 and 256")
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripe(self, memloc: bytes) -> int:
+        return memloc[0] * len(self.locks) >> 8
+
+    def lock(self, memloc: bytes) -> threading.Lock:
+        return self.locks[self.stripe(memloc)]
+
+    @contextlib.contextmanager
+    def hold(self, memlocs=None):
+        """
+        Hold the locks of every stripe the memlocs fall in, or of all
+        stripes if memlocs is None.  Locks are taken in stripe order, so
+        callers holding several never deadlock.
+        """
+        if memlocs is None:
+            locks = self.locks
+        else:
+            locks = [self.locks[i] for i in sorted({self.stripe(m) for m in memlocs})]
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
+class Dataserver:
+    """
+    Dataserver implementation.
+
+    The Dataserver is safe to use from several threads.  Each memloc is
+    guarded by one of `stripes` locks, picked by its first byte, so calls
+    on different memlocs rarely wait for each other.  Batched calls hold
+    the locks of all their memlocs, and so are atomic with respect to
+    other calls: a GetMany never sees half of a SetMany.  Clear and
+    GetMap hold every lock.
+
+    Every stored value also has a version, which changes whenever the
+    memloc is written or deleted.  GetVersioned and SetIfVersion let
+    clients update a value with optimistic concurrency: read it with its
+    version, compute the new value, and write it only if nobody else
+    wrote in between, retrying otherwise.  Versions come from one counter
+    and are never reused.  They are kept in memory, so values already in
+    a backend when it is opened are at version 1.
+    """
+    def __init__(self, backend: Backend = None, stripes: int = 16):
+        """
+        Params:
+            > backend - Backend to store values in (default: DictBackend)
+            > stripes - int, number of locks (1-256), or 0 for no locking
+                        when the Dataserver is only used by one thread
+        """
+        self.backend = backend if backend is not None else DictBackend()
+        self._stripes = _StripedLock(stripes) if stripes else None
+
+        self._versions = {}  # type: dict[bytes, int]
+        self._clock = itertools.count(2)
+
+    def _lock(self, memloc: bytes):
+        return self._stripes.lock(memloc) if self._stripes else contextlib.nullcontext()
+
+    def _hold(self, memlocs=None):
+        return self._stripes.hold(memlocs) if self._stripes else contextlib.nullcontext()
+
     def _validate(self, memloc: bytes) -> None:
         """
         Validates the format of a memloc. Not to be used externally.
@@ -49,28 +365,39 @@ class Dataserver:
             print("ERROR: Memloc must be a bytes() object of size 16 bytes")
             raise Exception("InvalidMemloc")
 
+    def _validate_val(self, val) -> None:
+        """
+        Validates that a val is a contiguous bytes-like object (bytes,
+        bytearray or memoryview). Not to be used externally.
+        """
+        if not isinstance(val, (bytes, bytearray, memoryview)) or (
+                isinstance(val, memoryview) and not val.contiguous):
+            print(
+                f"ERROR: Datasever can only store raw bytes! You gave val of type {type(val)}. Please serialize to bytes."
+            )
+            raise ValueError
+
     def Set(self, memloc: bytes, val: bytes) -> None:
         """
         Stores a value at a memory location.
 
         Params:
             > memloc - bytes (16 bytes)
-            > val    - bytes
+            > val    - bytes-like (bytes, bytearray or memoryview)
 
         Returns: None
         """
         self._validate(memloc)
-        if not isinstance(val, bytes):
-            print(
-                f"ERROR: Datasever can only store raw bytes! You gave val of type {type(val)}. Please serialize to bytes."
-            )
-            raise ValueError
+        self._validate_val(val)
 
-        self.data[memloc] = val
+        with self._lock(memloc):
+            self.backend.set_many({memloc: val})
+            self._versions[memloc] = next(self._clock)
 
     def Get(self, memloc: bytes) -> bytes:
         """
-        Retrieves a value from a memory location.
+        Retrieves a value from a memory location.  With a LogBackend, the
+        value is a read-only memoryview instead of a bytes copy.
 
         Params:
             > memloc - bytes (16 bytes)
@@ -78,8 +405,10 @@ class Dataserver:
         Returns: val or raises ValueError
         """
         self._validate(memloc)
-        if memloc in self.data:
-            return self.data[memloc]
+        with self._lock(memloc):
+            val = self.backend.get(memloc)
+        if val is not None:
+            return val
         else:
             raise ValueError("ValDoesNotExist")
 
@@ -93,11 +422,125 @@ class Dataserver:
         Returns: None or raises ValueError
         """
         self._validate(memloc)
-        if memloc in self.data:
-            del self.data[memloc]
-        else:
+        with self._lock(memloc):
+            deleted = self.backend.delete(memloc)
+            self._versions.pop(memloc, None)
+        if not deleted:
             raise ValueError("ValDoesNotExist")
 
+    def _version(self, memloc: bytes, val) -> int:
+        if val is None:
+            return 0
+        return self._versions.get(memloc, 1)
+
+    def GetVersioned(self, memloc: bytes) -> tuple:
+        """
+        Retrieves a value together with its version.
+
+        Params:
+            > memloc - bytes (16 bytes)
+
+        Returns: (val, version); (None, 0) if nothing is stored there
+        """
+        self._validate(memloc)
+        with self._lock(memloc):
+            val = self.backend.get(memloc)
+            return val, self._version(memloc, val)
+
+    def SetIfVersion(self, memloc: bytes, val: bytes, expected_version: int) -> int:
+        """
+        Stores a value only if the memloc is still at the expected
+        version, as returned by GetVersioned.  A version of 0 stores the
+        value only if nothing is stored there.  The check and the write
+        are atomic unless the Dataserver was made with stripes=0.
+
+        Params:
+            > memloc           - bytes (16 bytes)
+            > val              - bytes-like (bytes, bytearray or memoryview)
+            > expected_version - int
+
+        Returns: the new version, or raises VersionConflict
+        """
+        self._validate(memloc)
+        self._validate_val(val)
+
+        with self._lock(memloc):
+            if self._version(memloc, self.backend.get(memloc)) != expected_version:
+                raise VersionConflict("VersionConflict")
+            self.backend.set_many({memloc: val})
+            version = self._versions[memloc] = next(self._clock)
+        return version
+
+    def GetMany(self, memlocs: list) -> dict:
+        """
+        Retrieves the values at several memory locations in one operation.
+        All memlocs are validated before any lookup is performed.
+
+        Params:
+            > memlocs - list of bytes (16 bytes each)
+
+        Returns: dict mapping each memloc to its val, or to None if
+                 nothing is stored there
+        """
+        for m in memlocs:
+            self._validate(m)
+
+        with self._hold(memlocs):
+            return {m: self.backend.get(m) for m in memlocs}
+
+    def SetMany(self, mapping: dict) -> None:
+        """
+        Stores several values in one operation.  All memlocs and vals
+        are validated before anything is stored, so an invalid entry
+        leaves the server unchanged.
+
+        Params:
+            > mapping - dict of memloc (16 bytes) -> val (bytes-like)
+
+        Returns: None
+        """
+        for m, val in mapping.items():
+            self._validate(m)
+            self._validate_val(val)
+
+        with self._hold(mapping):
+            self.backend.set_many(mapping)
+            self._versions.update(dict.fromkeys(mapping, next(self._clock)))
+
+    def DeleteMany(self, memlocs: list) -> dict:
+        """
+        Deletes the values at several memory locations in one operation.
+        All memlocs are validated before anything is deleted.
+
+        Params:
+            > memlocs - list of bytes (16 bytes each)
+
+        Returns: dict mapping each memloc to True if a value was deleted,
+                 or False if nothing was stored there
+        """
+        for m in memlocs:
+            self._validate(m)
+
+        with self._hold(memlocs):
+            for m in memlocs:
+                self._versions.pop(m, None)
+            return {m: self.backend.delete(m) for m in memlocs}
+
+    def ListKeys(self, prefix: bytes = b"") -> list:
+        """
+        Lists the memlocs holding a value that start with prefix, without
+        their values, so that a large server can be walked one prefix at
+        a time.  Memlocs written during the call may or may not be listed.
+
+        Params:
+            > prefix - bytes (at most 16 bytes)
+
+        Returns: list of memlocs
+        """
+        if not isinstance(prefix, bytes) or len(prefix) > 16:
+            raise ValueError("InvalidPrefix")
+        return self.backend.keys(prefix)
+
     ##################################################################
     # NOTE: the following functions are provided for testing ONLY--you
     # can use them to test functionality or attacks, but you should
@@ -106,19 +549,22 @@ class Dataserver:
 
     def GetMap(self) -> dict:
         """
-        Return the entire server contents as a dictionary.  You can
-
+        Return the entire server contents as a dictionary.  With a
+        LogBackend this is a copy of the contents.
 
         Params: None
         Returns: dict
         """
-        return self.data
+        with self._hold():
+            return self.backend.as_dict()
 
     def Clear(self):
         """
         Delete the entire server contents
         """
-        self.data = {}
+        with self._hold():
+            self.backend.clear()
+            self._versions = {}
 
 dataserver = Dataserver()
 memloc = Memloc()
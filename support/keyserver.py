@@ -8,14 +8,22 @@
 ## overwritten.
 ##
 
+import threading
+
 from support.crypto import AsmPublicKey
 
 class Keyserver:
     """
     Keyserver implementation.
+
+    The Keyserver is safe to use from several threads.  Set is an atomic
+    set-if-absent: when several threads register the same identifier,
+    exactly one succeeds.  Get and Delete make a single dict operation,
+    so they never see an identifier vanish between checking and reading.
     """
     def __init__(self):
         self.data = {}
+        self._lock = threading.Lock()
 
     def _validate(self, identifier: str, pk=None) -> None:
         """
@@ -42,10 +50,10 @@ class Keyserver:
         Returns: None
         """
         self._validate(identifier, pk=pk)
-        if identifier in self.data:
-            raise ValueError("IdentifierAlreadyTaken")
-
-        self.data[identifier] = pk
+        with self._lock:
+            if identifier in self.data:
+                raise ValueError("IdentifierAlreadyTaken")
+            self.data[identifier] = pk
 
     def Get(self, identifier: str) -> bytes:
         """
@@ -57,8 +65,9 @@ class Keyserver:
         Returns: public key or raises ValueError
         """
         self._validate(identifier)
-        if identifier in self.data:
-            return self.data[identifier]
+        pk = self.data.get(identifier)
+        if pk is not None:
+            return pk
         else:
             raise ValueError("IdentifierAlreadyTaken")
 
@@ -72,9 +81,7 @@ class Keyserver:
         Returns: None or raises ValueError
         """
         self._validate(identifier)
-        if identifier in self.data:
-            del self.data[identifier]
-        else:
+        if self.data.pop(identifier, None) is None:
             raise ValueError("IdentifierAlreadyTaken")
 
     ##################################################################
@@ -96,7 +103,8 @@ class Keyserver:
         """
         Delete the entire server contents
         """
-        self.data = {}
+        with self._lock:
+            self.data = {}
 
 keyserver = Keyserver()
 
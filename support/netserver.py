@@ -0,0 +1,571 @@
+##
+## netserver.py - Networked dataserver and keyserver
+##
+## This file contains an asyncio server that exposes a Dataserver and a
+## Keyserver over TCP or a Unix socket, and client stubs that can be
+## used in place of the in-process dataserver and keyserver, so several
+## client processes can share one store:
+##
+##   $ python3 -m support.netserver serve --port 7070
+##
+##   >>> ds, ks = netserver.connect(("127.0.0.1", 7070))
+##   >>> client.dataserver, client.keyserver = ds, ks
+##
+## Wire protocol: every request and reply is a frame
+##
+##   length (4 bytes, little-endian) | payload
+##
+## where the payload is a binary-codec object (see util.ObjectToBytes).
+## A request is [op, arg, ...], e.g. ["ds.Get", memloc].  A reply is
+## [True, result] or [False, exception name, [exception args]].  The
+## server answers the requests on a connection in the order they were
+## sent, so a client may send many requests before reading the replies
+## (pipelining).  Public keys travel as [class name, DER form].
+##
+
+import argparse
+import asyncio
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+
+import support.util as util
+
+from support.crypto import AsmPublicKey, AsymmetricEncryptKey, SignatureVerifyKey
+from support.dataserver import Dataserver, LogBackend, VersionConflict
+from support.keyserver import Keyserver
+
+_LENGTH = struct.Struct("<I")
+
+# Largest frame either side accepts, to bound memory use on bad input
+MAX_FRAME = 1 << 30
+
+# Exceptions re-raised by name on the client; anything else is raised
+# as a plain Exception with the same args
+_ERRORS = {cls.__name__: cls for cls in (ValueError, TypeError, KeyError, VersionConflict)}
+
+
+_KEY_TYPES = {cls.__name__: cls for cls in (AsmPublicKey, AsymmetricEncryptKey, SignatureVerifyKey)}
+
+def _key_to_wire(pk: AsmPublicKey) -> list:
+    return [type(pk).__name__, pk.to_bytes("der")]
+
+def _key_from_wire(wire) -> AsmPublicKey:
+    # Anything else is passed through for the Keyserver to reject
+    if isinstance(wire, list) and len(wire) == 2 and wire[0] in _KEY_TYPES:
+        return _KEY_TYPES[wire[0]].from_bytes(wire[1])
+    return wire
+
+def _frame(obj) -> bytes:
+    payload = util.ObjectToBytes(obj, codec="binary")
+    return _LENGTH.pack(len(payload)) + payload
+
+
+##
+## Server
+##
+
+class Service:
+    """
+    Dispatches requests to a Dataserver and a Keyserver.
+    """
+    def __init__(self, dataserver: Dataserver = None, keyserver: Keyserver = None):
+        """
+        Params:
+            > dataserver - Dataserver to serve (default: a new one)
+            > keyserver  - Keyserver to serve (default: a new one)
+        """
+        self.dataserver = dataserver if dataserver is not None else Dataserver()
+        self.keyserver = keyserver if keyserver is not None else Keyserver()
+        self.connections = set()  # transports of open connections
+
+        ds, ks = self.dataserver, self.keyserver
+        self._handlers = {
+            "ds.Set": ds.Set,
+            "ds.Get": ds.Get,
+            "ds.Delete": ds.Delete,
+            "ds.GetVersioned": lambda memloc: list(ds.GetVersioned(memloc)),
+            "ds.SetIfVersion": ds.SetIfVersion,
+            "ds.GetMany": ds.GetMany,
+            "ds.SetMany": ds.SetMany,
+            "ds.DeleteMany": ds.DeleteMany,
+            "ds.ListKeys": ds.ListKeys,
+            "ds.GetMap": ds.GetMap,
+            "ds.Clear": ds.Clear,
+            "ks.Set": lambda identifier, pk: ks.Set(identifier, _key_from_wire(pk)),
+            "ks.Get": lambda identifier: _key_to_wire(ks.Get(identifier)),
+            "ks.Delete": ks.Delete,
+            "ks.GetMap": lambda: {i: _key_to_wire(pk) for i, pk in ks.GetMap().items()},
+            "ks.Clear": ks.Clear,
+        }
+
+    def dispatch(self, payload) -> bytes:
+        """
+        Run one request.
+
+        Params:
+            > payload - bytes-like, an encoded request
+        Returns: the reply frame (bytes)
+        """
+        try:
+            request = util.BytesToObject(payload)
+            if not isinstance(request, list) or not request:
+                raise ValueError("MalformedRequest")
+            handler = self._handlers.get(request[0])
+            if handler is None:
+                raise ValueError(f"UnknownOperation {request[0]}")
+            return _frame([True, handler(*request[1:])])
+        except Exception as e:
+            return _frame([False, type(e).__name__, [str(a) for a in e.args]])
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0, path: str = None):
+        """
+        Start listening on the running event loop.
+
+        Params:
+            > host, port - TCP address to listen on (port 0 picks a free port)
+            > path       - Unix socket path; if given, host and port are ignored
+        Returns: asyncio.Server
+        """
+        loop = asyncio.get_running_loop()
+        if path is not None:
+            return await loop.create_unix_server(lambda: _ServiceProtocol(self), path)
+        return await loop.create_server(lambda: _ServiceProtocol(self), host, port)
+
+class _ServiceProtocol(asyncio.Protocol):
+    """
+    One client connection.  All complete requests in a read are answered
+    with a single write.
+    """
+    def __init__(self, service: Service):
+        self.service = service
+        self.buf = bytearray()
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self.service.connections.add(transport)
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data: bytes) -> None:
+        self.buf += data
+
+        replies = []
+        pos = 0
+        with memoryview(self.buf) as view:
+            while len(view) - pos >= _LENGTH.size:
+                (n,) = _LENGTH.unpack_from(view, pos)
+                if n > MAX_FRAME:
+                    self.transport.close()
+                    return
+                end = pos + _LENGTH.size + n
+                if end > len(view):
+                    break
+                with view[pos + _LENGTH.size:end] as payload:
+                    replies.append(self.service.dispatch(payload))
+                pos = end
+        del self.buf[:pos]
+
+        if replies:
+            self.transport.write(b"".join(replies))
+
+    def connection_lost(self, exc) -> None:
+        self.service.connections.discard(self.transport)
+
+    # Stop reading from a client that does not read its replies
+    def pause_writing(self) -> None:
+        self.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.transport.resume_reading()
+
+class ServiceThread:
+    """
+    Runs a Service on an event loop in a background thread.
+    """
+    def __init__(self, service: Service = None, host: str = "127.0.0.1",
+                 port: int = 0, path: str = None):
+        """
+        Params: see Service.start.  Returns once the server is listening.
+        """
+        self.service = service if service is not None else Service()
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(self.service.start(host, port, path))
+        self.address = path if path is not None else self._server.sockets[0].getsockname()[:2]
+
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the server and close its connections.
+        """
+        async def shutdown():
+            self._server.close()
+            for transport in list(self.service.connections):
+                transport.close()
+            await self._server.wait_closed()
+            await asyncio.sleep(0)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+##
+## Client
+##
+
+class _Connection:
+    """
+    A blocking connection to a Service.
+    """
+    def __init__(self, address, timeout: float = None):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.rfile = self.sock.makefile("rb")
+
+    def roundtrip(self, requests: list) -> list:
+        """
+        Send encoded requests in one write, then read one reply each.
+
+        Returns: list of decoded replies
+        """
+        self.sock.sendall(b"".join(requests))
+
+        replies = []
+        for _ in requests:
+            header = self.rfile.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                raise ConnectionError("Connection closed by server")
+            (n,) = _LENGTH.unpack(header)
+            payload = self.rfile.read(n)
+            if len(payload) < n:
+                raise ConnectionError("Connection closed by server")
+            replies.append(util.BytesToObject(payload))
+        return replies
+
+    def close(self) -> None:
+        self.rfile.close()
+        self.sock.close()
+
+class ServiceClient:
+    """
+    A thread-safe pool of connections to a Service.  Each call checks out
+    a connection, so up to pool_size threads can have requests in flight
+    at once; further callers wait for a free connection.
+    """
+    def __init__(self, address, pool_size: int = 8, timeout: float = None):
+        """
+        Params:
+            > address   - (host, port) for TCP, or a Unix socket path
+            > pool_size - int, most connections open at once
+            > timeout   - float, socket timeout in seconds (default: none)
+        """
+        self.address = address
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def call_many(self, calls: list) -> list:
+        """
+        Run several requests on one connection, pipelined.
+
+        Params:
+            > calls - list of [op, args] pairs
+        Returns: list with the result of each call, or the exception it
+                 raised
+        """
+        requests = [_frame([op, *args]) for op, args in calls]
+
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = _Connection(self.address, self.timeout)
+            try:
+                replies = conn.roundtrip(requests)
+            except BaseException:
+                # The connection may be mid-reply; never reuse it
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+        results = []
+        for reply in replies:
+            if reply[0]:
+                results.append(reply[1])
+            else:
+                results.append(_ERRORS.get(reply[1], Exception)(*reply[2]))
+        return results
+
+    def call(self, op: str, *args):
+        """
+        Run one request.
+
+        Returns: its result, or raises its exception
+        """
+        (result,) = self.call_many([[op, args]])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self) -> None:
+        """
+        Close idle connections.  Connections in use are closed when
+        they are returned.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class _Stub:
+    """
+    Base for the client stubs.  A stub made by pipeline() queues calls
+    instead of running them, and runs them all in one round trip when
+    execute() is called.
+    """
+    def __init__(self, client: ServiceClient, _queued: list = None):
+        self.client = client
+        self._queued = _queued
+
+    def _call(self, op: str, *args, decode=None):
+        if self._queued is not None:
+            self._queued.append((op, args, decode))
+            return None
+        result = self.client.call(op, *args)
+        return decode(result) if decode is not None else result
+
+    def pipeline(self):
+        """
+        Returns: a stub of the same type whose calls are queued until
+                 execute() is called.  Calls on it return None.
+        """
+        return type(self)(self.client, _queued=[])
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        """
+        Run the queued calls of a pipeline.
+
+        Params:
+            > raise_on_error - bool, raise the first exception among the
+                               results instead of returning it
+        Returns: list with the result of each queued call
+        """
+        if self._queued is None:
+            raise ValueError("Not a pipeline")
+        queued, self._queued = self._queued, []
+        if not queued:
+            return []
+
+        results = self.client.call_many([[op, args] for op, args, _ in queued])
+        for i, (result, (_, _, decode)) in enumerate(zip(results, queued)):
+            if isinstance(result, Exception):
+                if raise_on_error:
+                    raise result
+            elif decode is not None:
+                results[i] = decode(result)
+        return results
+
+class RemoteDataserver(_Stub):
+    """
+    Stands in for a Dataserver, sending each call to a Service.  Calls
+    raise the same exceptions a local Dataserver would.
+    """
+    def Set(self, memloc: bytes, val: bytes) -> None:
+        return self._call("ds.Set", memloc, val)
+
+    def Get(self, memloc: bytes) -> bytes:
+        return self._call("ds.Get", memloc)
+
+    def Delete(self, memloc: bytes) -> None:
+        return self._call("ds.Delete", memloc)
+
+    def GetVersioned(self, memloc: bytes) -> tuple:
+        return self._call("ds.GetVersioned", memloc, decode=tuple)
+
+    def SetIfVersion(self, memloc: bytes, val: bytes, expected_version: int) -> int:
+        return self._call("ds.SetIfVersion", memloc, val, expected_version)
+
+    def GetMany(self, memlocs: list) -> dict:
+        return self._call("ds.GetMany", list(memlocs))
+
+    def SetMany(self, mapping: dict) -> None:
+        return self._call("ds.SetMany", mapping)
+
+    def DeleteMany(self, memlocs: list) -> dict:
+        return self._call("ds.DeleteMany", list(memlocs))
+
+    def ListKeys(self, prefix: bytes = b"") -> list:
+        return self._call("ds.ListKeys", prefix)
+
+    def GetMap(self) -> dict:
+        return self._call("ds.GetMap")
+
+    def Clear(self):
+        return self._call("ds.Clear")
+
+class RemoteKeyserver(_Stub):
+    """
+    Stands in for a Keyserver, sending each call to a Service.
+    """
+    def Set(self, identifier: str, pk: AsmPublicKey) -> None:
+        if isinstance(pk, AsmPublicKey):
+            pk = _key_to_wire(pk)
+        return self._call("ks.Set", identifier, pk)
+
+    def Get(self, identifier: str) -> AsmPublicKey:
+        return self._call("ks.Get", identifier, decode=_key_from_wire)
+
+    def Delete(self, identifier: str) -> None:
+        return self._call("ks.Delete", identifier)
+
+    def GetMap(self) -> dict:
+        return self._call("ks.GetMap", decode=lambda m: {
+            i: _key_from_wire(pk) for i, pk in m.items()})
+
+    def Clear(self):
+        return self._call("ks.Clear")
+
+def connect(address, pool_size: int = 8, timeout: float = None):
+    """
+    Connect to a Service.
+
+    Params: see ServiceClient
+    Returns: (RemoteDataserver, RemoteKeyserver) sharing one connection pool
+    """
+    client = ServiceClient(address, pool_size, timeout)
+    return RemoteDataserver(client), RemoteKeyserver(client)
+
+
+##
+## Load generator
+##
+
+def load_test(dataserver, concurrency: int, ops: int, value_size: int = 1024,
+              depth: int = 1, read_fraction: float = 0.5) -> dict:
+    """
+    Drive a dataserver from several threads and measure throughput and
+    latency.  Each thread issues a mix of Get and Set calls on its own
+    set of memlocs.
+
+    Params:
+        > dataserver    - Dataserver or RemoteDataserver
+        > concurrency   - int, number of threads
+        > ops           - int, calls per thread
+        > value_size    - int, bytes per value
+        > depth         - int, calls per round trip; above 1, calls are
+                          sent through a pipeline (RemoteDataserver only)
+        > read_fraction - float, share of calls that are Gets
+    Returns: dict with "ops", "seconds", "ops_per_sec", and "p50" and
+             "p99" latency per round trip in seconds
+    """
+    value = bytes(value_size)
+    latencies = [[] for _ in range(concurrency)]
+    spans = [None] * concurrency
+    start = threading.Barrier(concurrency)
+
+    def worker(i: int) -> None:
+        rng = random.Random(i)
+        keys = [uuid.uuid4().bytes for _ in range(64)]
+        dataserver.SetMany({k: value for k in keys})
+        target = dataserver.pipeline() if depth > 1 else dataserver
+        start.wait()
+
+        begin = time.perf_counter()
+        for _ in range(ops // depth):
+            t = time.perf_counter()
+            for _ in range(depth):
+                k = rng.choice(keys)
+                if rng.random() < read_fraction:
+                    target.Get(k)
+                else:
+                    target.Set(k, value)
+            if depth > 1:
+                target.execute()
+            latencies[i].append(time.perf_counter() - t)
+        spans[i] = (begin, time.perf_counter())
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # From the first thread starting its calls to the last one finishing
+    seconds = max(end for _, end in spans) - min(begin for begin, _ in spans)
+
+    samples = sorted(x for lat in latencies for x in lat)
+    done = len(samples) * depth
+    return {
+        "ops": done,
+        "seconds": seconds,
+        "ops_per_sec": done / seconds if seconds > 0 else float("inf"),
+        "p50": samples[len(samples) // 2] if samples else 0.0,
+        "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python3 -m support.netserver")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="run a server")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=7070, help="0 picks a free port")
+    serve.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead")
+    serve.add_argument("--log", metavar="FILE", help="store values in a LogBackend")
+
+    load = sub.add_parser("load", help="run the load generator against a server")
+    load.add_argument("address", help="HOST:PORT or a Unix socket path")
+    load.add_argument("--concurrency", default="1,2,4,8,16",
+                      help="comma-separated thread counts")
+    load.add_argument("--ops", type=int, default=2000, help="calls per thread")
+    load.add_argument("--size", type=int, default=1024, help="bytes per value")
+    load.add_argument("--depth", type=int, default=1, help="calls per round trip")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        backend = LogBackend(args.log) if args.log else None
+
+        async def run():
+            server = await Service(Dataserver(backend)).start(args.host, args.port, args.unix)
+            name = args.unix or "%s:%d" % server.sockets[0].getsockname()[:2]
+            print(f"listening on {name}", flush=True)
+            await server.serve_forever()
+
+        try:
+            asyncio.run(run())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    address = args.address
+    if ":" in address and "/" not in address:
+        host, port = address.rsplit(":", 1)
+        address = (host, int(port))
+
+    print(f"{'threads':>8} {'ops/sec':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for n in (int(x) for x in args.concurrency.split(",")):
+        ds, _ = connect(address, pool_size=n)
+        stats = load_test(ds, n, args.ops, args.size, args.depth)
+        ds.client.close()
+        print(f"{n:>8} {stats['ops_per_sec']:>10.0f} "
+              f"{stats['p50'] * 1e3:>8.3f} {stats['p99'] * 1e3:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
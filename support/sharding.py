@@ -0,0 +1,368 @@
+##
+## sharding.py - Dataserver sharded across several backends
+##
+## This file contains a router with the Dataserver API that spreads
+## memlocs over several Dataservers (in-process, or RemoteDataservers for
+## other processes or machines), so that storage and load are split
+## between them:
+##
+##   >>> ds = ShardedDataserver([Dataserver(), Dataserver()])
+##   >>> client.dataserver = ds
+##   >>> ds.add_shard(RemoteDataserver(...))   # rebalances in the background
+##
+## Memlocs are placed by consistent hashing: each shard owns VNODES points
+## on a 64-bit ring, and a memloc belongs to the shard owning the first
+## point at or after its first 8 bytes.  Adding a shard only moves the
+## memlocs that fall just before its points, about 1/N of the data.
+##
+
+import bisect
+import concurrent.futures
+import itertools
+import threading
+
+import support.crypto as crypto
+
+from support.dataserver import VersionConflict, _StripedLock
+
+# Points each shard owns on the ring.  More points spread memlocs more
+# evenly between shards.
+VNODES = 64
+
+# Number of memlocs moved at a time when rebalancing
+MOVE_BATCH = 256
+
+# Shard versions are combined with the id of the shard that holds the
+# value, so a version handed out by one shard never matches another
+_SHARD_BITS = 16
+
+
+class _Ring:
+    """
+    A consistent hash ring over shard ids.
+    """
+    def __init__(self, shard_ids: list, vnodes: int):
+        points = sorted(
+            (int.from_bytes(crypto.Hash(b"shard %d/%d" % (sid, i))[:8], "big"), sid)
+            for sid in shard_ids for i in range(vnodes))
+        self.positions = [pos for pos, _ in points]
+        self.owners = [sid for _, sid in points]
+
+    def lookup(self, memloc: bytes) -> int:
+        """
+        Returns: the id of the shard that owns memloc
+        """
+        i = bisect.bisect_left(self.positions, int.from_bytes(memloc[:8], "big"))
+        return self.owners[i % len(self.owners)]
+
+
+class ShardedDataserver:
+    """
+    Routes each memloc to one of several Dataservers.
+
+    Every call holds the router's lock for the stripes of its memlocs (see
+    Dataserver), so calls on one memloc are applied in order even while
+    the memloc is being moved to another shard.  Batched calls send one
+    batched call to each shard involved, all at once on a thread pool.
+
+    Versions returned by GetVersioned and SetIfVersion identify the
+    shard as well, so a value that moves to another shard has a new
+    version.
+    """
+    def __init__(self, shards: list, vnodes: int = VNODES, stripes: int = 64,
+                 workers: int = None):
+        """
+        Params:
+            > shards  - list of Dataservers (or RemoteDataservers); at least one
+            > vnodes  - int, points per shard on the ring
+            > stripes - int, number of router locks (1-256)
+            > workers - int, threads used to call shards in parallel
+                        (default: 2 per shard, at least 8)
+        """
+        if not shards:
+            raise ValueError("At least one shard is needed")
+        self.shards = list(shards)
+        self.vnodes = vnodes
+        self._ring = _Ring(range(len(self.shards)), vnodes)
+        self._prev = None  # ring before the last add_shard, while rebalancing
+        self._stripes = _StripedLock(stripes)
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers or max(8, 2 * len(self.shards)))
+        self._rebalancer = None
+        self._rebalance_error = None
+
+        # Memlocs moved by rebalancing since this router was made
+        self.moved = 0
+        self._moved_lock = threading.Lock()
+
+    def _validate(self, memloc: bytes) -> None:
+        """
+        Validates the format of a memloc, as Dataserver does, before it
+        is used for routing. Not to be used externally.
+        """
+        if (not isinstance(memloc, bytes)) or (not len(memloc) == 16):
+            print("ERROR: Memloc must be a bytes() object of size 16 bytes")
+            raise Exception("InvalidMemloc")
+
+    def _validate_val(self, val) -> None:
+        """
+        Validates a val as Dataserver does, so that a bad SetMany stores
+        nothing on any shard. Not to be used externally.
+        """
+        if not isinstance(val, (bytes, bytearray, memoryview)) or (
+                isinstance(val, memoryview) and not val.contiguous):
+            print(
+                f"ERROR: Datasever can only store raw bytes! You gave val of type {type(val)}. Please serialize to bytes."
+            )
+            raise ValueError
+
+    ##
+    ## Routing
+    ##
+
+    def _group(self, memlocs) -> dict:
+        """
+        Returns: dict of shard id -> list of the memlocs it owns
+        """
+        groups = {}
+        for m in memlocs:
+            groups.setdefault(self._ring.lookup(m), []).append(m)
+        return groups
+
+    def _fan_out(self, calls: list) -> list:
+        """
+        Run (func, *args) calls, on the thread pool if there are several.
+
+        Returns: list of results, in order
+        """
+        if len(calls) == 1:
+            func, *args = calls[0]
+            return [func(*args)]
+        futures = [self._pool.submit(*call) for call in calls]
+        return [f.result() for f in futures]
+
+    def _settle(self, memlocs) -> None:
+        """
+        Move any of the memlocs that are still on the shard that owned
+        them before the last add_shard to their new shard.  The caller
+        must hold the stripe locks of the memlocs.
+        """
+        prev = self._prev
+        if prev is None:
+            return
+
+        moves = {}
+        for m in memlocs:
+            src, dst = prev.lookup(m), self._ring.lookup(m)
+            if src != dst:
+                moves.setdefault((src, dst), []).append(m)
+        if not moves:
+            return
+
+        def move(src: int, dst: int, batch: list) -> int:
+            found = {m: v for m, v in self.shards[src].GetMany(batch).items() if v is not None}
+            if found:
+                self.shards[dst].SetMany(found)
+                self.shards[src].DeleteMany(list(found))
+            return len(found)
+
+        count = sum(self._fan_out([(move, src, dst, batch)
+                                   for (src, dst), batch in moves.items()]))
+        with self._moved_lock:
+            self.moved += count
+
+    ##
+    ## Dataserver API
+    ##
+
+    def Set(self, memloc: bytes, val: bytes) -> None:
+        self._validate(memloc)
+        with self._stripes.lock(memloc):
+            self._settle([memloc])
+            self.shards[self._ring.lookup(memloc)].Set(memloc, val)
+
+    def Get(self, memloc: bytes) -> bytes:
+        self._validate(memloc)
+        with self._stripes.lock(memloc):
+            self._settle([memloc])
+            return self.shards[self._ring.lookup(memloc)].Get(memloc)
+
+    def Delete(self, memloc: bytes) -> None:
+        self._validate(memloc)
+        with self._stripes.lock(memloc):
+            self._settle([memloc])
+            self.shards[self._ring.lookup(memloc)].Delete(memloc)
+
+    def GetVersioned(self, memloc: bytes) -> tuple:
+        self._validate(memloc)
+        with self._stripes.lock(memloc):
+            self._settle([memloc])
+            sid = self._ring.lookup(memloc)
+            val, version = self.shards[sid].GetVersioned(memloc)
+        return val, (version << _SHARD_BITS | sid) if version else 0
+
+    def SetIfVersion(self, memloc: bytes, val: bytes, expected_version: int) -> int:
+        self._validate(memloc)
+        with self._stripes.lock(memloc):
+            self._settle([memloc])
+            sid = self._ring.lookup(memloc)
+            if expected_version:
+                if expected_version & ((1 << _SHARD_BITS) - 1) != sid:
+                    raise VersionConflict("VersionConflict")
+                expected_version >>= _SHARD_BITS
+            version = self.shards[sid].SetIfVersion(memloc, val, expected_version)
+        return version << _SHARD_BITS | sid
+
+    def GetMany(self, memlocs: list) -> dict:
+        for m in memlocs:
+            self._validate(m)
+
+        with self._stripes.hold(memlocs):
+            self._settle(memlocs)
+            groups = self._group(memlocs)
+            found = {}
+            for part in self._fan_out([(self.shards[sid].GetMany, batch)
+                                       for sid, batch in groups.items()]):
+                found.update(part)
+        return {m: found[m] for m in memlocs}
+
+    def SetMany(self, mapping: dict) -> None:
+        for m, val in mapping.items():
+            self._validate(m)
+            self._validate_val(val)
+
+        with self._stripes.hold(mapping):
+            self._settle(mapping)
+            groups = self._group(mapping)
+            self._fan_out([(self.shards[sid].SetMany, {m: mapping[m] for m in batch})
+                           for sid, batch in groups.items()])
+
+    def DeleteMany(self, memlocs: list) -> dict:
+        for m in memlocs:
+            self._validate(m)
+
+        with self._stripes.hold(memlocs):
+            self._settle(memlocs)
+            groups = self._group(memlocs)
+            deleted = {}
+            for part in self._fan_out([(self.shards[sid].DeleteMany, batch)
+                                       for sid, batch in groups.items()]):
+                deleted.update(part)
+        return {m: deleted[m] for m in memlocs}
+
+    def ListKeys(self, prefix: bytes = b"") -> list:
+        """
+        List the memlocs on every shard that start with prefix.  While a
+        memloc is being moved it may be listed twice; duplicates are
+        dropped.
+        """
+        if not isinstance(prefix, bytes) or len(prefix) > 16:
+            raise ValueError("InvalidPrefix")
+        keys = self._fan_out([(shard.ListKeys, prefix) for shard in self.shards])
+        return list(dict.fromkeys(itertools.chain.from_iterable(keys)))
+
+    def GetMap(self) -> dict:
+        """
+        Return the contents of every shard as one dictionary (testing only).
+        """
+        with self._stripes.hold():
+            result = {}
+            for part in self._fan_out([(shard.GetMap,) for shard in self.shards]):
+                result.update(part)
+            return result
+
+    def Clear(self):
+        """
+        Delete the contents of every shard (testing only).
+        """
+        with self._stripes.hold():
+            self._fan_out([(shard.Clear,) for shard in self.shards])
+
+    ##
+    ## Rebalancing
+    ##
+
+    def add_shard(self, shard) -> None:
+        """
+        Add a shard.  It takes over its share of the memlocs at once, and
+        they are moved to it by a background thread; until a memloc is
+        moved, calls on it move it first.  Waits for any earlier
+        rebalancing to finish before adding the shard, and raises
+        ValueError if it did not finish (see resume_rebalance).
+
+        Params:
+            > shard - Dataserver or RemoteDataserver, preferably empty
+        """
+        self.wait_rebalanced()
+        with self._stripes.hold():
+            # Memlocs not moved yet are only found through the old ring
+            if self._prev is not None:
+                raise ValueError("Rebalancing did not finish")
+            self._prev = self._ring
+            self.shards.append(shard)
+            self._ring = _Ring(range(len(self.shards)), self.vnodes)
+
+        self._start_rebalance()
+
+    def resume_rebalance(self) -> None:
+        """
+        Start moving memlocs again after rebalancing failed.
+        """
+        self.wait_rebalanced()
+        if self._prev is not None:
+            self._start_rebalance()
+
+    def _start_rebalance(self) -> None:
+        self._rebalance_error = None
+        self._rebalancer = threading.Thread(target=self._rebalance, daemon=True)
+        self._rebalancer.start()
+
+    def _rebalance(self) -> None:
+        """
+        Move every memloc whose owner changed, MOVE_BATCH at a time.
+        Each old shard's memlocs are listed one first byte at a time
+        with ListKeys, so only about 1/256 of a shard's memlocs are held
+        at once, and values are only read for the memlocs that move.
+        Memlocs stored on a shard after it is listed were routed by the
+        new ring, so they are already in place.
+
+        If a shard call fails, the error is kept for wait_rebalanced and
+        the old ring stays in use for the memlocs that were not moved.
+        """
+        prev = self._prev
+        try:
+            for sid, shard in enumerate(self.shards[:-1]):
+                for first in range(256):
+                    stale = [m for m in shard.ListKeys(bytes([first]))
+                             if self._ring.lookup(m) != sid]
+                    for i in range(0, len(stale), MOVE_BATCH):
+                        batch = stale[i:i + MOVE_BATCH]
+                        with self._stripes.hold(batch):
+                            self._settle(batch)
+        except Exception as e:
+            self._rebalance_error = e
+            return
+
+        with self._stripes.hold():
+            if self._prev is prev:
+                self._prev = None
+
+    def wait_rebalanced(self) -> None:
+        """
+        Wait until the last add_shard has finished moving memlocs.
+        Raises the error that stopped it, if any.
+        """
+        if self._rebalancer is not None:
+            self._rebalancer.join()
+            self._rebalancer = None
+        error, self._rebalance_error = self._rebalance_error, None
+        if error is not None:
+            raise error
+
+    def close(self) -> None:
+        """
+        Wait for rebalancing and stop the thread pool.
+        """
+        try:
+            self.wait_rebalanced()
+        finally:
+            self._pool.shutdown()
@@ -12,6 +12,7 @@
 import code
 import json
 import base64
+import struct
 
 import readline
 import rlcompleter
@@ -118,11 +119,159 @@ def _repair_bytes(o):
         print(f"ERROR: Undeserializable type {type(o)} detected! Valid types are [dict, list, int, str, float, bool, NoneType]")
         raise ValueError
 
-def ObjectToBytes(o: object) -> bytes:
+##
+## Binary codec
+##
+## A binary blob starts with a version byte (which never starts a JSON
+## document), followed by one tagged value:
+##
+##   N / T / F          None, True, False
+##   i <varint>         int, zig-zag encoded
+##   f <8 bytes>        float, little-endian double
+##   s <varint> <data>  str, UTF-8 encoded
+##   b <varint> <data>  bytes
+##   l <varint> <item>* list
+##   d <varint> (<key> <value>)*  dict
+##
+## Lengths and counts are unsigned LEB128 varints.  Unlike the JSON
+## codec, bytes are stored as-is and dict keys keep their type.
+## Bytearrays and contiguous memoryviews are encoded as bytes.
+##
+## Blobs may come from anyone, so decoding checks counts against the
+## bytes that are left before allocating, and nesting is limited to
+## _BINARY_DEPTH levels.
+##
+
+_BINARY_VERSION = 1
+_BINARY_DEPTH = 100
+_DOUBLE = struct.Struct("<d")
+
+def _write_varint(buf: bytearray, n: int) -> None:
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def _read_varint(b: memoryview, pos: int):
+    result = 0
+    shift = 0
+    while True:
+        byte = b[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def _encode_binary(o, buf: bytearray) -> None:
+    """
+    A helper function for ObjectToBytes
+    """
+    # Check exact types first, since this is called for every value
+    t = type(o)
+    if t is bytes or isinstance(o, bytes):
+        buf.append(0x62)                        # b
+        _write_varint(buf, len(o))
+        buf += o
+    elif t is str or isinstance(o, str):
+        data = o.encode()
+        buf.append(0x73)                        # s
+        _write_varint(buf, len(data))
+        buf += data
+    elif t is list or isinstance(o, list):
+        buf.append(0x6c)                        # l
+        _write_varint(buf, len(o))
+        for item in o:
+            _encode_binary(item, buf)
+    elif o is None:
+        buf.append(0x4e)                        # N
+    elif o is True:
+        buf.append(0x54)                        # T
+    elif o is False:
+        buf.append(0x46)                        # F
+    elif t is int or isinstance(o, int):
+        buf.append(0x69)                        # i
+        _write_varint(buf, o << 1 if o >= 0 else (-o << 1) - 1)
+    elif isinstance(o, dict):
+        buf.append(0x64)                        # d
+        _write_varint(buf, len(o))
+        for key, value in o.items():
+            _encode_binary(key, buf)
+            _encode_binary(value, buf)
+    elif isinstance(o, float):
+        buf.append(0x66)                        # f
+        buf += _DOUBLE.pack(o)
+    elif isinstance(o, (bytearray, memoryview)):
+        buf.append(0x62)                        # b
+        _write_varint(buf, o.nbytes if isinstance(o, memoryview) else len(o))
+        buf += o
+    else:
+        print(f"ERROR: Unserializable type {type(o)} detected! Valid types are [dict, list, int, str, float, bool, NoneType, bytes]")
+        raise ValueError
+
+def _decode_binary(b: memoryview, pos: int, depth: int = 0):
+    """
+    A helper function for BytesToObject
+
+    Returns: (object, position after it)
+    """
+    if depth > _BINARY_DEPTH:
+        raise ValueError("Binary object nested too deeply")
+    tag = b[pos]
+    pos += 1
+
+    if tag == 0x62 or tag == 0x73:    # b, s
+        n = b[pos]
+        pos += 1
+        if n >= 0x80:
+            n, pos = _read_varint(b, pos - 1)
+        end = pos + n
+        if end > len(b):
+            raise ValueError("Truncated binary object")
+        if tag == 0x62:
+            return b[pos:end].tobytes(), end
+        return str(b[pos:end], "utf-8"), end
+    if tag == 0x6c:    # l
+        n, pos = _read_varint(b, pos)
+        # Every item takes at least one byte
+        if n > len(b) - pos:
+            raise ValueError("Truncated binary object")
+        result = [None] * n
+        for i in range(n):
+            result[i], pos = _decode_binary(b, pos, depth + 1)
+        return result, pos
+    if tag == 0x69:    # i
+        n, pos = _read_varint(b, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == 0x64:    # d
+        n, pos = _read_varint(b, pos)
+        if 2 * n > len(b) - pos:
+            raise ValueError("Truncated binary object")
+        result = {}
+        for _ in range(n):
+            key, pos = _decode_binary(b, pos, depth + 1)
+            result[key], pos = _decode_binary(b, pos, depth + 1)
+        return result, pos
+    if tag == 0x4e:    # N
+        return None, pos
+    if tag == 0x54:    # T
+        return True, pos
+    if tag == 0x46:    # F
+        return False, pos
+    if tag == 0x66:    # f
+        return _DOUBLE.unpack_from(b, pos)[0], pos + _DOUBLE.size
+
+    raise ValueError(f"Unknown binary tag {tag}")
+
+def ObjectToBytes(o: object, codec: str = "json") -> bytes:
     """
     A helper function that will serialize objects to bytes using JSON.
     It can serialize arbitrary nestings of lists and dictionaries containing ints, floats, booleans, strs, Nones, and bytes.
 
+    With codec="binary", a compact length-prefixed binary format is used
+    instead.  It stores bytes without base64 encoding and has none of the
+    caveats below.  BytesToObject decodes both formats.
+
     A note on bytes and strings:
     This function encodes all bytes as base64 strings in order to be json compliant.
     The complimentary function, BytesToObject, will decode everything it detects to be a base64 string
@@ -133,15 +282,35 @@ def ObjectToBytes(o: object) -> bytes:
 
     In the (unlikely) event you store a string with this format it will be decoded to bytes!
     """
+    if codec == "binary":
+        buf = bytearray([_BINARY_VERSION])
+        _encode_binary(o, buf)
+        return bytes(buf)
+    if codec != "json":
+        raise ValueError(f"Unknown codec {codec}")
+
     o = _prepare_bytes(o)
     return json.dumps(o).encode()
 
 def BytesToObject(b: bytes) -> object:
     """
     A helper function that will deserialize bytes to an object using JSON. See caveats in ObjectToBytes().
+    Blobs made with the binary codec are detected by their version byte.
+    Any bytes-like object is accepted.
     """
-    obj = json.loads(b.decode())
-    return _repair_bytes(obj)
+    if b[:1] == bytes([_BINARY_VERSION]):
+        try:
+            obj, pos = _decode_binary(memoryview(b), 1)
+        except (IndexError, TypeError, struct.error, UnicodeDecodeError):
+            raise ValueError("Malformed binary object")
+        if pos != len(b):
+            raise ValueError("Trailing data after binary object")
+        return obj
+
+    try:
+        return _repair_bytes(json.loads(str(b, "utf-8")))
+    except RecursionError:
+        raise ValueError("JSON object nested too deeply")
 
 
 
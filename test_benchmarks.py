@@ -0,0 +1,1161 @@
+##
+## test_benchmarks.py - Performance benchmarks for the client and support code
+##
+## These run as part of the regular test suite at a small size.  Set
+## DROPBOX_BENCH_SCALE to a larger integer to run them on bigger inputs,
+## for example:
+##
+##   DROPBOX_BENCH_SCALE=10 python3 -m unittest -v test_benchmarks
+##
+## Results are printed; the assertions only check the shape of the
+## results (e.g. that a cost stays flat), not absolute timings.
+##
+
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+
+import support.crypto as crypto
+import support.util as util
+
+from support.dataserver import Dataserver, DictBackend, LogBackend, dataserver, memloc
+from support.keyserver import keyserver
+from support.netserver import connect, load_test
+from support.sharding import ShardedDataserver
+
+import client as c
+
+
+SCALE = int(os.environ.get("DROPBOX_BENCH_SCALE", "1"))
+
+
+def _report(title: str, header: list, rows: list) -> None:
+    """
+    Print a table of benchmark results.
+    """
+    print(f"\n== {title} ==")
+    print("  ".join(f"{h:>14}" for h in header))
+    for row in rows:
+        print("  ".join(f"{v:>14.3f}" if isinstance(v, float) else f"{v:>14}" for v in row))
+
+
+class CountingDataserver(Dataserver):
+    """
+    A Dataserver that counts the bytes written to it.
+    """
+    def __init__(self):
+        super().__init__()
+        self.bytes_written = 0
+
+    def Set(self, memloc: bytes, val: bytes) -> None:
+        super().Set(memloc, val)
+        self.bytes_written += len(val)
+
+    def SetMany(self, mapping: dict) -> None:
+        super().SetMany(mapping)
+        self.bytes_written += sum(len(v) for v in mapping.values())
+
+    def SetIfVersion(self, memloc: bytes, val: bytes, expected_version: int) -> int:
+        version = super().SetIfVersion(memloc, val, expected_version)
+        self.bytes_written += len(val)
+        return version
+
+
+class _ClientBenchmark(unittest.TestCase):
+    """
+    Runs the client against a private CountingDataserver.
+    """
+    def setUp(self):
+        dataserver.Clear()
+        keyserver.Clear()
+        self.ds = CountingDataserver()
+        self._orig_ds = c.dataserver
+        c.dataserver = self.ds
+
+    def tearDown(self):
+        c.dataserver = self._orig_ds
+
+
+class AppendBenchmark(_ClientBenchmark):
+    def test_append_bytes_written_flat(self):
+        """
+        Bytes written per append should not depend on the size of the file.
+        """
+        u = c.create_user("usr", "pswd")
+        u.upload_file("log", b'')
+
+        # Start a new index page on every append, so that the file has
+        # thousands of pages and an index tree several levels deep
+        orig = c.PAGE_ENTRIES
+        c.PAGE_ENTRIES = 1
+        try:
+            record = b'r' * 1000
+            window = 256
+            rows = []
+            written = []
+            for i in range(1, 2048 * SCALE + 1):
+                before = self.ds.bytes_written
+                start = time.perf_counter()
+                u.append_file("log", record)
+                elapsed = time.perf_counter() - start
+                written.append(self.ds.bytes_written - before)
+                if i % window == 0:
+                    depth = u._open("log")[2]["depth"]
+                    rows.append([i, depth, max(written[-window:]), elapsed * 1000])
+        finally:
+            c.PAGE_ENTRIES = orig
+
+        _report("append_file: cost per 1000-byte append, one page per append",
+                ["pages", "tree depth", "max written", "last ms"], rows)
+
+        # Writes are bounded by one chunk plus one index page, one node
+        # per level of the tree and the header, no matter how large the
+        # file has become: at most a full node more per level than at first.
+        ref_bytes = len(util.ObjectToBytes(u._open("log")[2]["index"], codec="binary"))
+        self.assertGreaterEqual(rows[-1][1], 2)
+        self.assertLess(rows[-1][2], rows[0][2] + rows[-1][1] * c.NODE_ENTRIES * ref_bytes)
+
+
+class StreamingBenchmark(_ClientBenchmark):
+    def _pieces(self, size: int):
+        for _ in range(size // c.CHUNK_SIZE):
+            yield crypto.SecureRandom(c.CHUNK_SIZE)
+
+    def _transient_peak(self, func):
+        """
+        Run func and return the most memory it held at once beyond what
+        it allocated and kept (i.e. the stored ciphertext).
+        """
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak - current
+
+    def test_stream_memory_flat(self):
+        """
+        Peak memory of streamed uploads and downloads should not grow with
+        the size of the file.
+        """
+        u = c.create_user("usr", "pswd")
+
+        rows = []
+        peaks = []
+        for mb in [1, 4, 16 * SCALE]:
+            size = mb * 1024 * 1024
+            up = self._transient_peak(lambda: u.upload_stream("big", self._pieces(size)))
+            down = self._transient_peak(lambda: sum(len(p) for p in u.download_stream("big")))
+            whole = self._transient_peak(lambda: u.download_file("big"))
+            peaks.append(max(up, down))
+            rows.append([mb, up // 1024, down // 1024, whole // 1024])
+
+        _report("streaming: transient peak memory (KiB)",
+                ["file MiB", "upload_stream", "download_stream", "download_file"], rows)
+
+        self.assertLess(peaks[-1], 2 * peaks[0] + 4 * c.BATCH_CHUNKS * c.CHUNK_SIZE)
+
+
+class ParallelCryptoBenchmark(_ClientBenchmark):
+    def test_worker_scaling(self):
+        """
+        Reports upload and download throughput by number of crypto workers.
+        Run with DROPBOX_BENCH_SCALE=4 or more for a 100 MB+ file.
+        """
+        size = 32 * SCALE * 1024 * 1024
+        data = crypto.SecureRandom(size)
+        u = c.create_user("usr", "pswd")
+
+        rows = []
+        for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+            u.workers = workers
+
+            # A new file each time, so that no chunks are deduplicated
+            name = f"big{workers}"
+            start = time.perf_counter()
+            u.upload_file(name, data)
+            up = time.perf_counter() - start
+
+            start = time.perf_counter()
+            down_data = u.download_file(name)
+            down = time.perf_counter() - start
+
+            self.assertEqual(down_data, data)
+            rows.append([workers, size / up / 2**20, size / down / 2**20])
+
+        _report(f"chunk crypto on {os.cpu_count()} cores: {size // 2**20} MiB file",
+                ["workers", "upload MiB/s", "download MiB/s"], rows)
+
+
+class ReadCacheBenchmark(_ClientBenchmark):
+    def test_hot_reads(self):
+        """
+        Compares repeated downloads of a hot file with and without the
+        per-User read cache.
+        """
+        u = c.create_user("usr", "pswd")
+        u.upload_file("hot", b'')
+        for _ in range(4 * c.PAGE_ENTRIES):
+            u.append_file("hot", b'record\n' * 10)
+
+        reads = 20 * SCALE
+        rows = []
+        for name, maxsize in [("off", 0), ("on", c.CACHE_ENTRIES)]:
+            v = c.authenticate_user("usr", "pswd")
+            v._cache.maxsize = maxsize
+            start = time.perf_counter()
+            for _ in range(reads):
+                v.download_file("hot")
+            elapsed = (time.perf_counter() - start) / reads * 1000
+            rows.append([name, elapsed, v._cache.hits, v._cache.misses])
+
+        _report(f"download_file: {reads} reads of a file with {4 * c.PAGE_ENTRIES} appends",
+                ["cache", "ms per read", "hits", "misses"], rows)
+
+        self.assertLess(rows[1][1], rows[0][1])
+
+
+class BackendBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "data.log")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _fill(self, ds: Dataserver, locs: list, size: int) -> None:
+        for i in range(0, len(locs), 256):
+            ds.SetMany({m: crypto.SecureRandom(size) for m in locs[i:i + 256]})
+
+    def _read_all(self, ds: Dataserver, locs: list) -> float:
+        start = time.perf_counter()
+        for m in locs:
+            ds.Get(m)
+        return time.perf_counter() - start
+
+    def test_log_backend(self):
+        """
+        Compares the log backend with the dict backend: heap held for the
+        working set, cold-start recovery time and read throughput.
+        """
+        count = 4096 * SCALE
+        size = 16 * 1024
+        locs = [memloc.Make() for _ in range(count)]
+        data_mb = count * size / 2**20
+
+        rows = []
+        for name, make in [("dict", DictBackend),
+                           ("log", lambda: LogBackend(self.path))]:
+            tracemalloc.start()
+            ds = Dataserver(make())
+            self._fill(ds, locs, size)
+            heap = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            # Only the log survives a restart; time how long reopening takes
+            recovery = "-"
+            if name == "log":
+                ds.backend.close()
+                start = time.perf_counter()
+                ds = Dataserver(LogBackend(self.path))
+                recovery = (time.perf_counter() - start) * 1000
+
+            elapsed = self._read_all(ds, locs)
+            rows.append([name, data_mb, heap / 2**20, recovery, count / elapsed])
+            if name == "log":
+                self.assertEqual(len(ds.GetMap()), count)
+                ds.backend.close()
+
+        _report(f"dataserver backends: {count} values of {size} bytes",
+                ["backend", "data MiB", "heap MiB", "recovery ms", "reads/s"], rows)
+
+        # The log backend keeps values out of the Python heap
+        self.assertLess(rows[1][2], rows[0][2] / 4)
+
+
+class SerializationBenchmark(unittest.TestCase):
+    def _shapes(self) -> dict:
+        """
+        Record shapes like the ones the client stores.
+        """
+        return {
+            "user record": {
+                "dec_key": crypto.SecureRandom(1700),
+                "sign_key": crypto.SecureRandom(1700),
+                "files_key": crypto.SecureRandom(16),
+            },
+            "index page": [[memloc.Make(), c.CHUNK_SIZE, crypto.SecureRandom(64), 0]
+                           for _ in range(c.PAGE_ENTRIES)],
+            "ciphertexts": {"size": 10, "cts": [[crypto.SecureRandom(1024) for _ in range(4)]
+                                                for _ in range(16)]},
+        }
+
+    def _time(self, func, repeat: int) -> float:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1e6
+
+    def test_binary_codec(self):
+        """
+        Compares size and speed of the JSON and binary codecs.
+        """
+        repeat = 50 * SCALE
+        rows = []
+        for name, obj in self._shapes().items():
+            for codec in ["json", "binary"]:
+                b = util.ObjectToBytes(obj, codec=codec)
+                enc = self._time(lambda: util.ObjectToBytes(obj, codec=codec), repeat)
+                dec = self._time(lambda: util.BytesToObject(b), repeat)
+                rows.append([name, codec, len(b), enc, dec])
+
+        _report("ObjectToBytes/BytesToObject codecs (us per call)",
+                ["record", "codec", "bytes", "encode us", "decode us"], rows)
+
+        for json_row, binary_row in zip(rows[::2], rows[1::2]):
+            self.assertLess(binary_row[2], json_row[2])
+
+
+class KeySerializationBenchmark(unittest.TestCase):
+    def _time(self, func, repeat: int) -> float:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1e6
+
+    def test_key_caching(self):
+        """
+        Compares first (uncached) and repeated key comparisons and loads.
+        """
+        repeat = 200 * SCALE
+        pk, _ = crypto.AsymmetricKeyGen()
+        pem = bytes(pk)
+
+        def fresh():
+            return crypto.AsymmetricEncryptKey(pk.libPubKey)
+
+        def cold_load():
+            crypto.key_intern_table.clear()
+            crypto.AsymmetricEncryptKey.from_bytes(pem)
+
+        warm = crypto.AsymmetricEncryptKey.from_bytes(pem)
+        rows = [
+            ["__eq__", self._time(lambda: fresh() == fresh(), repeat),
+             self._time(lambda: warm == pk, repeat)],
+            ["from_bytes", self._time(cold_load, repeat),
+             self._time(lambda: crypto.AsymmetricEncryptKey.from_bytes(pem), repeat)],
+        ]
+        _report("public key operations (us per call)", ["operation", "uncached", "cached"], rows)
+        print(f"public key size: {len(pem)} bytes PEM, {len(pk.to_bytes('der'))} bytes DER")
+
+        for row in rows:
+            self.assertLess(row[2], row[1])
+
+
+class KDFCacheBenchmark(unittest.TestCase):
+    def tearDown(self):
+        crypto.DisableKDFCache()
+
+    def _login(self, password: str, salt: bytes) -> None:
+        """
+        A login path that derives several subkeys from one password.
+        """
+        root = crypto.PasswordKDF(password, salt, 16)
+        for purpose in ["enc", "mac", "files", "sharing"]:
+            crypto.HashKDF(root, purpose)
+
+    def test_kdf_cache(self):
+        """
+        Compares repeated logins with and without the derived-key cache.
+        """
+        logins = 50 * SCALE
+        salt = crypto.SecureRandom(16)
+
+        rows = []
+        for name in ["off", "on"]:
+            cache = crypto.EnableKDFCache() if name == "on" else None
+            start = time.perf_counter()
+            for _ in range(logins):
+                self._login("pswd", salt)
+            elapsed = (time.perf_counter() - start) / logins * 1000
+            hit_rate = cache.stats()["hit_rate"] if cache else 0.0
+            rows.append([name, elapsed, hit_rate])
+
+        _report(f"KDF cache: {logins} logins, 1 PasswordKDF + 4 HashKDF each",
+                ["cache", "ms per login", "hit rate"], rows)
+
+        self.assertLess(rows[1][1], rows[0][1])
+
+
+class WorkFactorBenchmark(unittest.TestCase):
+    def setUp(self):
+        dataserver.Clear()
+        keyserver.Clear()
+        self.orig = crypto.PBKDF2_ITERATIONS
+
+    def tearDown(self):
+        crypto.PBKDF2_ITERATIONS = self.orig
+
+    def test_login_latency(self):
+        """
+        Reports create_user and authenticate_user latency across PBKDF2
+        work factors, and the work factor calibrated for 100 ms.
+        """
+        rows = []
+        for iterations in [1000, 10000, 100000 * SCALE]:
+            crypto.PBKDF2_ITERATIONS = iterations
+            name = f"usr{iterations}"
+
+            start = time.perf_counter()
+            c.create_user(name, "pswd")
+            created = time.perf_counter() - start
+
+            start = time.perf_counter()
+            c.authenticate_user(name, "pswd")
+            authenticated = time.perf_counter() - start
+
+            rows.append([iterations, created * 1000, authenticated * 1000])
+
+        _report("login latency by PBKDF2 work factor",
+                ["iterations", "create ms", "authenticate ms"], rows)
+        print(f"calibrated for 100 ms: {crypto.CalibratePasswordKDF(0.1)} iterations")
+
+        self.assertLess(rows[0][2], rows[-1][2])
+
+
+class KeyPoolBenchmark(unittest.TestCase):
+    def setUp(self):
+        dataserver.Clear()
+        keyserver.Clear()
+
+    def tearDown(self):
+        crypto.DisableKeyPool()
+
+    def test_create_user_with_pool(self):
+        """
+        Compares create_user latency with on-demand keygen and with a
+        prefilled key pool.
+        """
+        users = 4 * SCALE
+
+        rows = []
+        for name in ["on demand", "pool"]:
+            pool = None
+            if name == "pool":
+                pool = crypto.EnableKeyPool(size=2 * users, low_water=users // 2)
+                pool.wait_until_full()
+
+            start = time.perf_counter()
+            for i in range(users):
+                c.create_user(f"{name}{i}", "pswd")
+            elapsed = (time.perf_counter() - start) / users * 1000
+
+            starved = pool.stats()["starved"] if pool else "-"
+            rows.append([name, elapsed, starved])
+
+        _report(f"create_user: {users} users", ["keygen", "ms per user", "starved"], rows)
+
+        self.assertLess(rows[1][1], rows[0][1])
+
+
+class DedupBenchmark(_ClientBenchmark):
+    def test_edited_upload(self):
+        """
+        Compares re-uploading a large file after a few small edits with
+        uploading it from scratch.
+        """
+        size = 16 * SCALE * 1024 * 1024
+        data = crypto.SecureRandom(size)
+        u = c.create_user("usr", "pswd")
+
+        # Insert, overwrite and delete a few bytes at a handful of offsets
+        edited = bytearray(data)
+        for i, offset in enumerate(range(size // 7, size, size // 7)):
+            if i % 3 == 0:
+                edited[offset:offset] = b'inserted'
+            elif i % 3 == 1:
+                edited[offset:offset + 8] = b'replaced'
+            else:
+                del edited[offset:offset + 8]
+        edited = bytes(edited)
+
+        rows = []
+        for name, first, second in [("full", data, None), ("edited", data, edited)]:
+            u.upload_file(name, first)
+            if second is None:
+                # A full upload of a new file to compare against
+                name, second = name + "2", first
+
+            u.upload_stats = dict.fromkeys(u.upload_stats, 0)
+            before = self.ds.bytes_written
+            start = time.perf_counter()
+            u.upload_file(name, second)
+            elapsed = time.perf_counter() - start
+            written = self.ds.bytes_written - before
+
+            stats = u.upload_stats
+            self.assertEqual(u.download_file(name), second)
+            rows.append([name, written // 1024, elapsed * 1000,
+                         stats["bytes"] / max(1, stats["bytes"] - stats["bytes_saved"]),
+                         stats["bytes_saved"] // 1024])
+
+        _report(f"dedup: re-uploading a {size // 2**20} MiB file",
+                ["upload", "KiB written", "ms", "dedup ratio", "KiB saved"], rows)
+
+        self.assertLess(rows[1][1], rows[0][1] // 4)
+
+
+class ManifestBenchmark(_ClientBenchmark):
+    def test_small_edit_and_single_chunk(self):
+        """
+        Reports the bytes written by overwriting a file with a small edit
+        near its end, and the time to check and download one chunk, as the
+        file grows.
+        """
+        u = c.create_user("usr", "pswd")
+
+        rows = []
+        for mb in [4, 16, 64 * SCALE]:
+            size = mb * 1024 * 1024
+            data = crypto.SecureRandom(size)
+            u.upload_file("big", data)
+
+            before = self.ds.bytes_written
+            u.upload_file("big", data[:-1000] + b'edited' + data[-1000:])
+            written = self.ds.bytes_written - before
+
+            # A fresh session, so that no metadata is cached
+            reader = c.authenticate_user("usr", "pswd")
+            chunks = reader._open("big")[2]["index"][4]
+            start = time.perf_counter()
+            reader.download_chunk("big", chunks // 2)
+            elapsed = time.perf_counter() - start
+
+            rows.append([mb, written // 1024, chunks, elapsed * 1000])
+
+        _report("Merkle manifest: small edit and single chunk reads",
+                ["file MiB", "edit KiB written", "chunks", "chunk ms"], rows)
+
+        # Edits write the changed chunks, their page and the header
+        self.assertLess(rows[-1][1], 2 * rows[0][1] + 2 * c.CHUNK_SIZE // 1024)
+
+
+class RangeReadBenchmark(_ClientBenchmark):
+    def _pieces(self, size: int):
+        for _ in range(size // c.CHUNK_SIZE):
+            yield crypto.SecureRandom(c.CHUNK_SIZE)
+
+    def test_random_reads(self):
+        """
+        Reports the latency of random 4 KiB reads as the file grows.  Run
+        with DROPBOX_BENCH_SCALE=16 for a 1 GiB file.
+        """
+        rng = random.Random(1660)
+        u = c.create_user("usr", "pswd")
+
+        rows = []
+        for mb in [4, 16, 64 * SCALE]:
+            size = mb * 1024 * 1024
+            u.upload_stream("big", self._pieces(size))
+
+            # A fresh session per size, so pages are only cached once read
+            reader = c.authenticate_user("usr", "pswd")
+            times = []
+            for _ in range(50):
+                offset = rng.randrange(size - 4096)
+                start = time.perf_counter()
+                self.assertEqual(len(reader.download_range("big", offset, 4096)), 4096)
+                times.append(time.perf_counter() - start)
+
+            times.sort()
+            rows.append([mb, times[len(times) // 2] * 1000, times[-1] * 1000])
+
+        _report("download_range: random 4 KiB reads",
+                ["file MiB", "p50 ms", "max ms"], rows)
+
+        # Reads cost a chunk or two, not the whole file
+        self.assertLess(rows[-1][1], 10 * rows[0][1] + 5)
+
+
+class RevokeBenchmark(_ClientBenchmark):
+    def _pieces(self, size: int):
+        for i in range(0, size, c.CHUNK_SIZE):
+            yield crypto.SecureRandom(min(c.CHUNK_SIZE, size - i))
+
+    def test_revoke_flat(self):
+        """
+        Reports the cost of revoking a recipient as the file grows.  Run
+        with DROPBOX_BENCH_SCALE=64 for a 1 GiB file.
+        """
+        u = c.create_user("usr", "pswd")
+        for name in ["kept", "revoked"]:
+            c.create_user(name, "pswd")
+
+        rows = []
+        for size in [1024, 1024 * 1024, 16 * SCALE * 1024 * 1024]:
+            u.upload_stream("big", self._pieces(size))
+            u.share_file("big", "kept")
+            u.share_file("big", "revoked")
+
+            before = self.ds.bytes_written
+            start = time.perf_counter()
+            u.revoke_file("big", "revoked")
+            elapsed = time.perf_counter() - start
+            rows.append([size // 1024, self.ds.bytes_written - before, elapsed * 1000])
+
+        _report("revoke_file", ["file KiB", "bytes written", "ms"], rows)
+
+        # Only the header, pointer and remaining branch records are rewritten
+        self.assertLess(rows[-1][1], 10 * rows[0][1])
+
+
+class SharingBenchmark(_ClientBenchmark):
+    def test_fan_out(self):
+        """
+        Reports the cost of sharing one file with many recipients, and of
+        their first and later downloads.  Run with DROPBOX_BENCH_SCALE=50
+        for 1,000 recipients.
+        """
+        owner = c.create_user("owner", "pswd")
+        owner.upload_file("file1", crypto.SecureRandom(64 * 1024))
+        count = 20 * SCALE
+        users = [c.create_user(f"usr{i}", "pswd") for i in range(count)]
+
+        def timed(users, func):
+            start = time.perf_counter()
+            for u in users:
+                func(u)
+            return (time.perf_counter() - start) / count * 1000
+
+        rows = [["share", timed(users, lambda u: owner.share_file("file1", u.username))],
+                ["receive", timed(users, lambda u: u.receive_file("file1", "owner"))]]
+
+        # Fresh sessions, so that nothing is cached
+        readers = [c.authenticate_user(u.username, "pswd") for u in users]
+        rows.append(["first download", timed(readers, lambda u: u.download_file("file1"))])
+        rows.append(["download", timed(readers, lambda u: u.download_file("file1"))])
+        _report(f"sharing with {count} recipients", ["operation", "ms each"], rows)
+
+        # Bytes written by each share as recipients accumulate, using
+        # recipients that only have a public key.  Each window covers
+        # every fill level of the last share table page once.
+        pk, _ = crypto.AsymmetricKeyGen()
+        window = c.SHARE_PAGE_ENTRIES
+        rows = []
+        for w in range(4 * SCALE):
+            before = self.ds.bytes_written
+            for i in range(window):
+                name = f"key{w * window + i:06d}"
+                keyserver.Set(f"{name}/enc", pk)
+                owner.share_file("file1", name)
+            rows.append([count + w * window, (self.ds.bytes_written - before) // window])
+        _report("bytes written per share", ["recipients before", "bytes each"], rows)
+
+        # A share copies at most one table page, whatever the number of
+        # recipients
+        self.assertLessEqual(rows[-1][1], rows[0][1] * 1.1)
+
+    def test_depth(self):
+        """
+        Reports the cost of resolving a file shared through a chain of
+        recipients, before and after the route is cached.
+        """
+        depth = 8
+        users = [c.create_user(f"usr{i}", "pswd") for i in range(depth + 1)]
+        users[0].upload_file("file1", b'data')
+
+        rows = []
+        for i in range(1, depth + 1):
+            users[i - 1].share_file("file1", users[i].username)
+            users[i].receive_file("file1", users[i - 1].username)
+
+            reader = c.authenticate_user(users[i].username, "pswd")
+            start = time.perf_counter()
+            reader.download_file("file1")
+            first = time.perf_counter() - start
+            start = time.perf_counter()
+            reader.download_file("file1")
+            cached = time.perf_counter() - start
+            rows.append([i, first * 1000, cached * 1000])
+
+        _report("sharing depth", ["depth", "first ms", "cached ms"], rows)
+
+
+class HybridBenchmark(unittest.TestCase):
+    def test_multi_recipient(self):
+        """
+        Compares encrypting one payload for several recipients with RSA in
+        126-byte pieces, with one hybrid ciphertext each, and with one
+        shared hybrid body.
+        """
+        recipients = 8
+        keys = [crypto.AsymmetricKeyGen()[0] for _ in range(recipients)]
+        data = crypto.SecureRandom(16 * 1024)
+
+        def rsa_pieces():
+            return [[crypto.AsymmetricEncrypt(pk, data[i:i + 126])
+                     for i in range(0, len(data), 126)] for pk in keys]
+
+        def hybrid_each():
+            return [crypto.HybridEncrypt(pk, data) for pk in keys]
+
+        def hybrid_multi():
+            wrapped, body = crypto.HybridEncryptMulti(keys, data)
+            return wrapped + [body]
+
+        rows = []
+        for name, func in [("RSA pieces", rsa_pieces), ("hybrid each", hybrid_each),
+                           ("hybrid multi", hybrid_multi)]:
+            start = time.perf_counter()
+            for _ in range(SCALE):
+                out = func()
+            elapsed = (time.perf_counter() - start) / SCALE
+            size = sum(len(x) if isinstance(x, bytes) else sum(map(len, x)) for x in out)
+            rows.append([name, elapsed * 1000, size // 1024])
+
+        _report(f"encrypting {len(data) // 1024} KiB for {recipients} recipients",
+                ["scheme", "ms", "KiB stored"], rows)
+
+        self.assertLess(rows[2][2], rows[1][2])
+
+
+class AuthenticatedEncryptionBenchmark(unittest.TestCase):
+    def test_aead_vs_cbc_hmac(self):
+        """
+        Compares one-pass AEAD with AES-CBC followed by HMAC, over 64 KiB
+        chunks.
+        """
+        key = crypto.SecureRandom(16)
+        mac_key = crypto.SecureRandom(16)
+        chunk = crypto.SecureRandom(c.CHUNK_SIZE)
+        count = 128 * SCALE
+        size = count * len(chunk) / 2**20
+
+        def cbc_hmac():
+            ct = crypto.SymmetricEncrypt(key, crypto.SecureRandom(16), chunk)
+            return ct + crypto.HMAC(mac_key, ct)
+
+        def cbc_hmac_open(ct):
+            if not crypto.HMACEqual(crypto.HMAC(mac_key, ct[:-64]), ct[-64:]):
+                raise ValueError
+            return crypto.SymmetricDecrypt(key, ct[:-64])
+
+        def aead():
+            return crypto.AuthenticatedEncrypt(key, crypto.SecureRandom(12), chunk, b'addr')
+
+        def aead_open(ct):
+            return crypto.AuthenticatedDecrypt(key, ct, b'addr')
+
+        rows = []
+        for name, seal, unseal in [("CBC+HMAC", cbc_hmac, cbc_hmac_open),
+                                   (crypto.AEAD_ALGORITHM, aead, aead_open)]:
+            start = time.perf_counter()
+            for _ in range(count):
+                ct = seal()
+            enc = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(count):
+                self.assertEqual(unseal(ct), chunk)
+            dec = time.perf_counter() - start
+            rows.append([name, size / enc, size / dec])
+
+        _report("authenticated encryption of 64 KiB chunks",
+                ["scheme", "seal MiB/s", "open MiB/s"], rows)
+
+
+class StreamingHashBenchmark(unittest.TestCase):
+    def _peak(self, func):
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        digest = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return digest, peak
+
+    def test_peak_memory(self):
+        """
+        Compares the peak memory of MACing a header followed by a large
+        body by joining them with MACing them in place, and of MACing a
+        stream of pieces by joining it with MACing it as it flows.
+        """
+        key = crypto.SecureRandom(16)
+        header = crypto.SecureRandom(4096)
+        body = crypto.SecureRandom(16 * SCALE * 1024 * 1024)
+        piece = c.CHUNK_SIZE
+
+        def joined():
+            return crypto.HMAC(key, header + body)
+
+        def in_place():
+            ctx = crypto.HMACContext(key)
+            ctx.update(header)
+            ctx.update(body)
+            return ctx.finalize()
+
+        def stream_joined():
+            view = memoryview(body)
+            return crypto.HMAC(key, b"".join(bytes(view[i:i + piece])
+                                             for i in range(0, len(body), piece)))
+
+        def stream_flowing():
+            view = memoryview(body)
+            ctx = crypto.HMACContext(key)
+            for i in range(0, len(body), piece):
+                ctx.update(view[i:i + piece])
+            return ctx.finalize()
+
+        rows = []
+        results = {}
+        for name, func in [("joined", joined), ("HMACContext", in_place),
+                           ("stream joined", stream_joined), ("stream HMACContext", stream_flowing)]:
+            results[name], peak = self._peak(func)
+            rows.append([name, peak // 1024])
+
+        _report(f"MAC of a {len(body) // 2**20} MiB body: peak memory",
+                ["method", "peak KiB"], rows)
+
+        self.assertEqual(results["joined"], results["HMACContext"])
+        self.assertEqual(results["stream joined"], results["stream HMACContext"])
+        self.assertLess(rows[1][1], rows[0][1] // 100)
+        self.assertLess(rows[3][1], rows[2][1] // 100)
+
+
+class ZeroCopyBenchmark(unittest.TestCase):
+    def _allocated(self, func):
+        """
+        Run func and return the most memory it allocated at once, less
+        the size of its result.
+        """
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak - len(result)
+
+    def test_hot_path_copies(self):
+        """
+        Reports the memory allocated beyond the output when decrypting
+        values read from a LogBackend, which returns memoryviews, with
+        and without copying them to bytes first, and when uploading and
+        downloading through the client.
+        """
+        size = 16 * SCALE * 1024 * 1024
+        key = crypto.SecureRandom(16)
+        data = crypto.SecureRandom(size)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = LogBackend(os.path.join(tmp, "data.log"))
+            ds = Dataserver(backend)
+            m_aead, m_cbc = memloc.Make(), memloc.Make()
+            ds.SetMany({m_aead: crypto.AuthenticatedEncrypt(key, key[:12], data),
+                        m_cbc: crypto.SymmetricEncrypt(key, key, data)})
+
+            rows = []
+            for name, func in [
+                    ("AEAD, bytes()", lambda: crypto.AuthenticatedDecrypt(key, bytes(ds.Get(m_aead)))),
+                    ("AEAD, view", lambda: crypto.AuthenticatedDecrypt(key, ds.Get(m_aead))),
+                    ("CBC, bytes()", lambda: crypto.SymmetricDecrypt(key, bytes(ds.Get(m_cbc)))),
+                    ("CBC, view", lambda: crypto.SymmetricDecrypt(key, ds.Get(m_cbc)))]:
+                rows.append([name, self._allocated(func) // 1024])
+
+            orig = c.dataserver
+            c.dataserver = ds
+            try:
+                u = c.create_user("usr", "pswd")
+                rows.append(["upload_file", self._allocated(
+                    lambda: u.upload_file("big", data) or b"") // 1024])
+                rows.append(["download_file", self._allocated(
+                    lambda: u.download_file("big")) // 1024])
+            finally:
+                c.dataserver = orig
+                backend.close()
+
+        _report(f"memory allocated beyond the output, {size // 2**20} MiB value",
+                ["operation", "KiB"], rows)
+
+        # Reading through a view avoids a copy of the whole input
+        self.assertLess(rows[1][1], rows[0][1] - size // 2048)
+        self.assertLess(rows[3][1], rows[2][1] - size // 2048)
+
+
+class LatencyDataserver(Dataserver):
+    """
+    A Dataserver that waits a fixed time in every call, like a remote
+    store would.  The wait releases the GIL, so calls from several
+    threads overlap.
+    """
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+
+    def _wait(self) -> None:
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def Set(self, memloc, val):
+        self._wait()
+        return super().Set(memloc, val)
+
+    def Get(self, memloc):
+        self._wait()
+        return super().Get(memloc)
+
+    def Delete(self, memloc):
+        self._wait()
+        return super().Delete(memloc)
+
+    def GetMany(self, memlocs):
+        self._wait()
+        return super().GetMany(memlocs)
+
+    def SetMany(self, mapping):
+        self._wait()
+        return super().SetMany(mapping)
+
+    def DeleteMany(self, memlocs):
+        self._wait()
+        return super().DeleteMany(memlocs)
+
+    def GetVersioned(self, memloc):
+        self._wait()
+        return super().GetVersioned(memloc)
+
+    def SetIfVersion(self, memloc, val, expected_version):
+        self._wait()
+        return super().SetIfVersion(memloc, val, expected_version)
+
+
+class AsyncUserBenchmark(unittest.TestCase):
+    def setUp(self):
+        keyserver.Clear()
+        self.ds = LatencyDataserver(0.01)
+        self._orig_ds = c.dataserver
+        c.dataserver = self.ds
+
+    def tearDown(self):
+        c.dataserver = self._orig_ds
+
+    def test_latency_bound_transfers(self):
+        """
+        Reports upload and download times of User and AsyncUser on a
+        dataserver with 10 ms per call.  User makes one call per batch
+        of chunks in turn; AsyncUser overlaps them.
+        """
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 64 * SCALE)
+        u = c.create_user("usr", "pswd")
+
+        def timed(func):
+            calls = self.ds.calls
+            start = time.perf_counter()
+            func()
+            return time.perf_counter() - start, self.ds.calls - calls
+
+        async def timed_async(coro):
+            calls = self.ds.calls
+            start = time.perf_counter()
+            await coro
+            return time.perf_counter() - start, self.ds.calls - calls
+
+        rows = []
+        t_up, _ = timed(lambda: u.upload_file("sync", data))
+        t_down, n_down = timed(lambda: u.download_file("sync"))
+        rows.append(["User", "-", t_up * 1e3, t_down * 1e3, n_down])
+
+        async def run(concurrency: int) -> None:
+            async with c.AsyncUser(u, concurrency=concurrency) as a:
+                name = f"async{concurrency}"
+                t_up, _ = await timed_async(a.upload_file(name, data))
+                t_down, n_down = await timed_async(a.download_file(name))
+            rows.append(["AsyncUser", concurrency, t_up * 1e3, t_down * 1e3, n_down])
+
+        for concurrency in [1, 4, 16]:
+            asyncio.run(run(concurrency))
+            self.assertEqual(u.download_file(f"async{concurrency}"), data)
+
+        _report(f"{len(data) // 1024} KiB file, 10 ms per dataserver call",
+                ["client", "concurrency", "upload ms", "download ms", "calls"], rows)
+
+        # Downloads overlap their calls, so they take fewer round trips
+        self.assertLess(rows[-1][3], rows[0][3])
+
+
+class ThreadScalingBenchmark(unittest.TestCase):
+    def test_striped_locks(self):
+        """
+        Reports the throughput of 1 KiB Gets and Sets on one Dataserver
+        shared by several threads, without locking, with a single lock
+        and with 16 striped locks.
+        """
+        total = 8000 * SCALE
+        rows = []
+        for stripes in [0, 1, 16]:
+            for threads in [1, 2, 4, 8]:
+                stats = load_test(Dataserver(stripes=stripes), threads, total // threads)
+                rows.append([stripes, threads, int(stats["ops_per_sec"]),
+                             stats["p50"] * 1e6, stats["p99"] * 1e6])
+
+        _report(f"shared Dataserver, 1 KiB values, 50% reads, {os.cpu_count()} CPUs",
+                ["stripes", "threads", "ops/sec", "p50 us", "p99 us"], rows)
+
+        for row in rows:
+            self.assertGreater(row[2], 0)
+
+
+class ContentionBenchmark(unittest.TestCase):
+    def setUp(self):
+        keyserver.Clear()
+        self.ds = LatencyDataserver(0.001)
+        self._orig_ds = c.dataserver
+        c.dataserver = self.ds
+
+    def tearDown(self):
+        c.dataserver = self._orig_ds
+
+    def test_concurrent_appends(self):
+        """
+        Reports the throughput of sessions of one user appending to the
+        same file at once, on a dataserver with 1 ms per call, and how
+        often an append had to be retried.
+        """
+        c.create_user("usr", "pswd")
+        appends = 6 * SCALE
+        rows = []
+        for sessions in [1, 2, 4, 8, 16]:
+            users = [c.authenticate_user("usr", "pswd") for _ in range(sessions)]
+            name = f"log{sessions}"
+            users[0].upload_file(name, b'')
+
+            conflicts = []
+            orig = self.ds.SetIfVersion
+
+            def counting(*args):
+                try:
+                    return orig(*args)
+                except c.VersionConflict:
+                    conflicts.append(1)
+                    raise
+
+            self.ds.SetIfVersion = counting
+            threads = [threading.Thread(target=lambda u=u: [
+                u.append_file(name, crypto.SecureRandom(1024)) for _ in range(appends)])
+                for u in users]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            del self.ds.SetIfVersion
+
+            total = sessions * appends
+            self.assertEqual(len(users[0].download_file(name)), total * 1024)
+            rows.append([sessions, total, int(total / elapsed), len(conflicts) / total])
+
+        _report("sessions appending 1 KiB to one file, 1 ms per dataserver call",
+                ["sessions", "appends", "appends/sec", "retries each"], rows)
+
+
+class SerialDataserver(LatencyDataserver):
+    """
+    A LatencyDataserver that serves one call at a time, like a single
+    server with a fixed capacity.
+    """
+    def __init__(self, latency: float):
+        super().__init__(latency)
+        self._serial = threading.Lock()
+
+    def _wait(self) -> None:
+        with self._serial:
+            super()._wait()
+
+
+class ShardingBenchmark(unittest.TestCase):
+    def test_shard_scaling(self):
+        """
+        Reports aggregate throughput of 16 threads making 1 KiB Gets and
+        Sets, the latency of a 64-memloc GetMany, and the share of
+        memlocs moved when one more shard is added, for 1 to 8 shards
+        that each serve one call at a time at 0.5 ms per call.
+        """
+        ops = 64 * SCALE
+        rows = []
+        for n in [1, 2, 4, 8]:
+            ds = ShardedDataserver([SerialDataserver(0.0005) for _ in range(n)])
+            stats = load_test(ds, 16, ops)
+
+            locs = [memloc.Make() for _ in range(64)]
+            ds.SetMany({m: bytes(1024) for m in locs})
+            start = time.perf_counter()
+            for _ in range(10):
+                ds.GetMany(locs)
+            batch = (time.perf_counter() - start) / 10
+
+            stored = len(ds.GetMap())
+            ds.add_shard(SerialDataserver(0.0005))
+            start = time.perf_counter()
+            ds.wait_rebalanced()
+            rebalance = time.perf_counter() - start
+            ds.close()
+
+            rows.append([n, int(stats["ops_per_sec"]), stats["p99"] * 1e3,
+                         batch * 1e3, ds.moved / stored, rebalance * 1e3])
+
+        _report("sharded dataserver, 16 threads, 0.5 ms per call, one call at a time per shard",
+                ["shards", "ops/sec", "p99 ms", "GetMany ms", "moved on add", "rebalance ms"], rows)
+
+        # Shards serve calls side by side, and adding one moves about 1/(n+1)
+        self.assertGreater(rows[-1][1], rows[0][1])
+        for row in rows:
+            self.assertLess(row[4], 2 / (row[0] + 1))
+
+
+class NetServiceBenchmark(unittest.TestCase):
+    def setUp(self):
+        # Run the server in its own process, as a deployment would
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "support.netserver", "serve", "--port", "0"],
+            stdout=subprocess.PIPE, text=True)
+        host, port = self.proc.stdout.readline().split()[-1].rsplit(":", 1)
+        self.address = (host, int(port))
+
+    def tearDown(self):
+        self.proc.terminate()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+    def test_load(self):
+        """
+        Reports throughput and latency of 1 KiB Gets and Sets on a
+        localhost server as the number of client threads grows, with and
+        without pipelining.
+        """
+        ops = 256 * SCALE
+        rows = []
+        for depth in [1, 16]:
+            for threads in [1, 2, 4, 8, 16]:
+                ds, _ = connect(self.address, pool_size=threads)
+                stats = load_test(ds, threads, ops, depth=depth)
+                ds.client.close()
+                rows.append([threads, depth, int(stats["ops_per_sec"]),
+                             stats["p50"] * 1e3, stats["p99"] * 1e3])
+
+        _report("localhost service, 1 KiB values, 50% reads",
+                ["threads", "pipeline", "ops/sec", "p50 ms", "p99 ms"], rows)
+
+        for row in rows:
+            self.assertGreater(row[2], 0)
+            self.assertLessEqual(row[3], row[4])
+
+
+if __name__ == '__main__':
+    util.start_repl(locals())
@@ -3,13 +3,18 @@
 ##
 ##
 
+import asyncio
+import os
+import sys
+import tempfile
+import threading
 import unittest
 import string
 
 import support.crypto as crypto
 import support.util as util
 
-from support.dataserver import dataserver, memloc
+from support.dataserver import Dataserver, LogBackend, dataserver, memloc
 from support.keyserver import keyserver
 
 # Import your client
@@ -72,6 +77,129 @@ class ClientTests(unittest.TestCase):
 
         self.assertEqual(down_data, b'shared data')
 
+    def test_share_writes_both_ways(self):
+        """
+        Checks that owner and recipient see each other's changes.
+        """
+        u1 = c.create_user("usr1", "pswd")
+        u2 = c.create_user("usr2", "pswd")
+        u1.upload_file("file1", b'v1')
+        u1.share_file("file1", "usr2")
+        u2.receive_file("file1", "usr1")
+
+        u2.append_file("file1", b' by usr2')
+        self.assertEqual(u1.download_file("file1"), b'v1 by usr2')
+        u1.upload_file("file1", b'v2')
+        self.assertEqual(u2.download_file("file1"), b'v2')
+        u2.upload_file("file1", b'v3')
+        self.assertEqual(u1.download_file("file1"), b'v3')
+
+    def test_reshare_tree(self):
+        """
+        Checks that recipients can share further, and that revoking a
+        direct recipient also cuts off everyone they shared with, but
+        nobody else.
+        """
+        owner = c.create_user("owner", "pswd")
+        a, b, a1, a2 = (c.create_user(name, "pswd") for name in ["a", "b", "a1", "a2"])
+        owner.upload_file("file1", b'data')
+        owner.share_file("file1", "a")
+        owner.share_file("file1", "b")
+        a.receive_file("file1", "owner")
+        b.receive_file("file1", "owner")
+        a.share_file("file1", "a1")
+        a1.receive_file("file1", "a")
+        a1.share_file("file1", "a2")
+        a2.receive_file("file1", "a1")
+        for u in [a, b, a1, a2]:
+            self.assertEqual(u.download_file("file1"), b'data')
+
+        owner.revoke_file("file1", "a")
+        owner.append_file("file1", b' more')
+        for u in [a, a1, a2]:
+            self.assertRaises(util.DropboxError, lambda: u.download_file("file1"))
+        # Uploading under the name makes a new file of their own
+        a1.upload_file("file1", b'x')
+        self.assertEqual(a1.download_file("file1"), b'x')
+        self.assertRaises(util.DropboxError, lambda: a2.download_file("file1"))
+        self.assertEqual(b.download_file("file1"), b'data more')
+        self.assertEqual(owner.download_file("file1"), b'data more')
+
+        # Sharing again gives access back
+        owner.share_file("file1", "a")
+        a.receive_file("file1", "owner")
+        self.assertEqual(a.download_file("file1"), b'data more')
+
+    def test_share_route_cache(self):
+        """
+        Checks that recipients only resolve their route once, and follow
+        the file after it moves on revocation.
+        """
+        owner = c.create_user("owner", "pswd")
+        a, b, a1 = (c.create_user(name, "pswd") for name in ["a", "b", "a1"])
+        owner.upload_file("file1", b'data')
+        for name in ["a", "b"]:
+            owner.share_file("file1", name)
+        a.receive_file("file1", "owner")
+        b.receive_file("file1", "owner")
+        a.share_file("file1", "a1")
+        a1.receive_file("file1", "a")
+
+        a1.download_file("file1")
+        misses = a1._routes.misses
+        a1.download_file("file1")
+        self.assertEqual(a1._routes.misses, misses)
+
+        owner.revoke_file("file1", "b")
+        owner.append_file("file1", b'!')
+        self.assertEqual(a1.download_file("file1"), b'data!')
+        self.assertRaises(util.DropboxError, lambda: b.download_file("file1"))
+
+    def test_share_errors(self):
+        """
+        Checks sharing with unknown users, receiving files that were not
+        shared, forged invitations and revocation by non-owners.
+        """
+        u1 = c.create_user("usr1", "pswd")
+        u2 = c.create_user("usr2", "pswd")
+        u3 = c.create_user("usr3", "pswd")
+        u1.upload_file("file1", b'data')
+
+        self.assertRaises(util.DropboxError, lambda: u1.share_file("file1", "nobody"))
+        self.assertRaises(util.DropboxError, lambda: u1.share_file("missing", "usr2"))
+        self.assertRaises(util.DropboxError, lambda: u2.receive_file("file1", "usr1"))
+        self.assertRaises(util.DropboxError, lambda: u2.receive_file("file1", "nobody"))
+
+        # usr3 cannot pass off an invitation as coming from usr1
+        u3.upload_file("file1", b'evil')
+        u3.share_file("file1", "usr2")
+        forged = dataserver.Get(c._invite_addr("usr3", "usr2", "file1"))
+        dataserver.Set(c._invite_addr("usr1", "usr2", "file1"), forged)
+        self.assertRaises(util.DropboxError, lambda: u2.receive_file("file1", "usr1"))
+
+        u2.upload_file("file1", b'mine')
+        u1.share_file("file1", "usr2")
+        self.assertRaises(util.DropboxError, lambda: u2.receive_file("file1", "usr1"))
+
+        u1.upload_file("file2", b'data')
+        u1.share_file("file2", "usr2")
+        u2.receive_file("file2", "usr1")
+        self.assertRaises(util.DropboxError, lambda: u2.revoke_file("file2", "usr1"))
+        self.assertEqual(u2.download_file("file2"), b'data')
+
+    def test_malformed_invitation(self):
+        """
+        Checks that invitations crafted to break the decoder are rejected
+        as invalid.
+        """
+        c.create_user("usr1", "pswd")
+        u2 = c.create_user("usr2", "pswd")
+        invite_addr = c._invite_addr("usr1", "usr2", "file1")
+
+        for blob in [b'\x01' + b'l\x01' * 100000 + b'N', b'\x01l' + b'\xff' * 9 + b'\x7f']:
+            dataserver.Set(invite_addr, blob)
+            self.assertRaises(util.DropboxError, lambda: u2.receive_file("file1", "usr1"))
+
     def test_download_error(self):
         """
         Simple test that tests that downloading a file that doesn't exist
@@ -83,6 +211,873 @@ class ClientTests(unittest.TestCase):
         #       error needs to be passed to `assertRaises` as a lambda function.
         self.assertRaises(util.DropboxError, lambda: u.download_file("file1"))
 
+    def test_authenticate_wrong_password(self):
+        """
+        Checks that a wrong password does not authenticate.
+        """
+        c.create_user("usr", "pswd")
+
+        self.assertRaises(util.DropboxError, lambda: c.authenticate_user("usr", "wrong"))
+        self.assertRaises(util.DropboxError, lambda: c.authenticate_user("nobody", "pswd"))
+
+    def test_iterations_stored_with_salt(self):
+        """
+        Checks that users keep authenticating after the work factor changes.
+        """
+        orig = crypto.PBKDF2_ITERATIONS
+        try:
+            crypto.PBKDF2_ITERATIONS = 1500
+            c.create_user("usr", "pswd")
+            crypto.PBKDF2_ITERATIONS = 2000
+
+            u = c.authenticate_user("usr", "pswd")
+            u.upload_file("file1", b'data')
+            self.assertEqual(u.download_file("file1"), b'data')
+        finally:
+            crypto.PBKDF2_ITERATIONS = orig
+
+    def test_create_duplicate_user(self):
+        """
+        Checks that a username cannot be registered twice.
+        """
+        c.create_user("usr", "pswd")
+
+        self.assertRaises(util.DropboxError, lambda: c.create_user("usr", "other"))
+
+    def test_concurrent_create_user(self):
+        """
+        Checks that of several registrations racing for one name, exactly
+        one succeeds and the others get a DropboxError.
+        """
+        start = threading.Barrier(4)
+        results = {}
+
+        def register(password):
+            start.wait()
+            try:
+                c.create_user("usr", password)
+                results[password] = "ok"
+            except util.DropboxError:
+                results[password] = "taken"
+
+        threads = [threading.Thread(target=register, args=(f"pswd{i}",)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        winners = [p for p, r in results.items() if r == "ok"]
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len(winners), 1)
+        u = c.authenticate_user("usr", winners[0])
+        u.upload_file("file1", b'data')
+        self.assertEqual(u.download_file("file1"), b'data')
+
+    def test_overwrite(self):
+        """
+        Checks that uploading to an existing filename replaces its contents.
+        """
+        u = c.create_user("usr", "pswd")
+
+        u.upload_file("file1", b'A' * (c.CHUNK_SIZE * 3))
+        u.upload_file("file1", b'short')
+
+        self.assertEqual(u.download_file("file1"), b'short')
+
+    def test_failed_upload(self):
+        """
+        Checks that a first upload whose data source fails leaves nothing
+        behind and does not block later uploads to the same name.
+        """
+        u = c.create_user("usr", "pswd")
+        base = len(dataserver.GetMap())
+
+        def pieces():
+            for _ in range(100):
+                yield crypto.SecureRandom(1024)
+            raise IOError("Source failed")
+
+        self.assertRaises(IOError, lambda: u.upload_stream("file1", pieces()))
+        self.assertEqual(len(dataserver.GetMap()), base)
+        self.assertRaises(util.DropboxError, lambda: u.download_file("file1"))
+
+        u.upload_file("file1", b'data')
+        self.assertEqual(u.download_file("file1"), b'data')
+
+        # A failed overwrite keeps the old contents
+        self.assertRaises(IOError, lambda: u.upload_stream("file1", pieces()))
+        self.assertEqual(u.download_file("file1"), b'data')
+
+    def test_upload_after_revoke(self):
+        """
+        Checks that a revoked recipient can upload its own file under the
+        name of the file it lost.
+        """
+        u1 = c.create_user("usr1", "pswd")
+        u2 = c.create_user("usr2", "pswd")
+        u1.upload_file("file1", b'shared')
+        u1.share_file("file1", "usr2")
+        u2.receive_file("file1", "usr1")
+        u1.revoke_file("file1", "usr2")
+
+        u2.upload_file("file1", b'mine')
+        self.assertEqual(u2.download_file("file1"), b'mine')
+        self.assertEqual(u1.download_file("file1"), b'shared')
+
+    def test_upload_over_tampered_header(self):
+        """
+        Checks that uploading over a file whose header was tampered with
+        fails rather than replacing the file and its shares.
+        """
+        u1 = c.create_user("usr1", "pswd")
+        u2 = c.create_user("usr2", "pswd")
+        u1.upload_file("file1", b'v1')
+        u1.share_file("file1", "usr2")
+        u2.receive_file("file1", "usr1")
+
+        meta_addr = u1._load_pointer("file1")["meta"]
+        blob = bytearray(dataserver.Get(meta_addr))
+        blob[0] ^= 1
+        dataserver.Set(meta_addr, bytes(blob))
+        u1._cache.clear()
+
+        self.assertRaises(util.DropboxError, lambda: u1.upload_file("file1", b'v2'))
+        self.assertIn("shares", u1._load_pointer("file1"))
+        self.assertRaises(util.DropboxError, lambda: u2.receive_file("file1", "usr1"))
+
+    def test_append(self):
+        """
+        Checks that appended data is returned after the original data.
+        """
+        u = c.create_user("usr", "pswd")
+
+        u.upload_file("file1", b'first ')
+        u.append_file("file1", b'second ')
+        u.append_file("file1", b'third')
+
+        self.assertEqual(u.download_file("file1"), b'first second third')
+
+    def test_append_across_pages(self):
+        """
+        Checks appends that fill several chunks and index pages.
+        """
+        u = c.create_user("usr", "pswd")
+        expected = b''
+
+        u.upload_file("file1", expected)
+        for i in range(c.PAGE_ENTRIES + 5):
+            piece = bytes([i % 256]) * (i * 7)
+            u.append_file("file1", piece)
+            expected += piece
+        u.append_file("file1", b'x' * (c.CHUNK_SIZE * 2 + 1))
+        expected += b'x' * (c.CHUNK_SIZE * 2 + 1)
+
+        self.assertEqual(u.download_file("file1"), expected)
+        self.assertEqual(c.authenticate_user("usr", "pswd").download_file("file1"), expected)
+
+    def test_index_tree(self):
+        """
+        Checks reads, appends and overwrites of a file whose index tree
+        has several levels, and that an append only copies the path to
+        the last page.
+        """
+        orig = c.PAGE_ENTRIES, c.NODE_ENTRIES
+        c.PAGE_ENTRIES, c.NODE_ENTRIES = 2, 3
+        try:
+            u = c.create_user("usr", "pswd")
+            pieces = [bytes([i]) * (i + 1) for i in range(60)]
+            u.upload_file("file1", b'')
+            for piece in pieces:
+                replaced = len(dataserver.GetMap())
+                u.append_file("file1", piece)
+                # One chunk and one page or node per level at most were added
+                header = u._open("file1")[2]
+                self.assertLessEqual(len(dataserver.GetMap()) - replaced, 2 + header["depth"])
+            data = b''.join(pieces)
+            self.assertGreaterEqual(header["depth"], 3)
+
+            u2 = c.authenticate_user("usr", "pswd")
+            self.assertEqual(u2.download_file("file1"), data)
+            for i, piece in enumerate(pieces):
+                self.assertEqual(u2.download_chunk("file1", i), piece)
+            self.assertRaises(util.DropboxError, lambda: u2.download_chunk("file1", 60))
+            for offset, length in [(0, 1), (5, 100), (900, 500), (1820, 100)]:
+                self.assertEqual(u2.download_range("file1", offset, length),
+                                 data[offset:offset + length])
+
+            # A chunk is checked through the nodes above it
+            refs, nodes = u2._index_refs(header)
+            self.assertGreater(len(nodes), 3)
+            dataserver.Set(nodes[-1][0], dataserver.Get(nodes[-2][0]))
+            u3 = c.authenticate_user("usr", "pswd")
+            self.assertRaises(util.DropboxError, lambda: u3.download_chunk("file1", 59))
+            self.assertEqual(u3.download_chunk("file1", 0), pieces[0])
+
+            u.upload_file("file1", data[:1000])
+            self.assertEqual(u3.download_file("file1"), data[:1000])
+        finally:
+            c.PAGE_ENTRIES, c.NODE_ENTRIES = orig
+
+    def test_append_missing_file(self):
+        """
+        Checks that appending to a file that doesn't exist raises an error.
+        """
+        u = c.create_user("usr", "pswd")
+
+        self.assertRaises(util.DropboxError, lambda: u.append_file("file1", b'data'))
+
+    def test_append_tampered_chunk(self):
+        """
+        Checks that modifying any stored value is detected on download.
+        """
+        u = c.create_user("usr", "pswd")
+        u.upload_file("file1", b'original data')
+        before = dict(dataserver.GetMap())
+
+        u.append_file("file1", b' and more')
+        for loc, val in dataserver.GetMap().items():
+            if before.get(loc) != val:
+                continue
+            dataserver.Set(loc, val[:-1] + bytes([val[-1] ^ 1]))
+
+        self.assertRaises(util.DropboxError, lambda: u.download_file("file1"))
+
+    def test_upload_stream(self):
+        """
+        Checks that a streamed upload can be downloaded in one piece, no
+        matter how the input pieces line up with chunk boundaries.
+        """
+        u = c.create_user("usr", "pswd")
+        pieces = [b'a' * 10, b'b' * c.CHUNK_SIZE, bytearray(b'c' * (c.CHUNK_SIZE + 3)),
+                  memoryview(b'd' * c.CHUNK_SIZE), b'', b'e']
+
+        u.upload_stream("file1", iter(pieces))
+
+        self.assertEqual(u.download_file("file1"), b''.join(bytes(p) for p in pieces))
+
+    def test_download_stream(self):
+        """
+        Checks that a streamed download yields the file in chunk-sized pieces.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 2 + 100)
+
+        u.upload_file("file1", data)
+        pieces = list(u.download_stream("file1"))
+
+        self.assertEqual(b''.join(pieces), data)
+        self.assertTrue(all(len(p) <= c.CHUNK_SIZE for p in pieces))
+        self.assertRaises(util.DropboxError, lambda: u.download_stream("missing"))
+
+    def test_parallel_workers(self):
+        """
+        Checks that chunk crypto on several threads keeps chunks in order.
+        """
+        u = c.create_user("usr", "pswd")
+        u.workers = 4
+        data = crypto.SecureRandom(c.CHUNK_SIZE * (c.BATCH_CHUNKS + 7) + 5)
+
+        u.upload_file("file1", data)
+        u.append_file("file1", data[:c.CHUNK_SIZE * 3])
+
+        self.assertEqual(u.download_file("file1"), data + data[:c.CHUNK_SIZE * 3])
+        u.workers = 1
+        self.assertEqual(u.download_file("file1"), data + data[:c.CHUNK_SIZE * 3])
+
+    def test_parallel_tamper(self):
+        """
+        Checks that errors from worker threads reach the caller.
+        """
+        u = c.create_user("usr", "pswd")
+        u.workers = 4
+        u.upload_file("file1", crypto.SecureRandom(c.CHUNK_SIZE * 4))
+
+        loc, val = max(dataserver.GetMap().items(), key=lambda kv: len(kv[1]))
+        dataserver.Set(loc, val[:-1] + bytes([val[-1] ^ 1]))
+
+        self.assertRaises(util.DropboxError, lambda: u.download_file("file1"))
+
+    def test_dedup_overwrite(self):
+        """
+        Checks that overwriting a file with an edited version only stores
+        the chunks around the edit, and frees the chunks that are gone.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 32)
+        base = len(dataserver.GetMap())
+        u.upload_file("file1", data)
+
+        edited = data[:100000] + b'inserted' + data[100000:300000] + data[300100:]
+        u.upload_stats = dict.fromkeys(u.upload_stats, 0)
+        u.upload_file("file1", edited)
+
+        self.assertEqual(u.download_file("file1"), edited)
+        self.assertGreater(u.upload_stats["reused"], 0)
+        self.assertGreater(u.upload_stats["bytes_saved"], len(edited) // 2)
+
+        # Only the pointer, header, pages, nodes and current chunks are left
+        header = u._open("file1")[2]
+        refs, nodes = u._index_refs(header)
+        pages = u._load_pages(header, refs)
+        chunks = {e[0] for page in pages for e in page}
+        self.assertEqual(len(dataserver.GetMap()), base + 2 + len(pages) + len(nodes) + len(chunks))
+
+        u.upload_file("file1", b'small')
+        self.assertEqual(u.download_file("file1"), b'small')
+        # pointer, header, one page and one chunk
+        self.assertEqual(len(dataserver.GetMap()), base + 4)
+
+    def test_dedup_repeated_chunks(self):
+        """
+        Checks that repeated contents within a file are stored once, and
+        that chunking does not depend on how the input is split up.
+        """
+        u = c.create_user("usr", "pswd")
+        block = crypto.SecureRandom(c.CHUNK_SIZE * 2)
+        data = block * 4
+
+        u.upload_stream("file1", (data[i:i + 1000] for i in range(0, len(data), 1000)))
+        self.assertEqual(u.download_file("file1"), data)
+        self.assertGreater(u.upload_stats["reused"], 0)
+
+        u.upload_file("file2", data)
+        self.assertEqual(u.download_file("file2"), data)
+
+    def test_download_chunk(self):
+        """
+        Checks that single chunks can be downloaded and checked by index.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 40)
+        u.upload_file("file1", data)
+
+        pieces = list(u.download_stream("file1"))
+        for i in [0, 1, len(pieces) // 2, len(pieces) - 1]:
+            self.assertEqual(u.download_chunk("file1", i), pieces[i])
+
+        self.assertRaises(util.DropboxError, lambda: u.download_chunk("file1", len(pieces)))
+        self.assertRaises(util.DropboxError, lambda: u.download_chunk("file1", -1))
+        self.assertRaises(util.DropboxError, lambda: u.download_chunk("missing", 0))
+
+    def test_download_range(self):
+        """
+        Checks that ranges are read correctly wherever they fall relative to
+        chunk and page boundaries.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 60 + 123)
+        u.upload_file("file1", data)
+        u.append_file("file1", b'tail')
+        data += b'tail'
+
+        ranges = [(0, 10), (0, len(data)), (c.CHUNK_SIZE - 5, 10), (len(data) - 3, 3),
+                  (len(data) - 3, 100), (len(data), 5), (len(data) + 10, 5), (12345, 0),
+                  (c.CHUNK_SIZE * 7 + 1, c.CHUNK_SIZE * 50)]
+        for offset, length in ranges:
+            self.assertEqual(u.download_range("file1", offset, length),
+                             data[offset:offset + length])
+
+        self.assertRaises(util.DropboxError, lambda: u.download_range("file1", -1, 5))
+        self.assertRaises(util.DropboxError, lambda: u.download_range("missing", 0, 5))
+
+    def test_download_range_reads_covering_chunks(self):
+        """
+        Checks that a range read only fetches the chunks that cover it.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 20)
+        u.upload_file("file1", data)
+
+        # Corrupt every chunk but the first
+        header = u._open("file1")[2]
+        entries = [e for page in u._load_pages(header, u._index_refs(header)[0]) for e in page]
+        for entry in entries[1:]:
+            val = dataserver.Get(entry[0])
+            dataserver.Set(entry[0], val[:-1] + bytes([val[-1] ^ 1]))
+
+        self.assertEqual(u.download_range("file1", 10, 100), data[10:110])
+        self.assertRaises(util.DropboxError, lambda: u.download_file("file1"))
+
+    def test_overwrite_reuses_pages(self):
+        """
+        Checks that overwriting a file with a small edit near its end keeps
+        the index pages before the edit.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 200)
+        u.upload_file("file1", data)
+        before = u._index_refs(u._open("file1")[2])[0]
+
+        edited = data[:-1000] + b'edited' + data[-1000:]
+        u.upload_file("file1", edited)
+        after = u._index_refs(u._open("file1")[2])[0]
+
+        self.assertEqual(u.download_file("file1"), edited)
+        self.assertGreater(len(before), 1)
+        self.assertEqual(before[0], after[0])
+        self.assertNotEqual(before[-1], after[-1])
+        self.assertEqual(len(after[0][2]), 32)
+
+    def test_tampered_page(self):
+        """
+        Checks that replacing an index page with another page of the same
+        file is detected.
+        """
+        u = c.create_user("usr", "pswd")
+        u.upload_file("file1", crypto.SecureRandom(c.CHUNK_SIZE * 200))
+        refs = u._index_refs(u._open("file1")[2])[0]
+        self.assertGreater(len(refs), 1)
+
+        dataserver.Set(refs[0][0], dataserver.Get(refs[1][0]))
+        u2 = c.authenticate_user("usr", "pswd")
+        self.assertRaises(util.DropboxError, lambda: u2.download_file("file1"))
+        self.assertRaises(util.DropboxError, lambda: u2.download_chunk("file1", 0))
+
+    def test_rotate_keys(self):
+        """
+        Checks that rotating a file's keys keeps it readable and writable
+        without rewriting any chunk.
+        """
+        u = c.create_user("usr", "pswd")
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 3)
+        u.upload_file("file1", data)
+        old_meta, old_kek, _, _ = u._open("file1")
+        before = dataserver.GetMap()
+
+        u._rotate_keys("file1", *u._load_pointer_versioned("file1"))
+        meta, kek, header, _ = u._open("file1")
+        after = dataserver.GetMap()
+
+        self.assertNotEqual(meta, old_meta)
+        self.assertNotEqual(kek, old_kek)
+        self.assertEqual(len(header["keys"]), 2)
+        self.assertNotIn(old_meta, after)
+        for loc, val in before.items():
+            if loc != old_meta and loc != u._file_addr("file1"):
+                self.assertEqual(after[loc], val)
+
+        u.append_file("file1", b'more')
+        self.assertEqual(u.download_file("file1"), data + b'more')
+        u.upload_file("file1", data)
+        self.assertEqual(u.download_file("file1"), data)
+
+        u2 = c.authenticate_user("usr", "pswd")
+        self.assertEqual(u2.download_file("file1"), data)
+
+    def test_revoke_errors(self):
+        """
+        Checks that revoking a missing file or a user the file was never
+        shared with fails.
+        """
+        u = c.create_user("usr", "pswd")
+        c.create_user("usr2", "pswd")
+        u.upload_file("file1", b'data')
+
+        self.assertRaises(util.DropboxError, lambda: u.revoke_file("missing", "usr2"))
+        self.assertRaises(util.DropboxError, lambda: u.revoke_file("file1", "usr2"))
+        self.assertEqual(u.download_file("file1"), b'data')
+
+    def test_log_backend(self):
+        """
+        Checks the client against a dataserver that returns memoryviews.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = LogBackend(os.path.join(tmp, "data.log"))
+            orig = c.dataserver
+            c.dataserver = Dataserver(backend)
+            try:
+                u1 = c.create_user("usr1", "pswd")
+                u2 = c.create_user("usr2", "pswd")
+                data = crypto.SecureRandom(c.CHUNK_SIZE * 5 + 7)
+                u1.upload_file("file1", data)
+                u1.append_file("file1", b'tail')
+                u1.share_file("file1", "usr2")
+                u2.receive_file("file1", "usr1")
+
+                u3 = c.authenticate_user("usr2", "pswd")
+                self.assertEqual(u3.download_file("file1"), data + b'tail')
+                self.assertEqual(u3.download_range("file1", 100, 1000), data[100:1100])
+                self.assertEqual(u3.download_chunk("file1", 0), data[:len(u3.download_chunk("file1", 0))])
+            finally:
+                c.dataserver = orig
+                backend.close()
+
+    def test_async_user(self):
+        """
+        Checks that AsyncUser reads and writes the same files as User.
+        """
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 40)
+
+        async def run():
+            async with await c.async_create_user("usr1", "pswd", concurrency=4, workers=2) as a1:
+                await a1.upload_file("file1", data)
+                self.assertEqual(await a1.download_file("file1"), data)
+                await a1.append_file("file1", b'tail')
+                u2 = c.create_user("usr2", "pswd")
+                await a1.share_file("file1", "usr2")
+
+                async with c.AsyncUser(u2) as a2:
+                    await a2.receive_file("file1", "usr1")
+                    self.assertEqual(await a2.download_file("file1"), data + b'tail')
+                    self.assertEqual(await a2.download_range("file1", 10, 100), data[10:110])
+
+                    # Overwrite and download concurrently from two users
+                    await asyncio.gather(a1.upload_file("file2", b'two'),
+                                         a1.upload_file("file1", data[:1000]))
+                    self.assertEqual(await asyncio.gather(a1.download_file("file2"),
+                                                          a2.download_file("file1")),
+                                     [b'two', data[:1000]])
+
+                    await a1.revoke_file("file1", "usr2")
+                    with self.assertRaises(util.DropboxError):
+                        await a2.download_file("file1")
+
+            u1 = c.authenticate_user("usr1", "pswd")
+            self.assertEqual(u1.download_file("file1"), data[:1000])
+
+        asyncio.run(run())
+
+    def test_async_uploads_wait_for_own_writes(self):
+        """
+        Checks that concurrent uploads on one AsyncUser each store their
+        header only after their own records, and that a failed write only
+        fails the upload it belongs to.
+        """
+        import time
+
+        class SlowDataserver(Dataserver):
+            def __init__(self):
+                super().__init__()
+                self.fail_big = False
+                self.stored = {}   # memloc -> time its write finished
+                self.headers = {}  # memloc -> time a single write started
+
+            def SetMany(self, mapping):
+                time.sleep(0.01)
+                if self.fail_big and any(len(v) > 1024 for v in mapping.values()):
+                    raise ValueError("Write failed")
+                super().SetMany(mapping)
+                self.stored.update(dict.fromkeys(mapping, time.perf_counter()))
+
+            def Set(self, memloc, val):
+                self.headers[memloc] = time.perf_counter()
+                super().Set(memloc, val)
+
+            def SetIfVersion(self, memloc, val, expected_version):
+                self.headers[memloc] = time.perf_counter()
+                return super().SetIfVersion(memloc, val, expected_version)
+
+        orig = c.dataserver
+        ds = c.dataserver = SlowDataserver()
+        try:
+            async def run():
+                async with await c.async_create_user("usr", "pswd", concurrency=2) as a:
+                    await asyncio.gather(*(a.upload_file(f"file{i}", crypto.SecureRandom(c.CHUNK_SIZE * 24))
+                                           for i in range(3)))
+                    for i in range(3):
+                        meta_addr, _, header, _ = a.user._open(f"file{i}")
+                        refs, nodes = a.user._index_refs(header)
+                        records = [ref[0] for ref in refs + nodes]
+                        for page in a.user._load_pages(header, refs):
+                            records.extend(e[0] for e in page)
+                        self.assertLess(max(ds.stored[r] for r in records), ds.headers[meta_addr])
+
+                    ds.fail_big = True
+                    results = await asyncio.gather(a.upload_file("small", b'x' * 100),
+                                                   a.upload_file("big", crypto.SecureRandom(c.CHUNK_SIZE * 6)),
+                                                   return_exceptions=True)
+                    self.assertIsNone(results[0])
+                    self.assertIsInstance(results[1], ValueError)
+                    ds.fail_big = False
+                    self.assertEqual(await a.download_file("small"), b'x' * 100)
+                    with self.assertRaises(util.DropboxError):
+                        await a.download_file("big")
+
+            asyncio.run(run())
+        finally:
+            c.dataserver = orig
+
+    def test_pipelined_writes_per_operation(self):
+        """
+        Checks that an operation of a pipelined user neither waits for
+        nor sees the errors of another operation's writes.
+        """
+        import concurrent.futures
+
+        blocked, release = memloc.Make(), threading.Event()
+
+        class BlockingDataserver(Dataserver):
+            def SetMany(self, mapping):
+                if blocked in mapping:
+                    release.wait(5)
+                    raise ValueError("Write failed")
+                super().SetMany(mapping)
+
+        user = c.create_user("usr", "pswd")
+        orig = c.dataserver
+        c.dataserver = BlockingDataserver()
+        executor = concurrent.futures.ThreadPoolExecutor(4)
+        try:
+            u = c._PipelinedUser(user, executor, concurrency=1)
+            started, errors = threading.Event(), []
+
+            def failing_op():
+                u._set_many({blocked: b'b'})
+                started.set()
+                u._wait_writes()
+
+            def other():
+                try:
+                    u._call(failing_op)
+                except ValueError as e:
+                    errors.append(e)
+
+            t = threading.Thread(target=other)
+            t.start()
+            self.assertTrue(started.wait(5))
+
+            locs = [memloc.Make() for _ in range(3)]
+            u._call(lambda: [u._set_many({m: b'a'}) for m in locs] + [u._wait_writes()])
+            self.assertFalse(release.is_set())
+            self.assertEqual(c.dataserver.GetMany(locs), dict.fromkeys(locs, b'a'))
+
+            release.set()
+            t.join()
+            self.assertEqual(len(errors), 1)
+        finally:
+            release.set()
+            executor.shutdown()
+            c.dataserver = orig
+
+    def test_async_tamper(self):
+        """
+        Checks that AsyncUser detects a modified chunk.
+        """
+        data = crypto.SecureRandom(c.CHUNK_SIZE * 8)
+        u = c.create_user("usr", "pswd")
+        u.upload_file("file1", data)
+
+        chunk = max(dataserver.GetMap().items(), key=lambda kv: len(kv[1]))[0]
+        dataserver.Set(chunk, crypto.SecureRandom(len(dataserver.Get(chunk))))
+
+        async def run():
+            async with c.AsyncUser(u) as a:
+                with self.assertRaises(util.DropboxError):
+                    await a.download_file("file1")
+
+        asyncio.run(run())
+
+    def test_concurrent_appends(self):
+        """
+        Checks that appends from several sessions at once are all kept.
+        """
+        c.create_user("usr", "pswd")
+        sessions = [c.authenticate_user("usr", "pswd") for _ in range(4)]
+        base = len(dataserver.GetMap())
+        sessions[0].upload_file("file1", b'')
+
+        def append(u, n):
+            for i in range(5):
+                u.append_file("file1", b'<%d.%d>' % (n, i))
+
+        threads = [threading.Thread(target=append, args=(u, n)) for n, u in enumerate(sessions)]
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(switch)
+
+        data = sessions[0].download_file("file1")
+        pieces = sorted(data[1:-1].split(b'><'))
+        self.assertEqual(pieces, sorted(b'%d.%d' % (n, i) for n in range(4) for i in range(5)))
+
+        # Pages written by appends that had to retry were deleted
+        header = sessions[0]._open("file1")[2]
+        refs, nodes = sessions[0]._index_refs(header)
+        pages = sessions[0]._load_pages(header, refs)
+        chunks = {e[0] for page in pages for e in page}
+        self.assertEqual(len(dataserver.GetMap()), base + 2 + len(pages) + len(nodes) + len(chunks))
+
+    def test_overwrite_during_overwrite(self):
+        """
+        Checks that an overwrite racing another session's overwrite or
+        append does not delete chunks that the file still lists.
+        """
+        c.create_user("usr", "pswd")
+        u1, u2 = [c.authenticate_user("usr", "pswd") for _ in range(2)]
+        a, b = crypto.SecureRandom(c.CHUNK_SIZE * 2), crypto.SecureRandom(c.CHUNK_SIZE * 2)
+        a2, b2 = crypto.SecureRandom(c.CHUNK_SIZE * 2), crypto.SecureRandom(c.CHUNK_SIZE * 2)
+        u1.upload_file("file1", a + b)
+
+        # u2 stops listing chunks that u1 reuses, so u1 gives way
+        def overwritten():
+            u2.upload_file("file1", a2 + b)
+            yield a + b2
+
+        self.assertRaises(util.DropboxError, lambda: u1.upload_stream("file1", overwritten()))
+        self.assertEqual(u1.download_file("file1"), a2 + b)
+
+        # An append keeps what u1 reuses, so u1 replaces it
+        def listed():
+            header = u2._open("file1")[2]
+            refs, nodes = u2._index_refs(header)
+            pages = u2._load_pages(header, refs)
+            return {ref[0] for ref in refs + nodes} | {e[0] for page in pages for e in page}
+
+        appended = set()
+
+        def append_first():
+            u2.append_file("file1", b'tail')
+            appended.update(listed())
+            yield a2 + b2
+
+        u1.upload_stream("file1", append_first())
+        self.assertEqual(u2.download_file("file1"), a2 + b2)
+
+        # What the appended version listed and the new one does not is gone
+        gone = appended - listed()
+        self.assertTrue(gone)
+        self.assertEqual(set(dataserver.GetMany(list(gone)).values()), {None})
+
+    def test_append_during_revoke(self):
+        """
+        Checks that appends by a recipient racing the owner's revocation
+        of someone else are not lost.
+        """
+        import time
+
+        alice = c.create_user("alice", "pswd")
+        bob = c.create_user("bob", "pswd")
+        kept = c.create_user("kept", "pswd")
+        alice.upload_file("f", b'base')
+        for u in [bob, kept]:
+            alice.share_file("f", u.username)
+            u.receive_file("f", "alice")
+
+        # An append that commits after the revocation read the header
+        store_header = alice._store_header
+
+        def append_first(*args):
+            del alice._store_header
+            kept.append_file("f", b' one')
+            store_header(*args)
+
+        alice._store_header = append_first
+        alice.revoke_file("f", "bob")
+        self.assertEqual(kept.download_file("f"), b'base one')
+
+        # An append that starts while the old header is a tombstone
+        alice.share_file("f", "bob")
+        store_pointer = alice._store_pointer
+        appender = threading.Thread(target=kept.append_file, args=("f", b' two'))
+
+        def append_during(*args):
+            del alice._store_pointer
+            appender.start()
+            time.sleep(0.05)
+            store_pointer(*args)
+
+        alice._store_pointer = append_during
+        alice.revoke_file("f", "bob")
+        appender.join()
+
+        self.assertEqual(kept.download_file("f"), b'base one two')
+        self.assertEqual(alice.download_file("f"), b'base one two')
+        self.assertRaises(util.DropboxError, lambda: bob.download_file("f"))
+
+    def test_share_table_pages(self):
+        """
+        Checks sharing and revoking across several share table pages.
+        """
+        orig = c.SHARE_PAGE_ENTRIES
+        c.SHARE_PAGE_ENTRIES = 2
+        try:
+            owner = c.create_user("owner", "pswd")
+            users = [c.create_user(f"usr{i}", "pswd") for i in range(5)]
+            owner.upload_file("file1", b'data')
+            for u in users:
+                owner.share_file("file1", u.username)
+                u.receive_file("file1", "owner")
+            owner.share_file("file1", "usr0")
+
+            shares, pages = owner._load_shares(owner._load_pointer("file1"))
+            self.assertEqual([e[0] for e in shares], [u.username for u in users])
+            self.assertEqual(len(pages), 3)
+
+            owner.revoke_file("file1", "usr2")
+            owner.append_file("file1", b' more')
+            shares, pages = owner._load_shares(owner._load_pointer("file1"))
+            self.assertEqual([e[0] for e in shares], ["usr0", "usr1", "usr3", "usr4"])
+            self.assertEqual(len(pages), 2)
+            self.assertRaises(util.DropboxError, lambda: users[2].download_file("file1"))
+            for i in [0, 1, 3, 4]:
+                self.assertEqual(users[i].download_file("file1"), b'data more')
+        finally:
+            c.SHARE_PAGE_ENTRIES = orig
+
+    def test_concurrent_shares(self):
+        """
+        Checks that sessions sharing a file at once do not drop each
+        other's shares.
+        """
+        c.create_user("usr", "pswd")
+        for i in range(4):
+            c.create_user(f"friend{i}", "pswd")
+        sessions = [c.authenticate_user("usr", "pswd") for _ in range(4)]
+        sessions[0].upload_file("file1", b'data')
+
+        threads = [threading.Thread(target=u.share_file, args=("file1", f"friend{i}"))
+                   for i, u in enumerate(sessions)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        shares, _ = sessions[0]._load_shares(sessions[0]._load_pointer("file1"))
+        self.assertEqual({e[0] for e in shares}, {f"friend{i}" for i in range(4)})
+        for i in range(4):
+            friend = c.authenticate_user(f"friend{i}", "pswd")
+            friend.receive_file("file1", "usr")
+            self.assertEqual(friend.download_file("file1"), b'data')
+
+    def test_read_cache(self):
+        """
+        Checks that repeated downloads use cached metadata.
+        """
+        u = c.create_user("usr", "pswd")
+        u.upload_file("file1", b'data')
+        u.download_file("file1")
+
+        hits = u._cache.hits
+        self.assertEqual(u.download_file("file1"), b'data')
+        self.assertGreater(u._cache.hits, hits)
+
+    def test_read_cache_sessions(self):
+        """
+        Checks that a session sees changes made by another session of the
+        same user, and still detects modified metadata.
+        """
+        u1 = c.create_user("usr", "pswd")
+        u2 = c.authenticate_user("usr", "pswd")
+
+        u1.upload_file("file1", b'one')
+        self.assertEqual(u2.download_file("file1"), b'one')
+        u1.append_file("file1", b' two')
+        self.assertEqual(u2.download_file("file1"), b'one two')
+        u1.upload_file("file1", b'three')
+        self.assertEqual(u2.download_file("file1"), b'three')
+
+        _, _, header, _ = u2._open("file1")
+        meta_addr = u2._load_pointer("file1")["meta"]
+        blob = dataserver.Get(meta_addr)
+        dataserver.Set(meta_addr, bytes([blob[0] ^ 1]) + blob[1:-1] + bytes([blob[-1] ^ 1]))
+
+        self.assertRaises(util.DropboxError, lambda: u2.download_file("file1"))
+
     def test_the_next_test(self):
         """
         Implement more tests by defining more functions like this one!
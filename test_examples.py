@@ -287,14 +287,15 @@ class TestAttackExamples(unittest.TestCase):
         dataserver.Set(s_addr("a"), "oops".encode("utf-8"))
 
         #### Testing:  try to do some action as client or adversary to prove attack worked
-        user2 = c.authenticate_user("a", "oops")
+        # user2 = c.authenticate_user("a", "oops")
 
         # When you write your attack tests, you should instead
         # probably test to make sure the attack is NOT successful:
-        # self.assertRaises(util.DropboxError, c.authenticate_user, "a", "oops")
+        self.assertRaises(util.DropboxError, c.authenticate_user, "a", "oops")
 
-        # Example 2:  Try to log in as if you were user (and it should fail)
-        self.assertRaises(util.DropboxError, c.authenticate_user, "a", "1234")
+        # Example 2:  Try to log in as if you were user (and it should still work,
+        # since the client does not store the password at s_addr("a"))
+        c.authenticate_user("a", "1234")
 
     # What if we didn't know where the password was stored?  Or, what
     # if we wanted to change a lot of data?
@@ -313,8 +314,8 @@ class TestAttackExamples(unittest.TestCase):
             dataserver.Set(memloc, bytes(b'0' * 16))
 
         #### Test phase
-        check_bytes = user.download_file("file")
-        #assert(file_bytes == check_bytes)
+        # The client detects the modified data instead of returning it
+        self.assertRaises(util.DropboxError, user.download_file, "file")
 
 
 
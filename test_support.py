@@ -0,0 +1,1099 @@
+##
+## test_support.py - Tests for the support libraries
+##
+##
+
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import support.crypto as crypto
+import support.util as util
+
+from support.dataserver import Dataserver, LogBackend, VersionConflict, dataserver, memloc
+from support.keyserver import keyserver
+from support.netserver import ServiceThread, connect
+from support.sharding import ShardedDataserver
+
+
+class DataserverTests(unittest.TestCase):
+    def setUp(self):
+        dataserver.Clear()
+        keyserver.Clear()
+
+    def test_get_many(self):
+        """
+        Checks that GetMany returns stored values and None for missing memlocs.
+        """
+        m1, m2, m3 = memloc.Make(), memloc.Make(), memloc.Make()
+        dataserver.Set(m1, b'one')
+        dataserver.Set(m2, b'two')
+
+        result = dataserver.GetMany([m1, m2, m3])
+
+        self.assertEqual(result, {m1: b'one', m2: b'two', m3: None})
+
+    def test_set_many(self):
+        """
+        Checks that SetMany stores every value in the mapping.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        dataserver.SetMany({m1: b'one', m2: b'two'})
+
+        self.assertEqual(dataserver.Get(m1), b'one')
+        self.assertEqual(dataserver.Get(m2), b'two')
+
+    def test_list_keys(self):
+        """
+        Checks that ListKeys lists stored memlocs by prefix.
+        """
+        locs = [bytes([i]) + memloc.Make()[1:] for i in [1, 1, 2]]
+        dataserver.SetMany(dict.fromkeys(locs, b'x'))
+        dataserver.Delete(locs[1])
+
+        self.assertEqual(sorted(dataserver.ListKeys()), sorted([locs[0], locs[2]]))
+        self.assertEqual(dataserver.ListKeys(b'\x01'), [locs[0]])
+        self.assertEqual(dataserver.ListKeys(locs[2]), [locs[2]])
+        self.assertEqual(dataserver.ListKeys(b'\x03'), [])
+        self.assertRaises(ValueError, lambda: dataserver.ListKeys("not bytes"))
+
+    def test_bytes_like_values(self):
+        """
+        Checks that bytearrays and memoryviews are stored as a snapshot of
+        their contents, and that non-contiguous views are rejected.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        buf = bytearray(b'mutable')
+        dataserver.Set(m1, buf)
+        dataserver.SetMany({m2: memoryview(b'xxviewxx')[2:6]})
+        buf[:] = b'changed'
+
+        self.assertEqual(dataserver.Get(m1), b'mutable')
+        self.assertEqual(dataserver.Get(m2), b'view')
+        self.assertRaises(ValueError, lambda: dataserver.Set(m1, memoryview(b'abcd')[::2]))
+
+    def test_set_many_validates_first(self):
+        """
+        Checks that an invalid entry in SetMany leaves the server unchanged.
+        """
+        m1 = memloc.Make()
+
+        self.assertRaises(ValueError,
+                          lambda: dataserver.SetMany({m1: b'one', memloc.Make(): "str"}))
+        self.assertRaises(Exception,
+                          lambda: dataserver.SetMany({m1: b'one', b'short': b'two'}))
+        self.assertEqual(dataserver.GetMap(), {})
+
+    def test_delete_many(self):
+        """
+        Checks that DeleteMany reports which memlocs held a value.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        dataserver.Set(m1, b'one')
+
+        result = dataserver.DeleteMany([m1, m2])
+
+        self.assertEqual(result, {m1: True, m2: False})
+        self.assertRaises(ValueError, lambda: dataserver.Get(m1))
+
+    def _stress(self, ds: Dataserver) -> list:
+        """
+        Run writers, readers, deleters and a clearer on one group of
+        memlocs spread over every stripe, and a compactor if the backend
+        has one, and return any inconsistent reads: a GetMany must never
+        see part of a SetMany, nor a value that was never written.
+        """
+        group = [memloc.MakeFromBytes(bytes([i * 32]) + bytes(15)) for i in range(8)]
+        valid = {b'%d.%d' % (n, i) for n in range(4) for i in range(300)} | {None}
+        errors = []
+        done = threading.Event()
+
+        def writer(n):
+            for i in range(300):
+                ds.SetMany({m: b'%d.%d' % (n, i) for m in group})
+
+        def reader():
+            while not done.is_set():
+                vals = {v if v is None else bytes(v) for v in ds.GetMany(group).values()}
+                if len(vals) != 1 or not vals <= valid:
+                    errors.append(vals)
+
+        def deleter():
+            while not done.is_set():
+                ds.DeleteMany(group)
+                ds.Clear()
+
+        def compactor():
+            while not done.is_set():
+                ds.backend.compact()
+
+        tasks = [reader, reader, deleter]
+        if hasattr(ds.backend, "compact"):
+            tasks.append(compactor)
+        writers = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        others = [threading.Thread(target=f) for f in tasks]
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for t in writers + others:
+                t.start()
+            for t in writers:
+                t.join()
+        finally:
+            done.set()
+            for t in others:
+                t.join()
+            sys.setswitchinterval(switch)
+        return errors
+
+    def test_thread_safety(self):
+        """
+        Checks that batched calls are atomic under concurrent use, with
+        both backends.
+        """
+        self.assertEqual(self._stress(Dataserver()), [])
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = LogBackend(os.path.join(tmp, "data.log"))
+            self.assertEqual(self._stress(Dataserver(backend)), [])
+            backend.close()
+
+        self.assertEqual(self._stress(Dataserver(stripes=1)), [])
+        self.assertRaises(ValueError, lambda: Dataserver(stripes=300))
+
+    def test_concurrent_delete(self):
+        """
+        Checks that exactly one of several racing Deletes succeeds.
+        """
+        ds = Dataserver()
+        for _ in range(50):
+            m = memloc.Make()
+            ds.Set(m, b'x')
+            deleted = []
+
+            def delete():
+                try:
+                    ds.Delete(m)
+                    deleted.append(m)
+                except ValueError:
+                    pass
+
+            threads = [threading.Thread(target=delete) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(deleted, [m])
+
+    def test_keyserver_set_if_absent(self):
+        """
+        Checks that exactly one of several racing Keyserver Sets succeeds.
+        """
+        pks = [crypto.AsymmetricKeyGen()[0] for _ in range(2)]
+        for i in range(50):
+            won = []
+
+            def register(pk):
+                try:
+                    keyserver.Set(f"usr{i}", pk)
+                    won.append(pk)
+                except ValueError:
+                    pass
+
+            threads = [threading.Thread(target=register, args=(pks[j % 2],)) for j in range(6)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(won), 1)
+            self.assertIs(keyserver.Get(f"usr{i}"), won[0])
+
+    def test_versioned(self):
+        """
+        Checks GetVersioned and SetIfVersion.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        self.assertEqual(dataserver.GetVersioned(m1), (None, 0))
+        self.assertRaises(VersionConflict, lambda: dataserver.SetIfVersion(m1, b'a', 1))
+
+        v1 = dataserver.SetIfVersion(m1, b'a', 0)
+        self.assertEqual(dataserver.GetVersioned(m1), (b'a', v1))
+        self.assertRaises(VersionConflict, lambda: dataserver.SetIfVersion(m1, b'b', 0))
+
+        # Every kind of write changes the version, and versions are not reused
+        dataserver.Set(m1, b'a')
+        v2 = dataserver.GetVersioned(m1)[1]
+        dataserver.SetMany({m1: b'c', m2: b'd'})
+        v3 = dataserver.GetVersioned(m1)[1]
+        self.assertEqual(len({v1, v2, v3}), 3)
+        self.assertRaises(VersionConflict, lambda: dataserver.SetIfVersion(m1, b'e', v1))
+        self.assertEqual(dataserver.Get(m1), b'c')
+
+        dataserver.Delete(m1)
+        self.assertEqual(dataserver.GetVersioned(m1), (None, 0))
+        self.assertGreater(dataserver.SetIfVersion(m1, b'f', 0), v3)
+
+        dataserver.Clear()
+        self.assertEqual(dataserver.GetVersioned(m2), (None, 0))
+
+    def test_versioned_counter(self):
+        """
+        Checks that optimistic increments from several threads are never
+        lost.
+        """
+        ds = Dataserver()
+        m = memloc.Make()
+        ds.Set(m, b'0')
+
+        def increment():
+            for _ in range(200):
+                while True:
+                    val, version = ds.GetVersioned(m)
+                    try:
+                        ds.SetIfVersion(m, b'%d' % (int(val) + 1), version)
+                        break
+                    except VersionConflict:
+                        pass
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(switch)
+        self.assertEqual(ds.Get(m), b'800')
+
+    def test_separate_instances(self):
+        """
+        Checks that Dataserver instances do not share storage.
+        """
+        ds = Dataserver()
+        m = memloc.Make()
+        ds.Set(m, b'data')
+
+        self.assertEqual(dataserver.GetMany([m]), {m: None})
+
+
+class LogBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "data.log")
+        self.backend = LogBackend(self.path)
+        self.ds = Dataserver(self.backend)
+
+    def tearDown(self):
+        self.backend.close()
+        self.dir.cleanup()
+
+    def reopen(self) -> Dataserver:
+        self.backend.close()
+        self.backend = LogBackend(self.path)
+        return Dataserver(self.backend)
+
+    def test_get_set_delete(self):
+        """
+        Checks that the log backend keeps the Dataserver semantics.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        self.ds.Set(m1, b'one')
+        self.ds.Set(m2, b'two')
+        self.ds.Set(m1, b'uno')
+        self.ds.Delete(m2)
+
+        self.assertEqual(self.ds.Get(m1), b'uno')
+        self.assertIsInstance(self.ds.Get(m1), memoryview)
+        self.assertRaises(ValueError, lambda: self.ds.Get(m2))
+        self.assertRaises(ValueError, lambda: self.ds.Delete(m2))
+        self.assertEqual(self.ds.GetMap(), {m1: b'uno'})
+        self.assertEqual(self.ds.ListKeys(), [m1])
+
+    def test_persistence(self):
+        """
+        Checks that values survive reopening the log.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        self.ds.SetMany({m1: b'one', m2: b''})
+        self.ds.Delete(m1)
+
+        ds = self.reopen()
+
+        self.assertEqual(ds.GetMany([m1, m2]), {m1: None, m2: b''})
+
+    def test_truncated_tail(self):
+        """
+        Checks that a partially written record is dropped on recovery.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        self.ds.Set(m1, b'one')
+        self.ds.Set(m2, b'two' * 10)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 5)
+
+        ds = self.reopen()
+        ds.Set(m2, b'again')
+
+        self.assertEqual(ds.Get(m1), b'one')
+        self.assertEqual(self.reopen().Get(m2), b'again')
+
+    def test_compact_and_clear(self):
+        """
+        Checks that compaction keeps live values and that Clear empties
+        the log without invalidating views that were already handed out.
+        """
+        m1, m2 = memloc.Make(), memloc.Make()
+        for i in range(10):
+            self.ds.Set(m1, bytes([i]) * 100)
+        self.ds.Set(m2, b'two')
+        view = self.ds.Get(m2)
+        size = os.path.getsize(self.path)
+
+        self.backend.compact()
+
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertEqual(self.ds.Get(m1), bytes([9]) * 100)
+
+        self.ds.Clear()
+
+        self.assertEqual(self.ds.GetMap(), {})
+        self.assertEqual(view, b'two')
+        self.assertEqual(self.reopen().GetMap(), {})
+
+    def test_client_on_log_backend(self):
+        """
+        Checks that the client works on top of a log-backed dataserver.
+        """
+        import client as c
+
+        orig = c.dataserver
+        c.dataserver = self.ds
+        keyserver.Clear()
+        try:
+            u = c.create_user("usr", "pswd")
+            u.upload_file("file1", b'x' * (c.CHUNK_SIZE + 10))
+            u.append_file("file1", b'tail')
+            c.dataserver = self.reopen()
+
+            u = c.authenticate_user("usr", "pswd")
+            self.assertEqual(u.download_file("file1"), b'x' * (c.CHUNK_SIZE + 10) + b'tail')
+        finally:
+            c.dataserver = orig
+            keyserver.Clear()
+
+
+class NetServerTests(unittest.TestCase):
+    def setUp(self):
+        self.server = ServiceThread()
+        self.ds, self.ks = connect(self.server.address, pool_size=4)
+
+    def tearDown(self):
+        self.ds.client.close()
+        self.server.stop()
+
+    def test_dataserver_api(self):
+        """
+        Checks that a RemoteDataserver behaves like a local Dataserver.
+        """
+        locs = [memloc.Make() for _ in range(3)]
+        self.ds.Set(locs[0], b'one')
+        self.ds.SetMany({locs[1]: bytearray(b'two'), locs[2]: memoryview(b'three')})
+
+        self.assertEqual(self.ds.Get(locs[0]), b'one')
+        self.assertEqual(self.ds.GetMany(locs + [memloc.Make()])[locs[2]], b'three')
+        self.assertEqual(self.server.service.dataserver.GetMap()[locs[1]], b'two')
+
+        self.ds.Delete(locs[0])
+        self.assertEqual(self.ds.DeleteMany(locs[:2]), {locs[0]: False, locs[1]: True})
+        self.assertRaises(ValueError, lambda: self.ds.Get(locs[0]))
+        self.assertRaises(ValueError, lambda: self.ds.Set(locs[0], "not bytes"))
+        self.assertRaises(Exception, lambda: self.ds.Get(b'short'))
+
+        v = self.ds.SetIfVersion(locs[0], b'four', 0)
+        self.assertEqual(self.ds.GetVersioned(locs[0]), (b'four', v))
+        self.assertRaises(VersionConflict, lambda: self.ds.SetIfVersion(locs[0], b'five', 0))
+        self.assertEqual(self.ds.ListKeys(locs[0][:1]), [locs[0]])
+
+        self.ds.Clear()
+        self.assertEqual(self.ds.GetMap(), {})
+
+    def test_keyserver_api(self):
+        """
+        Checks that public keys survive the trip to the server and back.
+        """
+        pk, _ = crypto.AsymmetricKeyGen()
+        self.ks.Set("usr/enc", pk)
+        self.assertEqual(self.ks.Get("usr/enc"), pk)
+        self.assertIsInstance(self.ks.Get("usr/enc"), crypto.AsymmetricEncryptKey)
+        self.assertEqual(self.ks.GetMap(), {"usr/enc": pk})
+        self.assertRaises(ValueError, lambda: self.ks.Set("usr/enc", pk))
+        self.assertRaises(ValueError, lambda: self.ks.Set("usr/sig", b'not a key'))
+
+        self.ks.Delete("usr/enc")
+        self.assertRaises(ValueError, lambda: self.ks.Get("usr/enc"))
+
+    def test_pipeline(self):
+        """
+        Checks that pipelined calls return their results in order.
+        """
+        a, b = memloc.Make(), memloc.Make()
+        pipe = self.ds.pipeline()
+        self.assertIsNone(pipe.Set(a, b'a'))
+        pipe.Get(a)
+        pipe.Get(b)
+        pipe.GetMany([a])
+
+        results = pipe.execute(raise_on_error=False)
+        self.assertEqual(results[:2], [None, b'a'])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(results[3], {a: b'a'})
+
+        pipe.Get(b)
+        self.assertRaises(ValueError, pipe.execute)
+        self.assertEqual(pipe.execute(), [])
+
+    def test_concurrent_callers(self):
+        """
+        Checks that more threads than pooled connections can share a client.
+        """
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(50):
+                    loc, val = memloc.Make(), crypto.SecureRandom(100)
+                    self.ds.Set(loc, val)
+                    if self.ds.Get(loc) != val:
+                        errors.append(loc)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.server.service.dataserver.GetMap()), 500)
+
+    def test_client_over_unix_socket(self):
+        """
+        Checks that two clients with their own connections share one store.
+        """
+        import client as c
+
+        with tempfile.TemporaryDirectory() as tmp:
+            server = ServiceThread(path=os.path.join(tmp, "sock"))
+            ds1, ks1 = connect(server.address)
+            ds2, ks2 = connect(server.address)
+            orig = c.dataserver, c.keyserver
+            try:
+                c.dataserver, c.keyserver = ds1, ks1
+                u1 = c.create_user("usr1", "pswd")
+                c.create_user("usr2", "pswd")
+                data = crypto.SecureRandom(c.CHUNK_SIZE * 3)
+                u1.upload_file("file1", data)
+                u1.share_file("file1", "usr2")
+
+                c.dataserver, c.keyserver = ds2, ks2
+                u2 = c.authenticate_user("usr2", "pswd")
+                u2.receive_file("file1", "usr1")
+                self.assertEqual(u2.download_file("file1"), data)
+            finally:
+                c.dataserver, c.keyserver = orig
+                ds1.client.close()
+                ds2.client.close()
+                server.stop()
+
+
+class ShardingTests(unittest.TestCase):
+    def setUp(self):
+        self.ds = ShardedDataserver([Dataserver() for _ in range(3)])
+
+    def tearDown(self):
+        self.ds.close()
+
+    def test_dataserver_api(self):
+        """
+        Checks that a ShardedDataserver behaves like a single Dataserver.
+        """
+        locs = [memloc.Make() for _ in range(20)]
+        self.ds.Set(locs[0], b'zero')
+        self.ds.SetMany({m: m for m in locs[1:]})
+
+        self.assertEqual(self.ds.Get(locs[0]), b'zero')
+        self.assertEqual(self.ds.GetMany(locs[1:] + [locs[1]]), {m: m for m in locs[1:]})
+        self.assertIsNone(self.ds.GetMany([memloc.Make()]).popitem()[1])
+        self.assertEqual(len(self.ds.GetMap()), 20)
+
+        self.ds.Delete(locs[0])
+        self.assertEqual(self.ds.DeleteMany(locs[:2]), {locs[0]: False, locs[1]: True})
+        self.assertRaises(ValueError, lambda: self.ds.Get(locs[0]))
+        self.assertRaises(ValueError, lambda: self.ds.Delete(locs[0]))
+        self.assertRaises(ValueError, lambda: self.ds.SetMany({locs[0]: b'ok', locs[1]: "not bytes"}))
+        self.assertRaises(ValueError, lambda: self.ds.Get(locs[0]))
+        self.assertRaises(Exception, lambda: self.ds.Get(b'short'))
+
+        v = self.ds.SetIfVersion(locs[0], b'one', 0)
+        self.assertEqual(self.ds.GetVersioned(locs[0]), (b'one', v))
+        self.assertEqual(self.ds.GetVersioned(locs[1]), (None, 0))
+        self.assertRaises(VersionConflict, lambda: self.ds.SetIfVersion(locs[0], b'two', 0))
+        self.assertRaises(VersionConflict, lambda: self.ds.SetIfVersion(locs[0], b'two', v + 1))
+        self.assertGreater(self.ds.SetIfVersion(locs[0], b'two', v), v)
+
+        self.ds.Clear()
+        self.assertEqual(self.ds.GetMap(), {})
+
+    def test_spread(self):
+        """
+        Checks that memlocs are spread evenly and each lives on its owner.
+        """
+        locs = [memloc.Make() for _ in range(3000)]
+        self.ds.SetMany({m: b'x' for m in locs})
+
+        sizes = [len(shard.GetMap()) for shard in self.ds.shards]
+        self.assertEqual(sum(sizes), 3000)
+        for size in sizes:
+            self.assertGreater(size, 600)
+
+    def test_add_shard(self):
+        """
+        Checks that adding a shard moves about a quarter of the memlocs,
+        and that calls made while they move see a consistent store.
+        """
+        locs = [memloc.Make() for _ in range(2000)]
+        self.ds.SetMany({m: b'old' for m in locs})
+        errors = []
+
+        def worker(part, overwrite):
+            try:
+                for m in part:
+                    if self.ds.Get(m) != b'old':
+                        errors.append(m)
+                    if overwrite:
+                        self.ds.Set(m, b'new')
+                    else:
+                        self.ds.Delete(m)
+            except Exception as e:
+                errors.append(e)
+
+        # Rebalancing lists keys rather than copying whole shards
+        for shard in self.ds.shards:
+            shard.GetMap = lambda: errors.append("GetMap")
+
+        self.ds.add_shard(Dataserver())
+        threads = [threading.Thread(target=worker, args=(locs[i:1000:4], i % 2)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.ds.wait_rebalanced()
+        for shard in self.ds.shards[:-1]:
+            del shard.GetMap
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(self.ds.ListKeys()), sorted(locs[1:1000:2] + locs[1000:]))
+        expected = {m: b'new' for m in locs[1:1000:2]}
+        expected.update({m: b'old' for m in locs[1000:]})
+        self.assertEqual(self.ds.GetMap(), expected)
+        for sid, shard in enumerate(self.ds.shards):
+            for m in shard.GetMap():
+                self.assertEqual(self.ds._ring.lookup(m), sid)
+        self.assertGreater(self.ds.moved, 250)
+        self.assertLess(self.ds.moved, 750)
+
+    def test_versions_across_move(self):
+        """
+        Checks that a version read before a memloc moves no longer matches.
+        """
+        locs = [memloc.Make() for _ in range(200)]
+        versions = {m: self.ds.SetIfVersion(m, b'v', 0) for m in locs}
+
+        self.ds.add_shard(Dataserver())
+        self.ds.wait_rebalanced()
+
+        conflicts = 0
+        for m in locs:
+            try:
+                self.ds.SetIfVersion(m, b'w', versions[m])
+            except VersionConflict:
+                conflicts += 1
+                self.ds.SetIfVersion(m, b'w', self.ds.GetVersioned(m)[1])
+        self.assertEqual(conflicts, len(self.ds.shards[3].GetMap()))
+        self.assertEqual(set(self.ds.GetMap().values()), {b'w'})
+
+    def test_failed_rebalance(self):
+        """
+        Checks that a rebalance stopped by a failing shard is reported,
+        keeps every memloc reachable and can be resumed.
+        """
+        locs = [memloc.Make() for _ in range(500)]
+        self.ds.SetMany({m: m for m in locs})
+
+        def dropped(prefix=b""):
+            raise ConnectionError("Connection dropped")
+
+        self.ds.shards[1].ListKeys = dropped
+        self.ds.add_shard(Dataserver())
+        self.assertRaises(ConnectionError, self.ds.wait_rebalanced)
+        self.assertRaises(ValueError, lambda: self.ds.add_shard(Dataserver()))
+        self.assertEqual(self.ds.GetMany(locs), {m: m for m in locs})
+
+        del self.ds.shards[1].ListKeys
+        self.ds.resume_rebalance()
+        self.ds.wait_rebalanced()
+        self.ds.add_shard(Dataserver())
+        self.ds.wait_rebalanced()
+        self.assertEqual(self.ds.GetMany(locs), {m: m for m in locs})
+        for sid, shard in enumerate(self.ds.shards):
+            self.assertTrue(all(self.ds._ring.lookup(m) == sid for m in shard.GetMap()))
+
+    def test_client_on_remote_shards(self):
+        """
+        Checks that the client works on shards in separate servers.
+        """
+        import client as c
+
+        servers = [ServiceThread() for _ in range(2)]
+        self.ds = ShardedDataserver([connect(s.address)[0] for s in servers])
+        orig = c.dataserver
+        c.dataserver = self.ds
+        keyserver.Clear()
+        try:
+            u = c.create_user("usr", "pswd")
+            data = crypto.SecureRandom(c.CHUNK_SIZE * 16)
+            u.upload_file("file1", data)
+
+            server = ServiceThread()
+            servers.append(server)
+            self.ds.add_shard(connect(server.address)[0])
+            u.append_file("file1", b'tail')
+            self.ds.wait_rebalanced()
+
+            u = c.authenticate_user("usr", "pswd")
+            self.assertEqual(u.download_file("file1"), data + b'tail')
+            for s in servers:
+                self.assertTrue(s.service.dataserver.GetMap())
+        finally:
+            c.dataserver = orig
+            keyserver.Clear()
+            for shard in self.ds.shards:
+                shard.client.close()
+            for s in servers:
+                s.stop()
+
+
+class SerializationTests(unittest.TestCase):
+    def test_binary_roundtrip(self):
+        """
+        Checks that the binary codec round-trips every supported type.
+        """
+        obj = {
+            "none": None, "t": True, "f": False,
+            "ints": [0, 1, -1, 127, 128, -129, 2**70, -2**70],
+            "float": 1.5, "str": "h\u00e9llo", "empty": "",
+            b"bytes key": crypto.SecureRandom(100),
+            "nested": [[b'', {"a": [b'x']}], {}],
+            "tagged": "^^^aGk=$$$",
+            7: "int key",
+        }
+
+        b = util.ObjectToBytes(obj, codec="binary")
+
+        self.assertEqual(util.BytesToObject(b), obj)
+
+    def test_binary_smaller_than_json(self):
+        """
+        Checks that bytes fields are not base64-expanded by the binary codec.
+        """
+        obj = {"ct": crypto.SecureRandom(3000)}
+
+        self.assertLess(len(util.ObjectToBytes(obj, codec="binary")), 3020)
+        self.assertGreater(len(util.ObjectToBytes(obj)), 4000)
+
+    def test_json_still_decodes(self):
+        """
+        Checks that JSON blobs decode alongside binary ones.
+        """
+        obj = {"a": 1, "b": b'\x00\x01', "c": [None, "x"]}
+
+        self.assertEqual(util.BytesToObject(util.ObjectToBytes(obj)), obj)
+        self.assertEqual(util.BytesToObject(b'[1, 2]'), [1, 2])
+
+    def test_binary_errors(self):
+        """
+        Checks that unsupported types and malformed blobs are rejected.
+        """
+        b = util.ObjectToBytes([b'abc', "def"], codec="binary")
+
+        self.assertRaises(ValueError, lambda: util.ObjectToBytes({"s": {1, 2}}, codec="binary"))
+        self.assertRaises(ValueError, lambda: util.BytesToObject(b[:-1]))
+        self.assertRaises(ValueError, lambda: util.BytesToObject(b + b'N'))
+        self.assertRaises(ValueError, lambda: util.ObjectToBytes([], codec="xml"))
+
+    def test_binary_hostile(self):
+        """
+        Checks that blobs crafted to exhaust the decoder raise ValueError.
+        """
+        nested = b'\x01' + b'l\x01' * 100000 + b'N'
+        huge = b'\x01l' + b'\xff' * 9 + b'\x7f' + b'N'
+        many = b'\x01d\xff\xff\xff\x7f' + b'NN' * 4
+
+        for blob in [nested, huge, many, b'[' * 100000]:
+            self.assertRaises(ValueError, lambda: util.BytesToObject(blob))
+        deep = [[[[["ok"]]]]]
+        self.assertEqual(util.BytesToObject(util.ObjectToBytes(deep, codec="binary")), deep)
+
+
+class PasswordKDFTests(unittest.TestCase):
+    def test_iterations(self):
+        """
+        Checks that the work factor changes the key and defaults to PBKDF2_ITERATIONS.
+        """
+        salt = crypto.SecureRandom(16)
+
+        k_default = crypto.PasswordKDF("pswd", salt, 16)
+        k_explicit = crypto.PasswordKDF("pswd", salt, 16, crypto.PBKDF2_ITERATIONS)
+        k_other = crypto.PasswordKDF("pswd", salt, 16, crypto.PBKDF2_ITERATIONS + 1)
+
+        self.assertEqual(k_default, k_explicit)
+        self.assertNotEqual(k_default, k_other)
+        self.assertRaises(ValueError, lambda: crypto.PasswordKDF("pswd", salt, 16, 0))
+
+    def test_calibrate(self):
+        """
+        Checks that calibration scales with the target latency.
+        """
+        low = crypto.CalibratePasswordKDF(0.01, minimum=1)
+        high = crypto.CalibratePasswordKDF(0.04, minimum=1)
+
+        self.assertGreater(high, low)
+        self.assertEqual(crypto.CalibratePasswordKDF(0.0001), 1000)
+
+
+class AsmKeyTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pk, cls.sk = crypto.AsymmetricKeyGen()
+
+    def setUp(self):
+        crypto.key_intern_table.clear()
+
+    def test_serialization_cached(self):
+        """
+        Checks that a key is only serialized once per encoding.
+        """
+        self.assertIs(bytes(self.pk), bytes(self.pk))
+        self.assertIs(self.sk.to_bytes("der"), self.sk.to_bytes("der"))
+        self.assertEqual(str(self.pk), bytes(self.pk).decode())
+
+    def test_der_roundtrip(self):
+        """
+        Checks that DER keys load, compare equal to PEM keys and are smaller.
+        """
+        pk2 = crypto.AsymmetricEncryptKey.from_bytes(self.pk.to_bytes("der"))
+        sk2 = crypto.AsymmetricDecryptKey.from_bytes(self.sk.to_bytes("der"))
+
+        self.assertEqual(pk2, self.pk)
+        self.assertEqual(sk2, self.sk)
+        self.assertLess(len(self.pk.to_bytes("der")), 0.75 * len(bytes(self.pk)))
+        self.assertLess(len(self.sk.to_bytes("der")), 0.75 * len(bytes(self.sk)))
+        self.assertEqual(crypto.AsymmetricDecrypt(sk2, crypto.AsymmetricEncrypt(pk2, b'msg')), b'msg')
+        self.assertRaises(ValueError, lambda: self.pk.to_bytes("xml"))
+
+    def test_from_bytes_interned(self):
+        """
+        Checks that loading identical bytes returns the same key object,
+        of the class it was loaded as.
+        """
+        pem = bytes(self.pk)
+
+        k1 = crypto.AsymmetricEncryptKey.from_bytes(pem)
+        k2 = crypto.AsymmetricEncryptKey.from_bytes(pem)
+        k3 = crypto.SignatureVerifyKey.from_bytes(pem)
+
+        self.assertIs(k1, k2)
+        self.assertIsNot(k1, k3)
+        self.assertIsInstance(k3, crypto.SignatureVerifyKey)
+        self.assertEqual(k1, k3)
+
+
+class HybridEncryptionTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [crypto.AsymmetricKeyGen() for _ in range(3)]
+
+    def test_roundtrip(self):
+        """
+        Checks that payloads of any size round-trip, beyond the RSA limit.
+        """
+        pk, sk = self.keys[0]
+        for size in [0, 1, 200, 100000]:
+            data = crypto.SecureRandom(size)
+            self.assertEqual(crypto.HybridDecrypt(sk, crypto.HybridEncrypt(pk, data)), data)
+
+    def test_multi_recipient(self):
+        """
+        Checks that one body serves every recipient, and only them.
+        """
+        data = crypto.SecureRandom(5000)
+        wrapped, body = crypto.HybridEncryptMulti([pk for pk, _ in self.keys[:2]], data)
+
+        self.assertEqual(len(wrapped), 2)
+        for (_, sk), key in zip(self.keys, wrapped):
+            self.assertEqual(crypto.HybridDecrypt(sk, key + body), data)
+        self.assertRaises(ValueError, lambda: crypto.HybridDecrypt(self.keys[2][1], wrapped[0] + body))
+        self.assertRaises(ValueError, lambda: crypto.HybridDecrypt(self.keys[1][1], wrapped[0] + body))
+
+    def test_tampered(self):
+        """
+        Checks that modified or truncated ciphertexts are rejected.
+        """
+        pk, sk = self.keys[0]
+        ct = crypto.HybridEncrypt(pk, b'secret message')
+
+        for i in [0, len(ct) // 2, len(ct) - 1]:
+            bad = ct[:i] + bytes([ct[i] ^ 1]) + ct[i + 1:]
+            self.assertRaises(ValueError, lambda: crypto.HybridDecrypt(sk, bad))
+        self.assertRaises(ValueError, lambda: crypto.HybridDecrypt(sk, ct[:100]))
+
+
+class AuthenticatedEncryptionTests(unittest.TestCase):
+    def setUp(self):
+        self.algorithm = crypto.AEAD_ALGORITHM
+
+    def tearDown(self):
+        crypto.AEAD_ALGORITHM = self.algorithm
+
+    def _check(self, key):
+        nonce = crypto.SecureRandom(crypto.AEAD_NONCE_LEN)
+        data = crypto.SecureRandom(1000)
+        ct = crypto.AuthenticatedEncrypt(key, nonce, data, b'header')
+
+        self.assertEqual(len(ct), len(data) + crypto.AEAD_TAG_LEN + crypto.AEAD_NONCE_LEN)
+        self.assertEqual(crypto.AuthenticatedDecrypt(key, ct, b'header'), data)
+        self.assertRaises(ValueError, lambda: crypto.AuthenticatedDecrypt(key, ct, b'other'))
+        self.assertRaises(ValueError, lambda: crypto.AuthenticatedDecrypt(key, ct))
+        self.assertRaises(ValueError, lambda: crypto.AuthenticatedDecrypt(
+            crypto.SecureRandom(len(key)), ct, b'header'))
+        for i in [0, len(ct) - 20, len(ct) - 1]:
+            bad = ct[:i] + bytes([ct[i] ^ 1]) + ct[i + 1:]
+            self.assertRaises(ValueError, lambda: crypto.AuthenticatedDecrypt(key, bad, b'header'))
+        self.assertRaises(ValueError, lambda: crypto.AuthenticatedDecrypt(key, ct[:20], b'header'))
+
+        empty = crypto.AuthenticatedEncrypt(key, nonce, b'')
+        self.assertEqual(crypto.AuthenticatedDecrypt(key, empty), b'')
+
+    def test_roundtrip(self):
+        """
+        Checks that ciphertexts round-trip and that any change to the
+        ciphertext, associated data or key is detected.
+        """
+        self._check(crypto.SecureRandom(16))
+        self._check(crypto.SecureRandom(32))
+
+    def test_chacha_fallback(self):
+        """
+        Checks the ChaCha20-Poly1305 fallback, including with 128-bit keys.
+        """
+        crypto.AEAD_ALGORITHM = "ChaCha20-Poly1305"
+        self._check(crypto.SecureRandom(16))
+        self._check(crypto.SecureRandom(32))
+
+    def test_invalid_parameters(self):
+        """
+        Checks that bad key and nonce sizes are rejected.
+        """
+        nonce = crypto.SecureRandom(crypto.AEAD_NONCE_LEN)
+        self.assertRaises(ValueError, lambda: crypto.AuthenticatedEncrypt(
+            crypto.SecureRandom(15), nonce, b'data'))
+        self.assertRaises(ValueError, lambda: crypto.AuthenticatedEncrypt(
+            crypto.SecureRandom(16), nonce[:8], b'data'))
+
+
+class BytesLikeTests(unittest.TestCase):
+    def test_crypto_accepts_buffers(self):
+        """
+        Checks that crypto functions accept bytearrays and memoryview
+        slices wherever they accept bytes.
+        """
+        def view(b):
+            return memoryview(b'..' + b + b'..')[2:-2]
+
+        key, data = crypto.SecureRandom(16), crypto.SecureRandom(1000)
+
+        ct = crypto.SymmetricEncrypt(view(key), bytearray(key), view(data))
+        self.assertEqual(crypto.SymmetricDecrypt(key, view(ct)), data)
+        ct = crypto.AuthenticatedEncrypt(view(key), view(key[:12]), view(data), view(b'ad'))
+        self.assertEqual(crypto.AuthenticatedDecrypt(key, view(ct), bytearray(b'ad')), data)
+        self.assertEqual(crypto.Hash(view(data)), crypto.Hash(data))
+        self.assertEqual(crypto.HMAC(view(key), bytearray(data)), crypto.HMAC(key, data))
+        self.assertTrue(crypto.HMACEqual(view(data), data))
+        self.assertEqual(crypto.HashKDF(view(key), "x"), crypto.HashKDF(key, "x"))
+        self.assertEqual(util.BytesToObject(view(util.ObjectToBytes([1, "a"]))), [1, "a"])
+
+        self.assertRaises(TypeError, lambda: crypto.Hash(memoryview(data)[::2]))
+        self.assertRaises(TypeError, lambda: crypto.Hash("text"))
+
+
+class StreamingHashTests(unittest.TestCase):
+    def test_hash_context(self):
+        """
+        Checks that hashing in pieces of any bytes-like type matches Hash,
+        and that copies are independent.
+        """
+        data = crypto.SecureRandom(10000)
+        ctx = crypto.HashContext()
+        ctx.update(data[:10])
+        ctx.update(bytearray(data[10:5000]))
+        prefix = ctx.copy()
+        ctx.update(memoryview(data)[5000:])
+
+        self.assertEqual(ctx.finalize(), crypto.Hash(data))
+        prefix.update(b'other')
+        self.assertEqual(prefix.finalize(), crypto.Hash(data[:5000] + b'other'))
+        self.assertRaises(TypeError, lambda: crypto.HashContext().update("text"))
+
+    def test_hmac_context(self):
+        """
+        Checks that MACing in pieces matches HMAC, and that copies are
+        independent.
+        """
+        key = crypto.SecureRandom(16)
+        data = crypto.SecureRandom(10000)
+        ctx = crypto.HMACContext(key)
+        ctx.update(memoryview(data)[:3000])
+        prefix = ctx.copy()
+        ctx.update(memoryview(data)[3000:])
+
+        self.assertEqual(ctx.finalize(), crypto.HMAC(key, data))
+        self.assertEqual(prefix.finalize(), crypto.HMAC(key, data[:3000]))
+        self.assertRaises(TypeError, lambda: crypto.HMACContext("key"))
+
+
+class KeyPoolTests(unittest.TestCase):
+    def tearDown(self):
+        crypto.DisableKeyPool()
+
+    def test_pool_keys_work(self):
+        """
+        Checks that keys taken from the pool are distinct working keypairs.
+        """
+        pool = crypto.EnableKeyPool(size=2, low_water=0)
+        self.assertTrue(pool.wait_until_full(timeout=30))
+
+        pk, sk = crypto.AsymmetricKeyGen()
+        vk, signk = crypto.SignatureKeyGen()
+
+        self.assertEqual(crypto.AsymmetricDecrypt(sk, crypto.AsymmetricEncrypt(pk, b'msg')), b'msg')
+        self.assertTrue(crypto.SignatureVerify(vk, b'msg', crypto.SignatureSign(signk, b'msg')))
+        self.assertNotEqual(bytes(pk), bytes(vk))
+        self.assertEqual(pool.stats()["hits"], 2)
+
+    def test_starvation(self):
+        """
+        Checks that an empty pool still hands out keys and counts starvation.
+        """
+        pool = crypto.EnableKeyPool(size=1, low_water=0)
+        takes = 4
+        for _ in range(takes):
+            crypto.AsymmetricKeyGen()
+
+        stats = pool.stats()
+        self.assertEqual(stats["hits"] + stats["starved"], takes)
+
+    def test_disable(self):
+        """
+        Checks that disabling the pool stops the background thread.
+        """
+        pool = crypto.EnableKeyPool(size=1, low_water=0)
+        crypto.DisableKeyPool()
+
+        self.assertIsNone(crypto.key_pool)
+        self.assertFalse(pool._thread.is_alive())
+        crypto.AsymmetricKeyGen()
+
+
+class KDFCacheTests(unittest.TestCase):
+    def tearDown(self):
+        crypto.DisableKDFCache()
+
+    def test_disabled_by_default(self):
+        """
+        Checks that no cache is used unless it is enabled.
+        """
+        self.assertIsNone(crypto.kdf_cache)
+
+    def test_password_kdf_hits(self):
+        """
+        Checks that repeated derivations hit the cache and return the same key.
+        """
+        salt = crypto.SecureRandom(16)
+        uncached = crypto.PasswordKDF("pswd", salt, 16)
+        cache = crypto.EnableKDFCache()
+
+        k1 = crypto.PasswordKDF("pswd", salt, 16)
+        k2 = crypto.PasswordKDF("pswd", salt, 16)
+        k3 = crypto.PasswordKDF("pswd", salt, 32)
+        k4 = crypto.PasswordKDF("other", salt, 16)
+
+        self.assertEqual(k1, uncached)
+        self.assertEqual(k2, uncached)
+        self.assertEqual(k3[:16], uncached)
+        self.assertNotEqual(k4, uncached)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 3)
+
+    def test_hash_kdf_hits(self):
+        """
+        Checks that HashKDF results are cached by key and purpose.
+        """
+        cache = crypto.EnableKDFCache()
+        key = crypto.SecureRandom(16)
+
+        k1 = crypto.HashKDF(key, "a")
+        k2 = crypto.HashKDF(key, "a")
+        k3 = crypto.HashKDF(key, "b")
+
+        self.assertEqual(k1, k2)
+        self.assertNotEqual(k1, k3)
+        self.assertEqual(cache.stats()["hit_rate"], 1 / 3)
+
+    def test_no_raw_secrets_in_keys(self):
+        """
+        Checks that cache keys do not contain the password.
+        """
+        cache = crypto.EnableKDFCache()
+        crypto.PasswordKDF("a very recognizable password", b'salt', 16)
+
+        for digest in cache._entries:
+            self.assertNotIn(b'recognizable', digest)
+            self.assertEqual(len(digest), 32)
+
+    def test_eviction_ttl_and_clear(self):
+        """
+        Checks the size bound, expiry and clear().
+        """
+        key = crypto.SecureRandom(16)
+        cache = crypto.EnableKDFCache(maxsize=2)
+        for purpose in ["a", "b", "c"]:
+            crypto.HashKDF(key, purpose)
+
+        self.assertEqual(cache.stats()["size"], 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        cache.clear()
+        self.assertEqual(cache.stats()["size"], 0)
+
+        cache = crypto.EnableKDFCache(ttl=0)
+        crypto.HashKDF(key, "a")
+        crypto.HashKDF(key, "a")
+        self.assertEqual(cache.stats()["hits"], 0)
+
+
+if __name__ == '__main__':
+    util.start_repl(locals())